@@ -1,5 +1,7 @@
+import hashlib
 import json
 
+from django.core.cache import cache
 from django.core.exceptions import ObjectDoesNotExist
 from django.http import HttpResponseForbidden, HttpResponse, \
     StreamingHttpResponse, FileResponse
@@ -13,13 +15,67 @@ from rest_framework_simplejwt.exceptions import AuthenticationFailed
 from cohort.auth import IDServer
 from cohort.models import User, get_or_create_user
 from cohort_back.settings import JWT_SESSION_COOKIE, JWT_REFRESH_COOKIE, \
-    JWT_SERVER_ACCESS_KEY, JWT_SERVER_REFRESH_KEY
+    JWT_SERVER_ACCESS_KEY, JWT_SERVER_REFRESH_KEY, JWT_CACHE_MAX_SIZE, \
+    JWT_CACHE_MAX_TTL
+from cohort_back.ttl_cache import TtlLruCache
 
 
 class HttpResponseUnauthorized(HttpResponse):
     status_code = 401
 
 
+class VerifiedJwtCache(TtlLruCache):
+    """
+    Cache of the tokens already verified by IDServer, with the id of the
+    user they belong to, so that a token is not verified again (which can
+    mean a request to the JWT server) on every call. The user itself is
+    read on each call, so that changes to it apply at once.
+    Entries are keyed by a hash of the token and expire at the token's 'exp'
+    claim, or after max_ttl seconds if sooner.
+    Each process has its own entries: an invalidated token is also revoked
+    in django's cache, shared by the processes, for the max_ttl seconds the
+    other processes may keep it.
+    """
+    def __init__(self, max_size: int, max_ttl: int):
+        super(VerifiedJwtCache, self).__init__(max_size=max_size, ttl=max_ttl)
+
+    @staticmethod
+    def get_key(raw_token: str) -> str:
+        return hashlib.sha256(raw_token.encode('utf-8')).hexdigest()
+
+    @staticmethod
+    def get_revoked_key(key: str) -> str:
+        return f"revoked-jwt:{key}"
+
+    def get(self, raw_token: str):
+        """
+        :return: (payload, user id) if the token is cached, not expired and
+        not revoked, else None
+        """
+        key = self.get_key(raw_token)
+        if cache.get(self.get_revoked_key(key), False):
+            super(VerifiedJwtCache, self).invalidate(key)
+        return super(VerifiedJwtCache, self).get(key)
+
+    def set(self, raw_token: str, payload: dict, user_id):
+        exp = payload.get('exp', None)
+        super(VerifiedJwtCache, self).set(
+            self.get_key(raw_token), (payload, user_id),
+            expires_at=exp if isinstance(exp, (int, float)) else None
+        )
+
+    def invalidate(self, raw_token: str):
+        key = self.get_key(raw_token)
+        super(VerifiedJwtCache, self).invalidate(key)
+        if self.ttl > 0:
+            cache.set(self.get_revoked_key(key), True, timeout=self.ttl)
+
+
+verified_jwt_cache = VerifiedJwtCache(
+    max_size=JWT_CACHE_MAX_SIZE, max_ttl=JWT_CACHE_MAX_TTL
+)
+
+
 class CustomAuthentication(BaseAuthentication):
     def authenticate(self, request):
         if getattr(request, "jwt_session_key", None) is not None:
@@ -36,6 +92,12 @@ class CustomAuthentication(BaseAuthentication):
             if type(raw_token) == bytes:
                 raw_token = raw_token.decode('utf-8')
 
+        cached = verified_jwt_cache.get(raw_token)
+        if cached is not None:
+            user = User.objects.filter(pk=cached[1]).first()
+            if user is not None:
+                return user, raw_token
+
         try:
             payload = IDServer.verify_jwt(raw_token)
         except ValueError:
@@ -43,11 +105,11 @@ class CustomAuthentication(BaseAuthentication):
             # return HttpResponseUnauthorized('<h1>401 Invalid or expired JWT token</h1>', content_type='text/html')
 
         try:
-            u = User.objects.get(username=payload['username'])
-            return u, raw_token
+            user = User.objects.get(username=payload['username'])
         except ObjectDoesNotExist:
             user = get_or_create_user(jwt_access_token=raw_token)
-            return user, raw_token
+        verified_jwt_cache.set(raw_token, payload, user.pk)
+        return user, raw_token
 
     def get_header(self, request):
         """
@@ -87,6 +149,20 @@ class CustomAuthentication(BaseAuthentication):
 
 
 class CustomJwtSessionMiddleware(MiddlewareMixin):
+    @staticmethod
+    def invalidate_tokens(request):
+        # the tokens used to log out must not authenticate from the cache
+        if request.jwt_session_key is not None:
+            verified_jwt_cache.invalidate(request.jwt_session_key)
+        header = CustomAuthentication().get_header(request)
+        if header is not None:
+            try:
+                raw_token = CustomAuthentication().get_raw_token(header)
+            except AuthenticationFailed:
+                raw_token = None
+            if raw_token is not None:
+                verified_jwt_cache.invalidate(raw_token.decode('utf-8'))
+
     def process_request(self, request):
         session_key = request.COOKIES.get(JWT_SESSION_COOKIE)
         request.jwt_session_key = session_key
@@ -95,6 +171,7 @@ class CustomJwtSessionMiddleware(MiddlewareMixin):
 
     def process_response(self, request, response):
         if request.path.startswith("/accounts/logout"):
+            self.invalidate_tokens(request)
             response.delete_cookie(
                 JWT_SESSION_COOKIE
             )
@@ -1,8 +1,8 @@
 import jwt
 from jwt import InvalidSignatureError, ExpiredSignatureError
-from requests import post
 
 import cohort_back.settings as settings
+from cohort_back.http_client import http_client
 
 jwt_headers = {settings.JWT_APP_HEADER: settings.JWT_APP_NAME}
 
@@ -16,7 +16,7 @@ class IDServer:
                 settings.JWT_SERVER_REFRESH_KEY: "accessToken",
             }
 
-        resp = post("{}/jwt/".format(settings.JWT_SERVER_URL), data={
+        resp = http_client.post("{}/jwt/".format(settings.JWT_SERVER_URL), data={
             "username": username, "password": password
         })
         if resp.status_code != 200:
@@ -33,7 +33,7 @@ class IDServer:
                 lastname="Leonheart"
             )
 
-        resp = post("{}/jwt/user_info/".format(
+        resp = http_client.post("{}/jwt/user_info/".format(
             settings.JWT_SERVER_URL),
             data={"token": jwt_access_token}
         )
@@ -57,7 +57,7 @@ class IDServer:
             except (InvalidSignatureError, ExpiredSignatureError):
                 pass
         else:
-            resp = post("{}/jwt/verify/".format(
+            resp = http_client.post("{}/jwt/verify/".format(
                 settings.JWT_SERVER_URL), data={"token": access_token}
             )
             if resp.status_code == 200:
@@ -75,7 +75,7 @@ class IDServer:
                 settings.JWT_SERVER_REFRESH_KEY: "accessToken",
             }
 
-        resp = post(
+        resp = http_client.post(
             "{}/jwt/refresh/".format(settings.JWT_SERVER_URL),
             data=dict(refresh=refresh), headers=jwt_headers
         )
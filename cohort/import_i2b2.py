@@ -1,27 +1,127 @@
+import os
+import threading
+from contextlib import contextmanager
+from datetime import datetime
+from typing import Iterator
+from uuid import uuid4
+
 import psycopg2 as psycopg2
+from psycopg2.pool import ThreadedConnectionPool
+
+from cohort_back.settings import PG_OMOP_URL, PG_OMOP_USER, PG_OMOP_PASS, PG_OMOP_DBNAME, PG_OMOP_SCHEMA, DEBUG, \
+    PG_OMOP_POOL_MIN_SIZE, PG_OMOP_POOL_MAX_SIZE, PG_OMOP_ITERSIZE
+
+
+class OmopConnection(psycopg2.extensions.connection):
+    # keeps the names of the statements prepared in this session
+    def __init__(self, *args, **kwargs):
+        super(OmopConnection, self).__init__(*args, **kwargs)
+        self.prepared_statements = set()
+
 
-from cohort_back.settings import PG_OMOP_URL, PG_OMOP_USER, PG_OMOP_PASS, PG_OMOP_DBNAME, PG_OMOP_SCHEMA, DEBUG
+_omop_pool = None
+_omop_pool_pid = None
+_omop_pool_lock = threading.Lock()
 
 
-def get_one(sql):
-    conn = psycopg2.connect(
-        host=PG_OMOP_URL,
-        database=PG_OMOP_DBNAME,
-        user=PG_OMOP_USER,
-        password=PG_OMOP_PASS,
-        options='-c search_path={}'.format(PG_OMOP_SCHEMA))
-    c = conn.cursor()
+def get_omop_pool() -> ThreadedConnectionPool:
+    """
+    Returns the pool of connections to OMOP database of the current process,
+    created on first call so that forked celery workers get their own one
+    """
+    global _omop_pool, _omop_pool_pid
+    if _omop_pool is None or _omop_pool_pid != os.getpid():
+        with _omop_pool_lock:
+            if _omop_pool is None or _omop_pool_pid != os.getpid():
+                _omop_pool = ThreadedConnectionPool(
+                    PG_OMOP_POOL_MIN_SIZE, PG_OMOP_POOL_MAX_SIZE,
+                    host=PG_OMOP_URL,
+                    database=PG_OMOP_DBNAME,
+                    user=PG_OMOP_USER,
+                    password=PG_OMOP_PASS,
+                    options='-c search_path={}'.format(PG_OMOP_SCHEMA),
+                    connection_factory=OmopConnection)
+                _omop_pool_pid = os.getpid()
+    return _omop_pool
+
+
+def is_connection_usable(conn) -> bool:
+    if conn.closed:
+        return False
     try:
-        c.execute(sql)
-        rows = c.fetchall()
-    except psycopg2.Error as e:
-        if DEBUG:
-            raise Exception(
-                "Failed to retrieve cohort information from OMOP Postgres instance! SQL: {} Error: {}".format(sql,
-                                                                                                              str(e)))
-        raise Exception("Code errored! Internal 4558712.")
+        with conn.cursor() as c:
+            c.execute("SELECT 1")
+        conn.rollback()
+        return True
+    except psycopg2.Error:
+        return False
+
+
+@contextmanager
+def omop_connection():
+    """
+    Lends a healthy connection of the pool, given back (in a clean state)
+    once the block is done
+    """
+    pool = get_omop_pool()
+    conn = pool.getconn()
+    if not is_connection_usable(conn):
+        pool.putconn(conn, close=True)
+        conn = pool.getconn()
+    try:
+        yield conn
     finally:
-        conn.close()
+        if not conn.closed:
+            try:
+                conn.rollback()
+            except psycopg2.Error:
+                pass
+        pool.putconn(conn, close=bool(conn.closed))
+
+
+def get_one(sql, params=None):
+    with omop_connection() as conn:
+        c = conn.cursor()
+        try:
+            c.execute(sql, params)
+            rows = c.fetchall()
+        except psycopg2.Error as e:
+            if DEBUG:
+                raise Exception(
+                    "Failed to retrieve cohort information from OMOP Postgres instance! SQL: {} Error: {}".format(sql,
+                                                                                                                  str(e)))
+            raise Exception("Code errored! Internal 4558712.")
+        finally:
+            c.close()
+    return get_single_value(rows)
+
+
+def get_one_prepared(name: str, sql: str, arg_types: [str], params: tuple):
+    """
+    Same as get_one, for a query using $1, $2... placeholders, which is
+    prepared once per connection, so that its plan is reused by the
+    following calls
+    """
+    with omop_connection() as conn:
+        c = conn.cursor()
+        try:
+            if name not in conn.prepared_statements:
+                c.execute("PREPARE {}({}) AS {}".format(name, ", ".join(arg_types), sql))
+                conn.prepared_statements.add(name)
+            c.execute("EXECUTE {}({})".format(name, ", ".join(["%s"] * len(params))), params)
+            rows = c.fetchall()
+        except psycopg2.Error as e:
+            if DEBUG:
+                raise Exception(
+                    "Failed to retrieve cohort information from OMOP Postgres instance! SQL: {} Error: {}".format(sql,
+                                                                                                                  str(e)))
+            raise Exception("Code errored! Internal 4558712.")
+        finally:
+            c.close()
+    return get_single_value(rows)
+
+
+def get_single_value(rows):
     count = len(rows)
     if count == 1:
         return rows[0][0]
@@ -30,30 +130,47 @@ def get_one(sql):
     return None
 
 
-def get_multiple(sql):
-    conn = psycopg2.connect(
-        host=PG_OMOP_URL,
-        database=PG_OMOP_DBNAME,
-        user=PG_OMOP_USER,
-        password=PG_OMOP_PASS,
-        options='-c search_path={}'.format(PG_OMOP_SCHEMA))
-    c = conn.cursor()
-    try:
-        c.execute(sql)
-        rows = c.fetchall()
-    except psycopg2.Error as e:
-        if DEBUG:
-            raise Exception(
-                "Failed to retrieve cohort information from OMOP Postgres instance! Error: {}".format(str(e)))
-        raise Exception("Code errored! Internal 4558712.")
-    finally:
-        conn.close()
+def get_multiple(sql, params=None):
+    with omop_connection() as conn:
+        c = conn.cursor()
+        try:
+            c.execute(sql, params)
+            rows = c.fetchall()
+        except psycopg2.Error as e:
+            if DEBUG:
+                raise Exception(
+                    "Failed to retrieve cohort information from OMOP Postgres instance! Error: {}".format(str(e)))
+            raise Exception("Code errored! Internal 4558712.")
+        finally:
+            c.close()
     count = len(rows)
     if count < 1:
         return None
     return rows
 
 
+def iter_multiple(sql, params=None, itersize: int = PG_OMOP_ITERSIZE):
+    """
+    Yields the rows of the query as they are fetched, itersize at a time,
+    through a named (server-side) cursor, so that the whole result is never
+    held in memory. The connection is lent until the iteration is over.
+    """
+    with omop_connection() as conn:
+        c = conn.cursor(name="omop_{}".format(uuid4().hex))
+        c.itersize = itersize
+        try:
+            c.execute(sql, params)
+            for row in c:
+                yield row
+        except psycopg2.Error as e:
+            if DEBUG:
+                raise Exception(
+                    "Failed to retrieve cohort information from OMOP Postgres instance! Error: {}".format(str(e)))
+            raise Exception("Code errored! Internal 4558712.")
+        finally:
+            c.close()
+
+
 class OmopCohort:
     def __init__(self, sql_omop_res: any):
         self.fhir_id = sql_omop_res[0]
@@ -64,26 +181,27 @@ class OmopCohort:
         self.username = sql_omop_res[5]
 
 
-def get_users_cohorts(users_ids_aph: [str]) -> [OmopCohort]:
-    tmp = get_multiple(
-        """
+def get_users_cohorts(users_ids_aph: [str], since: datetime = None) -> Iterator[OmopCohort]:
+    """
+    :param since: if given, only the cohorts initiated after it are returned
+    """
+    sql = """
         SELECT cd.cohort_definition_id, cd.cohort_definition_name, cd.cohort_definition_description,
             cd.cohort_initiation_datetime, cd.cohort_size,
             p.provider_source_value
         FROM cohort_definition cd 
             JOIN provider p ON p.provider_id=cd.owner_entity_id 
         WHERE cd.owner_domain_id='Provider' 
-            AND p.provider_source_value IN ({})
+            AND p.provider_source_value = ANY(%s)
             AND p.delete_datetime IS NULL
             AND cd.cohort_size>0
-        """.format(", ".join([f"'{id}'" for id in users_ids_aph]))
-    )
-    if tmp is None:
-        return []
-    res = []
-    for t in tmp:
-        res.append(OmopCohort(t))
-    return res
+        """
+    params = [list(users_ids_aph)]
+    if since is not None:
+        sql += "AND cd.cohort_initiation_datetime > %s"
+        params.append(since)
+    for row in iter_multiple(sql, params):
+        yield OmopCohort(row)
 
 
 class OmopCareSiteCohort:
@@ -102,10 +220,11 @@ class OmopCareSiteCohort:
         self.right_read_data_pseudo_anonymised = sql_omop_res[11]
         self.username = sql_omop_res[12]
         self.creation_date = sql_omop_res[13]
+        self.description = ""
 
 
-def get_user_care_sites_cohorts(users_ids_aph: [str]) -> [OmopCareSiteCohort]:
-    tmp = get_multiple(
+def get_user_care_sites_cohorts(users_ids_aph: [str]) -> Iterator[OmopCareSiteCohort]:
+    rows = iter_multiple(
         """
         SELECT cd.cohort_definition_id,
             cs.care_site_name, cs.valid_start_date, cs.valid_end_date,
@@ -113,35 +232,63 @@ def get_user_care_sites_cohorts(users_ids_aph: [str]) -> [OmopCareSiteCohort]:
             cd.owner_entity_id,
             p.valid_start_datetime, p.valid_end_datetime, p.manual_valid_start_datetime, p.manual_valid_end_datetime,
             r.right_read_data_nominative, r.right_read_data_pseudo_anonymised,
-            p.provider_source_value
+            p.provider_source_value, cd.cohort_initiation_datetime
         FROM care_site cs
             JOIN care_site_history csh on cs.care_site_id=csh.care_site_id 
             JOIN provider p on p.provider_id=csh.entity_id 
             JOIN cohort_definition cd on cd.owner_entity_id=cs.care_site_id
             JOIN role r on r.role_id=csh.role_id
-        WHERE p.provider_source_value IN ({})
+        WHERE p.provider_source_value = ANY(%s)
             AND p.delete_datetime IS NULL
             AND cd.owner_domain_id='Care_site'
             AND csh.domain_id='Provider'
             AND csh.delete_datetime IS NULL
-        """.format(", ".join([f"'{id}'" for id in users_ids_aph]))
+        """, (list(users_ids_aph),)
     )
-    if tmp is None:
-        return []
-    res = []
-    for t in tmp:
-        res.append(OmopCohort(t))
-    return res
+    for row in rows:
+        yield OmopCareSiteCohort(row)
+
+
+CARE_SITES_LAST_CHANGE = """GREATEST(cd.cohort_initiation_datetime, csh.change_datetime, csh.delete_datetime,
+            p.change_datetime, p.delete_datetime)"""
+
+
+def get_care_sites_changes(users_ids_aph: [str], since: datetime = None) -> [(str, datetime)]:
+    """
+    Returns the users whose care-site cohorts, or rights on them, changed
+    after since (every user if since is None), with the datetime of their
+    last change. Deleted history rows and providers are read too, so that
+    revoked rights are seen as changes.
+    """
+    sql = """
+        SELECT p.provider_source_value, MAX({})
+        FROM care_site_history csh
+            JOIN provider p on p.provider_id=csh.entity_id
+            JOIN cohort_definition cd on cd.owner_entity_id=csh.care_site_id
+        WHERE p.provider_source_value = ANY(%s)
+            AND cd.owner_domain_id='Care_site'
+            AND csh.domain_id='Provider'
+        """.format(CARE_SITES_LAST_CHANGE)
+    params = [list(users_ids_aph)]
+    if since is not None:
+        # written as a disjunction so that each column's index can be used
+        sql += """AND (cd.cohort_initiation_datetime > %s OR csh.change_datetime > %s
+            OR csh.delete_datetime > %s OR p.change_datetime > %s OR p.delete_datetime > %s)
+        """
+        params += [since] * 5
+    sql += "GROUP BY p.provider_source_value"
+    return [(r[0], r[1]) for r in get_multiple(sql, params) or []]
 
 
 def get_unique_patient_count_from_org_union(org_ids):
     if len(org_ids) == 0:
         return 0
-    tmp = get_one(
+    tmp = get_one_prepared(
+        "unique_patient_count_from_org_union",
         """
         SELECT COUNT(*) FROM (SELECT DISTINCT vo.person_id FROM omop.visit_occurrence vo
-        WHERE vo.care_site_id IN ({})) AS temp
-        """.format(','.join([str(e) for e in org_ids]))
+        WHERE vo.care_site_id = ANY($1)) AS temp
+        """, ["bigint[]"], ([int(e) for e in org_ids],)
     )
     if tmp is None:
         raise Exception("Code errored! Internal 4558714.")
@@ -0,0 +1,78 @@
+import time
+from unittest import mock
+
+from django.core.cache import cache
+
+from cohort.AuthMiddleware import CustomAuthentication, VerifiedJwtCache, \
+    verified_jwt_cache
+from cohort_back.tests import BaseTests
+
+
+class VerifiedJwtCacheTests(BaseTests):
+    def setUp(self):
+        super(VerifiedJwtCacheTests, self).setUp()
+        verified_jwt_cache.clear()
+        cache.clear()
+
+    def test_cache_expires_at_token_exp(self):
+        jwt_cache = VerifiedJwtCache(max_size=10, max_ttl=300)
+        jwt_cache.set("expired", dict(username=self.user1.username, exp=time.time() - 1), self.user1.pk)
+        jwt_cache.set("valid", dict(username=self.user1.username, exp=time.time() + 60), self.user1.pk)
+
+        self.assertIsNone(jwt_cache.get("expired"))
+        self.assertEqual(jwt_cache.get("valid")[1], self.user1.pk)
+        self.assertEqual(jwt_cache.stats, dict(size=1, hits=1, misses=1))
+
+    def test_cache_evicts_least_recently_used(self):
+        jwt_cache = VerifiedJwtCache(max_size=2, max_ttl=300)
+        jwt_cache.set("token1", dict(username=self.user1.username), self.user1.pk)
+        jwt_cache.set("token2", dict(username=self.user2.username), self.user2.pk)
+        jwt_cache.get("token1")
+        jwt_cache.set("token3", dict(username=self.user2.username), self.user2.pk)
+
+        self.assertIsNotNone(jwt_cache.get("token1"))
+        self.assertIsNone(jwt_cache.get("token2"))
+        self.assertIsNotNone(jwt_cache.get("token3"))
+
+    def test_invalidated_token_is_revoked_in_every_process(self):
+        # each process has its own entries, the revocation being shared
+        process1_cache = VerifiedJwtCache(max_size=10, max_ttl=300)
+        process2_cache = VerifiedJwtCache(max_size=10, max_ttl=300)
+        for jwt_cache in [process1_cache, process2_cache]:
+            jwt_cache.set("token", dict(username=self.user1.username), self.user1.pk)
+
+        process1_cache.invalidate("token")
+        self.assertIsNone(process1_cache.get("token"))
+        self.assertIsNone(process2_cache.get("token"))
+
+    @mock.patch('cohort.AuthMiddleware.IDServer')
+    def test_authenticate_verifies_token_once(self, mock_id_server):
+        mock_id_server.verify_jwt.return_value = dict(
+            username=self.user1.username, exp=time.time() + 60
+        )
+        request = self.factory.get("/", HTTP_AUTHORIZATION="Bearer token")
+        request.jwt_session_key = None
+
+        self.assertEqual(CustomAuthentication().authenticate(request), (self.user1, "token"))
+        self.assertEqual(CustomAuthentication().authenticate(request), (self.user1, "token"))
+        mock_id_server.verify_jwt.assert_called_once()
+
+        verified_jwt_cache.invalidate("token")
+        CustomAuthentication().authenticate(request)
+        self.assertEqual(mock_id_server.verify_jwt.call_count, 2)
+
+    @mock.patch('cohort.AuthMiddleware.IDServer')
+    def test_authenticate_reads_user_changes(self, mock_id_server):
+        # a cached token authenticates its user as it is now
+        mock_id_server.verify_jwt.return_value = dict(
+            username=self.user1.username, exp=time.time() + 60
+        )
+        request = self.factory.get("/", HTTP_AUTHORIZATION="Bearer token")
+        request.jwt_session_key = None
+        CustomAuthentication().authenticate(request)
+
+        self.user1.is_superuser = True
+        self.user1.save()
+        user, _ = CustomAuthentication().authenticate(request)
+        mock_id_server.verify_jwt.assert_called_once()
+        self.assertTrue(user.is_superuser)
@@ -1,15 +1,16 @@
 import re
 
 from django.contrib.auth.views import LoginView
+from django.core.exceptions import FieldDoesNotExist
 from django.http import QueryDict, HttpResponseRedirect, JsonResponse, Http404
 from django.utils.decorators import method_decorator
 from django.views.decorators.cache import never_cache
 from django.views.decorators.csrf import csrf_exempt
 from django.views.decorators.debug import sensitive_post_parameters
 from django_filters.rest_framework import DjangoFilterBackend
-from rest_framework import viewsets, status
+from rest_framework import viewsets, status, serializers
 from rest_framework.filters import OrderingFilter, SearchFilter
-from rest_framework.relations import PrimaryKeyRelatedField
+from rest_framework.relations import PrimaryKeyRelatedField, ManyRelatedField
 from rest_framework.response import Response
 
 from cohort.auth import IDServer
@@ -30,17 +31,103 @@ class CustomOrderingFilter(OrderingFilter):
             yield f"-{ordering_term}" if term[0] == '-' else ordering_term
 
 
+def _relation_path(model, attrs: [str]) -> [str]:
+    # keeps the leading attributes of a serializer source that are actual
+    # relations of the model
+    path = []
+    for attr in attrs:
+        try:
+            field = model._meta.get_field(attr)
+        except FieldDoesNotExist:
+            break
+        if not field.is_relation or field.related_model is None:
+            break
+        path.append(attr)
+        model = field.related_model
+    return path
+
+
+def get_serializer_prefetch_plan(serializer, prefix: str = "",
+                                 in_prefetch: bool = False) -> ([str], [str]):
+    """
+    Walks a serializer tree and returns the lookups to give to
+    select_related and prefetch_related so that serializing a list of
+    instances runs a fixed number of queries, whatever its size
+    :param serializer: serializer instance (or ListSerializer)
+    :param prefix: lookup of the serializer's instances from the root model
+    :param in_prefetch: True if an ancestor is a many relation, in which case
+    single relations also have to be prefetched
+    :return: (select_related lookups, prefetch_related lookups)
+    """
+    if isinstance(serializer, serializers.ListSerializer):
+        serializer = serializer.child
+    model = getattr(getattr(serializer, 'Meta', None), 'model', None)
+    if model is None:
+        return [], []
+
+    select_related, prefetch_related = [], []
+    for field in serializer.fields.values():
+        if field.write_only or field.source == '*':
+            continue
+        attrs = field.source.split('.')
+        many = isinstance(field, (serializers.ListSerializer, ManyRelatedField))
+        nested = isinstance(field, serializers.BaseSerializer)
+
+        if isinstance(field, PrimaryKeyRelatedField) and len(attrs) == 1:
+            # only the pk is read, from the instance's <field>_id column
+            continue
+        if not nested and not many:
+            # a plain field only needs the relations it is read through
+            attrs = attrs[:-1]
+
+        path = _relation_path(model, attrs)
+        if len(path) == 0:
+            continue
+        lookup = "__".join(([prefix] if prefix else []) + path)
+
+        if many or in_prefetch:
+            prefetch_related.append(lookup)
+        else:
+            select_related.append(lookup)
+
+        if nested and len(path) == len(attrs):
+            sub_select, sub_prefetch = get_serializer_prefetch_plan(
+                field, prefix=lookup, in_prefetch=in_prefetch or many
+            )
+            select_related.extend(sub_select)
+            prefetch_related.extend(sub_prefetch)
+
+    return select_related, prefetch_related
+
+
 class BaseViewSet(viewsets.ModelViewSet):
     filter_backends = (DjangoFilterBackend, CustomOrderingFilter, SearchFilter,)
 
+    def get_prefetched_queryset(self, queryset):
+        # joins or prefetches every relation read by the serializer, so that
+        # read calls do not run queries per serialized row
+        select_related, prefetch_related = get_serializer_prefetch_plan(
+            self.get_serializer_class()()
+        )
+        if len(select_related):
+            queryset = queryset.select_related(*select_related)
+        if len(prefetch_related):
+            queryset = queryset.prefetch_related(*prefetch_related)
+        return queryset
+
 
 class UserObjectsRestrictedViewSet(BaseViewSet):
     def get_queryset(self):
         if self.request.user.is_superuser:
-            return self.__class__.queryset
-        if self.__class__ == UserViewSet:
-            return self.__class__.queryset.filter(uuid=self.request.user.uuid)
-        return self.__class__.queryset.filter(owner=self.request.user)
+            queryset = self.__class__.queryset.all()
+        elif self.__class__ == UserViewSet:
+            queryset = self.__class__.queryset.filter(uuid=self.request.user.uuid)
+        else:
+            queryset = self.__class__.queryset.filter(owner=self.request.user)
+
+        if self.request.method == "GET":
+            return self.get_prefetched_queryset(queryset)
+        return queryset
 
     def partial_update(self, request, *args, **kwargs):
         # temp fix untill _id is not used
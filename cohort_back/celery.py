@@ -1,6 +1,5 @@
 from __future__ import absolute_import, unicode_literals
 import os
-from typing import TypeVar
 
 from celery import Celery
 
@@ -30,105 +29,14 @@ app.autodiscover_tasks()
 # app.conf.timezone = 'UTC'
 
 @app.task()
-def import_i2b2():
-    from cohort.models import User
-    from cohort.import_i2b2 import get_users_cohorts, get_user_care_sites_cohorts
-    from explorations.models import CohortResult, I2B2_COHORT_TYPE, MY_ORGANISATIONS_COHORT_TYPE,\
-        MY_PATIENTS_COHORT_TYPE
-    from cohort.import_i2b2 import OmopCohort, OmopCareSiteCohort
-    from cohort_back.FhirAPi import JobStatus
+def import_i2b2(full: bool = False):
+    from explorations.imports import import_omop_cohorts
 
-    users = User.objects.all()
-    usernames = [u.username for u in users]
-
-    cohorts = get_users_cohorts(usernames)
-    care_sites = get_user_care_sites_cohorts(usernames)
-
-    BaseOmopCohort = TypeVar("BaseOmopCohort", OmopCohort, OmopCareSiteCohort)
-
-    def create_cohort(user, cohort: BaseOmopCohort, cohort_type):
-        from explorations.models import CohortResult, Request,\
-            RequestQuerySnapshot, DatedMeasure
-        name = cohort.name[:50] if cohort.name else ""
-        description = cohort.description[:50] if cohort.description else ""
-        fhir_id = cohort.fhir_id
-        create_date = cohort.creation_date
-        size = cohort.size
-
-        # If this cohort already exists, do not create it again
-        cohorts = CohortResult.objects.filter(owner=user, name=name, fhir_group_id=fhir_id, type=cohort_type)
-        if cohorts.count() == 1:
-            cohort = cohorts.first()
-            cohort.name = name
-            cohort.description = description
-            cohort.type = cohort_type
-            cohort.save()
-
-            dm = cohort.dated_measure
-            dm.measure = size
-            dm.fhir_datetime = create_date
-            dm.save()
-            return cohort
-
-        r = Request(
-            owner=user,
-            name=name,
-            description=description
-        )
-        r.save()
-
-        rqs = RequestQuerySnapshot(
-            owner=user,
-            request=r,
-            serialized_query="{}"
-        )
-        rqs.save()
-
-        dm = DatedMeasure(
-            owner=user,
-            request_query_snapshot=rqs,
-            request=r,
-            measure=size,
-            fhir_datetime=create_date
-        )
-        dm.save()
-
-        c = CohortResult(
-            owner=user,
-            name=name,
-            description=description,
-            dated_measure=dm,
-            request_query_snapshot=rqs,
-            request=r,
-            fhir_group_id=fhir_id,
-            type=cohort_type,
-            request_job_status=JobStatus.FINISHED.name.lower()
-        )
-        c.save()
-
-        return c
-
-    for user in users:
-        user_cohorts = [c for c in cohorts if c.username == user.username]
-        user_care_sites = [c for c in care_sites if c.username == user.username]
-
-        for cohort in user_cohorts:
-            create_cohort(user, cohort, I2B2_COHORT_TYPE)
-
-        created_cohorts = []
-        for care_site in user_care_sites:
-            if care_site.right_read_data_nominative:
-                created_cohorts.append(create_cohort(user, care_site, MY_ORGANISATIONS_COHORT_TYPE))
-            if care_site.right_read_data_pseudo_anonymised:
-                create_cohort(user, care_site, MY_PATIENTS_COHORT_TYPE)
-
-        # Delete old organizations that do not exist anymore
-        CohortResult.objects \
-            .filter(
-                owner=user,
-                type__in=[MY_ORGANISATIONS_COHORT_TYPE, MY_PATIENTS_COHORT_TYPE]
-            ) \
-            .exclude(uuid__in=[c.uuid for c in created_cohorts]).delete()
+    stats = import_omop_cohorts(full=full)
+    if stats is None:
+        print("[ImportI2b2] Skipped, another import is running")
+    else:
+        print(f"[ImportI2b2] {stats}")
 
 
 @app.task()
@@ -140,14 +48,8 @@ def update_gitlab_issues():
 
 @app.task()
 def get_pending_jobs_status():
-    from explorations.models import CohortResult
-    from cohort_back.FhirAPi import JobStatus
-    crs = CohortResult.objects.filter(
-        request_job_status__in=[
-            JobStatus.PENDING.name.lower(), JobStatus.STARTED.name.lower()
-        ]
-    )
-
-    for cr in crs:
-        cr.check_request_status()
+    from explorations.tasks import reconcile_jobs_status
 
+    stats = reconcile_jobs_status()
+    if stats["polled"]:
+        print(f"[JobsStatus] {stats}")
@@ -106,3 +106,46 @@ def post_validate_cohort(json_file: str, auth_headers) -> FhirValidateResponse:
     :rtype:
     """
     raise NotImplementedError()
+
+
+# The functions below are optional: a job API that does not have them is
+# called through the ones above only. Left to None, they are not used;
+# define them to enable the matching features.
+
+# submit_count_cohort(json_file: str, auth_headers, log_prefix: str = "",
+#                     dated_measure: Model = None,
+#                     global_estimate: bool = False) -> FhirCountResponse
+# Same as post_count_cohort but returns as soon as the job is created, with
+# its fhir_job_id and status. The job server then sends the status changes
+# of the job to the callback endpoint (explorations/jobs/callback), see
+# parse_job_callback
+# If it is None, post_count_cohort is called instead
+submit_count_cohort = None
+
+# submit_create_cohort(json_file: str, auth_headers, log_prefix: str = "",
+#                      cohort_result: Model = None) -> FhirCohortResponse
+# Same as post_create_cohort but returns as soon as the job is created, with
+# its fhir_job_id and status, see submit_count_cohort
+# If it is None, post_create_cohort is called instead
+submit_create_cohort = None
+
+# parse_job_callback(data: dict) -> FhirCountResponse
+# Called with the body sent by the job server to the callback endpoint when
+# the status of a job changes
+# Returns a FhirCountResponse for a count job, or a FhirCohortResponse for a
+# cohort creation job, with its fhir_job_id
+# If it is None, the callback endpoint answers 501
+parse_job_callback = None
+
+# get_job_status(job_id: str) -> FhirCountResponse
+# Called by the job status poller to get the status of a job, and its result
+# if it is finished, with the back-end's own credentials
+# Returns a FhirCountResponse for a count job, or a FhirCohortResponse for a
+# cohort creation job
+# If it and get_jobs_status are None, the jobs are not polled
+get_job_status = None
+
+# get_jobs_status(job_ids: [str]) -> [FhirCountResponse]
+# Same as get_job_status for several jobs in one request
+# If it is None, get_job_status is called for each job
+get_jobs_status = None
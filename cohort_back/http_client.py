@@ -0,0 +1,120 @@
+import os
+import threading
+import time
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from cohort_back.settings import HTTP_CLIENT_TIMEOUT, HTTP_CLIENT_RETRIES, \
+    HTTP_CLIENT_BACKOFF_FACTOR, HTTP_CLIENT_POOL_CONNECTIONS, \
+    HTTP_CLIENT_POOL_MAXSIZE
+
+
+class EndpointMetrics:
+    def __init__(self):
+        self.calls = 0
+        self.errors = 0
+        self.total_duration = 0.
+
+    def to_dict(self) -> dict:
+        return dict(
+            calls=self.calls, errors=self.errors,
+            total_duration=self.total_duration,
+            mean_duration=self.total_duration / self.calls
+            if self.calls else None
+        )
+
+
+class HttpClient:
+    """
+    Shared client for all outbound HTTP calls of the back-end.
+    It keeps a requests.Session per process, whose connection pools (one per
+    host) keep connections alive between calls, sets a default timeout and
+    retries failed connections and 502/503/504 responses with a backoff.
+    Non idempotent methods such as POST are only retried when the connection
+    could not be established.
+    Call count, errors and duration are recorded per endpoint.
+    """
+    def __init__(
+            self, timeout: float, retries: int, backoff_factor: float,
+            pool_connections: int, pool_maxsize: int
+    ):
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff_factor = backoff_factor
+        self.pool_connections = pool_connections
+        self.pool_maxsize = pool_maxsize
+        self._metrics = dict()
+        self._lock = threading.Lock()
+        self._session = None
+        self._session_pid = None
+
+    def build_session(self) -> requests.Session:
+        session = requests.Session()
+        adapter = HTTPAdapter(
+            pool_connections=self.pool_connections,
+            pool_maxsize=self.pool_maxsize,
+            max_retries=Retry(
+                total=self.retries,
+                backoff_factor=self.backoff_factor,
+                status_forcelist=(502, 503, 504),
+                raise_on_status=False,
+            )
+        )
+        session.mount("http://", adapter)
+        session.mount("https://", adapter)
+        return session
+
+    @property
+    def session(self) -> requests.Session:
+        # connections cannot be shared with a forked process (celery workers)
+        if self._session is None or self._session_pid != os.getpid():
+            with self._lock:
+                if self._session is None or self._session_pid != os.getpid():
+                    self._session = self.build_session()
+                    self._session_pid = os.getpid()
+        return self._session
+
+    @staticmethod
+    def get_endpoint(method: str, url: str) -> str:
+        parts = urlsplit(url)
+        return f"{method.upper()} {parts.scheme}://{parts.netloc}{parts.path}"
+
+    def request(self, method: str, url: str, **kwargs) -> requests.Response:
+        kwargs.setdefault("timeout", self.timeout)
+        endpoint = self.get_endpoint(method, url)
+        start = time.monotonic()
+        failed = True
+        try:
+            resp = self.session.request(method, url, **kwargs)
+            failed = resp.status_code >= 500
+            return resp
+        finally:
+            duration = time.monotonic() - start
+            with self._lock:
+                metrics = self._metrics.setdefault(endpoint, EndpointMetrics())
+                metrics.calls += 1
+                metrics.errors += 1 if failed else 0
+                metrics.total_duration += duration
+
+    def get(self, url: str, **kwargs) -> requests.Response:
+        return self.request("get", url, **kwargs)
+
+    def post(self, url: str, **kwargs) -> requests.Response:
+        return self.request("post", url, **kwargs)
+
+    @property
+    def metrics(self) -> dict:
+        with self._lock:
+            return dict((k, v.to_dict()) for (k, v) in self._metrics.items())
+
+
+http_client = HttpClient(
+    timeout=HTTP_CLIENT_TIMEOUT,
+    retries=HTTP_CLIENT_RETRIES,
+    backoff_factor=HTTP_CLIENT_BACKOFF_FACTOR,
+    pool_connections=HTTP_CLIENT_POOL_CONNECTIONS,
+    pool_maxsize=HTTP_CLIENT_POOL_MAXSIZE,
+)
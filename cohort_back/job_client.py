@@ -0,0 +1,310 @@
+import abc
+import asyncio
+import os
+import threading
+from datetime import datetime
+
+import aiohttp
+
+from cohort_back.FhirAPi import FhirCountResponse, FhirCohortResponse, \
+    FhirValidateResponse, JobStatus
+from cohort_back.settings import HTTP_CLIENT_TIMEOUT, \
+    FHIR_JOB_CLIENT_MAX_IN_FLIGHT, FHIR_JOB_CLIENT_POLL_INTERVAL
+
+FINAL_JOB_STATUSES = [JobStatus.FINISHED, JobStatus.ERROR, JobStatus.KILLED]
+FAILED_JOB_STATUSES = [JobStatus.ERROR, JobStatus.KILLED]
+
+COUNT_JOB = "count"
+GLOBAL_COUNT_JOB = "count_all"
+CREATE_JOB = "create"
+VALIDATE_JOB = "validate"
+
+
+class AsyncJobClient(abc.ABC):
+    """
+    Asynchronous counterpart of the functions of conf_cohort_job_api: a
+    single event loop can keep many jobs in flight, each coroutine waiting
+    for the job API without holding a thread
+    """
+    @abc.abstractmethod
+    async def submit_count(
+            self, json_file: str, auth_headers: dict,
+            global_estimate: bool = False
+    ) -> FhirCountResponse:
+        pass
+
+    @abc.abstractmethod
+    async def submit_create(
+            self, json_file: str, auth_headers: dict
+    ) -> FhirCohortResponse:
+        pass
+
+    @abc.abstractmethod
+    async def validate(
+            self, json_file: str, auth_headers: dict
+    ) -> FhirValidateResponse:
+        pass
+
+    @abc.abstractmethod
+    async def get_status(
+            self, job_id: str, auth_headers: dict = None
+    ) -> FhirCountResponse:
+        pass
+
+    @abc.abstractmethod
+    async def cancel(self, job_id: str, auth_headers: dict) -> JobStatus:
+        pass
+
+    async def close(self):
+        pass
+
+    async def get_statuses(
+            self, job_ids: [str], auth_headers: dict = None
+    ) -> [FhirCountResponse]:
+        return list(await asyncio.gather(
+            *[self.get_status(job_id, auth_headers) for job_id in job_ids]
+        ))
+
+    async def wait(
+            self, resp: FhirCountResponse, auth_headers: dict,
+            poll_interval: float = FHIR_JOB_CLIENT_POLL_INTERVAL
+    ) -> FhirCountResponse:
+        """
+        Polls the job of a submission response until it is finished
+        """
+        while resp.success and resp.fhir_job_status not in FINAL_JOB_STATUSES:
+            await asyncio.sleep(poll_interval)
+            resp = await self.get_status(resp.fhir_job_id, auth_headers)
+        return resp
+
+    async def count(
+            self, json_file: str, auth_headers: dict,
+            global_estimate: bool = False
+    ) -> FhirCountResponse:
+        return await self.wait(
+            await self.submit_count(json_file, auth_headers, global_estimate),
+            auth_headers
+        )
+
+    async def create(
+            self, json_file: str, auth_headers: dict
+    ) -> FhirCohortResponse:
+        return await self.wait(
+            await self.submit_create(json_file, auth_headers), auth_headers
+        )
+
+
+def parse_job(data: dict) -> FhirCountResponse:
+    try:
+        job_status = JobStatus[str(data.get("status", "")).upper()]
+    except KeyError:
+        job_status = JobStatus.UNKNOWN
+    fhir_datetime = datetime.fromisoformat(data["datetime"]) \
+        if data.get("datetime") else None
+    kwargs = dict(
+        count=data.get("count"), fhir_datetime=fhir_datetime,
+        fhir_job_id=data.get("job_id", ""), job_duration=data.get("duration"),
+        success=job_status not in FAILED_JOB_STATUSES,
+        err_msg=data.get("err_msg", ""), fhir_job_status=job_status
+    )
+    if "group_id" in data:
+        return FhirCohortResponse(group_id=data["group_id"] or "", **kwargs)
+    return FhirCountResponse(
+        count_male=data.get("count_male"),
+        count_unknown=data.get("count_unknown"),
+        count_deceased=data.get("count_deceased"),
+        count_alive=data.get("count_alive"),
+        count_female=data.get("count_female"),
+        count_min=data.get("count_min"), count_max=data.get("count_max"),
+        **kwargs
+    )
+
+
+class HttpJobClient(AsyncJobClient):
+    """
+    Reference implementation of AsyncJobClient, for a job API with these
+    endpoints:
+    - POST {url}/jobs, with {"type": "count", "count_all", "create" or
+      "validate", "request": json_file}, returns the job;
+    - GET {url}/jobs/{job_id}, returns the job;
+    - DELETE {url}/jobs/{job_id}, cancels the job and returns it.
+    A job is given as {"job_id", "status", "err_msg", "datetime",
+    "duration", "count", "count_male", ..., "count_min", "count_max",
+    "group_id"}, its status being one of JobStatus.
+    A validation job is returned once finished.
+    At most max_in_flight requests are sent at once, the connections being
+    kept alive between them.
+    """
+    def __init__(
+            self, url: str, headers: dict = None,
+            max_in_flight: int = FHIR_JOB_CLIENT_MAX_IN_FLIGHT,
+            timeout: float = HTTP_CLIENT_TIMEOUT
+    ):
+        self.url = url.rstrip("/")
+        # used when no user's headers are given, as by the status poller
+        self.headers = headers or dict()
+        self.max_in_flight = max_in_flight
+        self.timeout = timeout
+        self._session = None
+        self._semaphore = None
+
+    @property
+    def session(self) -> aiohttp.ClientSession:
+        # created on first use, as it is bound to the running loop
+        if self._session is None:
+            self._session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=self.max_in_flight),
+                timeout=aiohttp.ClientTimeout(total=self.timeout)
+            )
+            self._semaphore = asyncio.Semaphore(self.max_in_flight)
+        return self._session
+
+    async def request(
+            self, method: str, path: str, auth_headers: dict = None,
+            json: dict = None
+    ) -> FhirCountResponse:
+        session = self.session
+        try:
+            async with self._semaphore:
+                async with session.request(
+                        method, f"{self.url}{path}",
+                        headers=auth_headers or self.headers, json=json
+                ) as resp:
+                    if resp.status >= 400:
+                        return FhirCountResponse(
+                            success=False,
+                            err_msg=f"{resp.status}: {await resp.text()}",
+                            fhir_job_status=JobStatus.ERROR
+                        )
+                    return parse_job(await resp.json())
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            return FhirCountResponse(
+                success=False, err_msg=f"{type(e).__name__}: {str(e)}",
+                fhir_job_status=JobStatus.ERROR
+            )
+
+    async def submit_count(
+            self, json_file: str, auth_headers: dict,
+            global_estimate: bool = False
+    ) -> FhirCountResponse:
+        return await self.request("POST", "/jobs", auth_headers, dict(
+            type=GLOBAL_COUNT_JOB if global_estimate else COUNT_JOB,
+            request=json_file
+        ))
+
+    async def submit_create(
+            self, json_file: str, auth_headers: dict
+    ) -> FhirCohortResponse:
+        return await self.request("POST", "/jobs", auth_headers, dict(
+            type=CREATE_JOB, request=json_file
+        ))
+
+    async def validate(
+            self, json_file: str, auth_headers: dict
+    ) -> FhirValidateResponse:
+        resp = await self.request("POST", "/jobs", auth_headers, dict(
+            type=VALIDATE_JOB, request=json_file
+        ))
+        return FhirValidateResponse(
+            success=resp.success, err_msg=resp.err_msg,
+            fhir_job_status=resp.fhir_job_status
+        )
+
+    async def get_status(
+            self, job_id: str, auth_headers: dict = None
+    ) -> FhirCountResponse:
+        resp = await self.request("GET", f"/jobs/{job_id}", auth_headers)
+        resp.fhir_job_id = resp.fhir_job_id or job_id
+        return resp
+
+    async def cancel(self, job_id: str, auth_headers: dict) -> JobStatus:
+        resp = await self.request("DELETE", f"/jobs/{job_id}", auth_headers)
+        if not resp.success and resp.fhir_job_status == JobStatus.ERROR:
+            raise Exception(resp.err_msg)
+        return resp.fhir_job_status
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+
+class SyncJobClient:
+    """
+    Thin adapter giving the functions of conf_cohort_job_api, for the celery
+    tasks and views, over an AsyncJobClient.
+    The coroutines run on an event loop of the process, in a background
+    thread, so that every caller (tasks, the poller's threads) shares the
+    client's connections, and that get_jobs_status polls its jobs
+    concurrently. A configuration can then be written as:
+        job_client = SyncJobClient(lambda: HttpJobClient(url))
+        post_count_cohort = job_client.post_count_cohort
+        ...
+    """
+    def __init__(self, client_factory):
+        self.client_factory = client_factory
+        self._client = None
+        self._loop = None
+        self._loop_pid = None
+        self._lock = threading.Lock()
+
+    def get_loop(self) -> asyncio.AbstractEventLoop:
+        # a forked process (celery worker) does not get the loop's thread
+        if self._loop is None or self._loop_pid != os.getpid():
+            with self._lock:
+                if self._loop is None or self._loop_pid != os.getpid():
+                    loop = asyncio.new_event_loop()
+                    threading.Thread(
+                        target=loop.run_forever, daemon=True,
+                        name="job-client-loop"
+                    ).start()
+                    self._client = self.client_factory()
+                    self._loop = loop
+                    self._loop_pid = os.getpid()
+        return self._loop
+
+    def run(self, method: str, *args, **kwargs):
+        loop = self.get_loop()
+        return asyncio.run_coroutine_threadsafe(
+            getattr(self._client, method)(*args, **kwargs), loop
+        ).result()
+
+    def submit_count_cohort(
+            self, json_file: str, auth_headers, log_prefix: str = "",
+            dated_measure=None, global_estimate: bool = False
+    ) -> FhirCountResponse:
+        return self.run(
+            "submit_count", json_file, auth_headers, global_estimate
+        )
+
+    def submit_create_cohort(
+            self, json_file: str, auth_headers, log_prefix: str = "",
+            cohort_result=None
+    ) -> FhirCohortResponse:
+        return self.run("submit_create", json_file, auth_headers)
+
+    def post_count_cohort(
+            self, json_file: str, auth_headers, log_prefix: str = "",
+            dated_measure=None, global_estimate: bool = False
+    ) -> FhirCountResponse:
+        return self.run("count", json_file, auth_headers, global_estimate)
+
+    def post_create_cohort(
+            self, json_file: str, auth_headers, log_prefix: str = "",
+            cohort_result=None
+    ) -> FhirCohortResponse:
+        return self.run("create", json_file, auth_headers)
+
+    def post_validate_cohort(
+            self, json_file: str, auth_headers
+    ) -> FhirValidateResponse:
+        return self.run("validate", json_file, auth_headers)
+
+    def cancel_job(self, job_id: str, auth_headers) -> JobStatus:
+        return self.run("cancel", job_id, auth_headers)
+
+    def get_job_status(self, job_id: str) -> FhirCountResponse:
+        return self.run("get_status", job_id)
+
+    def get_jobs_status(self, job_ids: [str]) -> [FhirCountResponse]:
+        return self.run("get_statuses", job_ids)
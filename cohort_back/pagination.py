@@ -0,0 +1,175 @@
+import base64
+import json
+from collections import OrderedDict
+
+import coreapi
+import coreschema
+from django.db.models import F, Q
+from rest_framework.exceptions import NotFound
+from rest_framework.filters import OrderingFilter
+from rest_framework.pagination import BasePagination, LimitOffsetPagination
+from rest_framework.response import Response
+from rest_framework.settings import api_settings
+from rest_framework.utils.urls import replace_query_param
+
+KEYSET_VALUE = "keyset_value"
+
+
+class KeysetPagination(BasePagination):
+    """
+    Paginates on the (ordering field, uuid) couple: the next page is fetched
+    with a WHERE on the last row seen instead of an OFFSET, so every page costs
+    the same whatever its depth.
+    The ordering field is the first one given to the view's ordering filter
+    (aliases of CustomOrderingFilter included), or the view's default one.
+    The position is given to the client as an opaque 'cursor' token.
+    The total count is only computed on the first page, unless count=false.
+    For older clients, a call providing 'offset' is paginated with
+    LimitOffsetPagination.
+    """
+    cursor_query_param = 'cursor'
+    page_size_query_param = 'limit'
+    count_query_param = 'count'
+    offset_query_param = 'offset'
+    page_size = api_settings.PAGE_SIZE
+    max_page_size = 1000
+    default_ordering = '-created_at'
+    tie_breaker_field = 'uuid'
+    invalid_cursor_message = 'Invalid cursor'
+
+    offset_paginator = None
+
+    def paginate_queryset(self, queryset, request, view=None):
+        if self.offset_query_param in request.query_params:
+            self.offset_paginator = LimitOffsetPagination()
+            return self.offset_paginator.paginate_queryset(
+                queryset, request, view
+            )
+
+        self.request = request
+        self.base_url = request.build_absolute_uri()
+        self.page_size = self.get_page_size(request)
+        cursor = self.decode_cursor(request)
+
+        self.count = None
+        if cursor is None and request.query_params.get(
+                self.count_query_param, "").lower() != "false":
+            self.count = queryset.count()
+
+        field, self.descending = self.get_ordering_key(request, queryset, view)
+        queryset = queryset.annotate(**{KEYSET_VALUE: F(field)})
+
+        value = F(KEYSET_VALUE)
+        tie_breaker = F(self.tie_breaker_field)
+        if self.descending:
+            queryset = queryset.order_by(
+                value.desc(nulls_last=True), tie_breaker.desc()
+            )
+        else:
+            queryset = queryset.order_by(
+                value.asc(nulls_last=True), tie_breaker.asc()
+            )
+
+        if cursor is not None:
+            queryset = queryset.filter(self.get_after_cursor_filter(*cursor))
+
+        results = list(queryset[:self.page_size + 1])
+        self.has_next = len(results) > self.page_size
+        self.page = results[:self.page_size]
+        return self.page
+
+    def get_after_cursor_filter(self, value, tie_breaker) -> Q:
+        # rows are sorted with nulls last in both directions
+        lookup = "lt" if self.descending else "gt"
+        after_tie_breaker = Q(**{
+            f"{self.tie_breaker_field}__{lookup}": tie_breaker
+        })
+        if value is None:
+            return Q(**{f"{KEYSET_VALUE}__isnull": True}) & after_tie_breaker
+
+        return Q(**{f"{KEYSET_VALUE}__{lookup}": value}) \
+            | (Q(**{KEYSET_VALUE: value}) & after_tie_breaker) \
+            | Q(**{f"{KEYSET_VALUE}__isnull": True})
+
+    def get_ordering_key(self, request, queryset, view) -> (str, bool):
+        ordering = []
+        for backend in getattr(view, 'filter_backends', []):
+            if issubclass(backend, OrderingFilter):
+                ordering = list(
+                    backend().get_ordering(request, queryset, view) or []
+                )
+                break
+        ordering = [o for o in ordering if o != '?'] or [self.default_ordering]
+        term = ordering[0]
+        return term.lstrip('-'), term.startswith('-')
+
+    def get_page_size(self, request) -> int:
+        try:
+            page_size = int(request.query_params[self.page_size_query_param])
+            if page_size > 0:
+                return min(page_size, self.max_page_size)
+        except (KeyError, ValueError):
+            pass
+        return self.page_size
+
+    def decode_cursor(self, request):
+        encoded = request.query_params.get(self.cursor_query_param)
+        if encoded is None:
+            return None
+        try:
+            value, tie_breaker = json.loads(
+                base64.urlsafe_b64decode(encoded.encode('ascii'))
+            )
+        except (TypeError, ValueError):
+            raise NotFound(self.invalid_cursor_message)
+        return value, tie_breaker
+
+    def encode_cursor(self, instance) -> str:
+        position = [
+            getattr(instance, KEYSET_VALUE),
+            getattr(instance, self.tie_breaker_field)
+        ]
+        return base64.urlsafe_b64encode(
+            json.dumps(position, default=str).encode('ascii')
+        ).decode('ascii')
+
+    def get_next_link(self):
+        if not self.has_next:
+            return None
+        return replace_query_param(
+            self.base_url, self.cursor_query_param,
+            self.encode_cursor(self.page[-1])
+        )
+
+    def get_paginated_response(self, data):
+        if self.offset_paginator is not None:
+            return self.offset_paginator.get_paginated_response(data)
+
+        return Response(OrderedDict([
+            ('count', self.count),
+            ('next', self.get_next_link()),
+            ('previous', None),
+            ('results', data)
+        ]))
+
+    def get_schema_fields(self, view):
+        return LimitOffsetPagination().get_schema_fields(view) + [
+            coreapi.Field(
+                name=self.cursor_query_param,
+                required=False,
+                location='query',
+                schema=coreschema.String(
+                    title='Cursor',
+                    description='The pagination cursor value.'
+                )
+            ),
+            coreapi.Field(
+                name=self.count_query_param,
+                required=False,
+                location='query',
+                schema=coreschema.Boolean(
+                    title='Count',
+                    description='Set to false to skip the total count.'
+                )
+            )
+        ]
@@ -121,6 +121,12 @@ DATABASES = {
     }
 }
 
+# cache shared by the API and the celery workers, such as
+# rediscache://localhost:6380/1, each process having its own by default
+CACHES = {
+    'default': env.cache("CACHE_URL", default="locmemcache://"),
+}
+
 
 # Password validation
 # https://docs.djangoproject.com/en/2.1/ref/settings/#auth-password-validators
@@ -176,6 +182,9 @@ REST_FRAMEWORK = {
     'DEFAULT_SCHEMA_CLASS': 'rest_framework.schemas.coreapi.AutoSchema',
     'PAGE_SIZE': 100,
 }
+# number of rows fetched at once from the server-side cursor when a list is
+# streamed with ?stream=ndjson
+STREAMING_LIST_CHUNK_SIZE = int(env("STREAMING_LIST_CHUNK_SIZE", default=2000))
 
 JWT_SERVER_URL = env("JWT_SERVER_URL")
 JWT_SIGNING_KEY = env("JWT_SIGNING_KEY")
@@ -186,6 +195,18 @@ JWT_SESSION_COOKIE = "access"
 JWT_REFRESH_COOKIE = "refresh"
 JWT_SERVER_ACCESS_KEY = "access"
 JWT_SERVER_REFRESH_KEY = "refresh"
+# verified tokens are cached in each process, until their expiration or for
+# JWT_CACHE_MAX_TTL seconds at most, logged out tokens being revoked for
+# every process in CACHES
+JWT_CACHE_MAX_SIZE = int(env("JWT_CACHE_MAX_SIZE", default=10000))
+JWT_CACHE_MAX_TTL = int(env("JWT_CACHE_MAX_TTL", default=300))
+
+# Outbound HTTP calls (JWT server, Gitlab)
+HTTP_CLIENT_TIMEOUT = float(env("HTTP_CLIENT_TIMEOUT", default=30))
+HTTP_CLIENT_RETRIES = int(env("HTTP_CLIENT_RETRIES", default=3))
+HTTP_CLIENT_BACKOFF_FACTOR = float(env("HTTP_CLIENT_BACKOFF_FACTOR", default=0.5))
+HTTP_CLIENT_POOL_CONNECTIONS = int(env("HTTP_CLIENT_POOL_CONNECTIONS", default=10))
+HTTP_CLIENT_POOL_MAXSIZE = int(env("HTTP_CLIENT_POOL_MAXSIZE", default=20))
 
 SWAGGER_SETTINGS = {
     "LOGOUT_URL": "/accounts/logout/",
@@ -201,27 +222,142 @@ CELERY_RESULT_SERIALIZER = 'json'
 CELERY_TASK_SERIALIZER = 'json'
 CELERY_TASK_ALWAYS_EAGER = False
 
+# each queue is consumed by its own worker, see entry-point.sh, so that
+# interactive counts do not wait behind cohort creations or imports
+INTERACTIVE_COUNT_QUEUE = "interactive-count"
+COHORT_CREATE_QUEUE = "cohort-create"
+GLOBAL_ESTIMATE_QUEUE = "global-estimate"
+MAINTENANCE_QUEUE = "maintenance"
+CELERY_TASK_DEFAULT_QUEUE = MAINTENANCE_QUEUE
+CELERY_TASK_ROUTES = {
+    'explorations.tasks.get_count_task': {'queue': INTERACTIVE_COUNT_QUEUE},
+    'explorations.tasks.validate_snapshot_task': {'queue': INTERACTIVE_COUNT_QUEUE},
+    'explorations.tasks.create_cohort_task': {'queue': COHORT_CREATE_QUEUE},
+    # frees the FHIR job slots of the counts it cancels, ahead of them
+    'explorations.tasks.cancel_superseded_counts_task': {'queue': INTERACTIVE_COUNT_QUEUE},
+    'cohort_back.celery.*': {'queue': MAINTENANCE_QUEUE},
+}
+# tasks are given a priority from 0 (first) to 9 within their queue
+TASK_MIN_PRIORITY = 0
+TASK_MAX_PRIORITY = 9
+CELERY_TASK_DEFAULT_PRIORITY = int(env("CELERY_TASK_DEFAULT_PRIORITY", default=5))
+CELERY_BROKER_TRANSPORT_OPTIONS = {
+    'priority_steps': list(range(TASK_MIN_PRIORITY, TASK_MAX_PRIORITY + 1)),
+    'queue_order_strategy': 'priority',
+}
+# a worker reserves a single task per process, long jobs not holding back
+# the tasks queued after them
+CELERY_WORKER_PREFETCH_MULTIPLIER = int(env("CELERY_WORKER_PREFETCH_MULTIPLIER", default=1))
+
+# seconds between two runs of the job status poller, each in-flight job is
+# polled at most this often
+FHIR_JOB_POLL_MIN_INTERVAL = int(env("FHIR_JOB_POLL_MIN_INTERVAL", default=5))
+# seconds between two polls of a job, however many jobs are in flight
+FHIR_JOB_POLL_MAX_INTERVAL = int(env("FHIR_JOB_POLL_MAX_INTERVAL", default=60))
+# maximum number of job statuses polled per second
+FHIR_JOB_POLL_RATE = float(env("FHIR_JOB_POLL_RATE", default=20))
+# number of job statuses asked at once to job APIs supporting it
+FHIR_JOB_STATUS_BATCH_SIZE = int(env("FHIR_JOB_STATUS_BATCH_SIZE", default=100))
+# number of job statuses asked concurrently to other job APIs
+FHIR_JOB_STATUS_CONCURRENCY = int(env("FHIR_JOB_STATUS_CONCURRENCY", default=10))
+
+# seconds after its job finished that a count is reused for the same query
+# of users with the same rights, 0 disables the count cache
+COUNT_CACHE_TTL = int(env("COUNT_CACHE_TTL", default=600))
+
+# queries accepted by post_validate_cohort are cached in each process, for
+# VALIDATION_CACHE_TTL seconds, 0 disabling the cache
+VALIDATION_CACHE_MAX_SIZE = int(env("VALIDATION_CACHE_MAX_SIZE", default=10000))
+VALIDATION_CACHE_TTL = int(env("VALIDATION_CACHE_TTL", default=600))
+
+# if 1, snapshots are saved before FHIR validates their query, in a task,
+# the count and cohort tasks of a snapshot waiting for its validation
+ASYNC_SNAPSHOT_VALIDATION = int(env("ASYNC_SNAPSHOT_VALIDATION", default=0)) == 1
+# seconds before a task of a snapshot being validated checks it again
+SNAPSHOT_VALIDATION_RETRY_DELAY = int(env("SNAPSHOT_VALIDATION_RETRY_DELAY", default=1))
+# seconds after the creation of a snapshot still being validated when the
+# tasks waiting for it fail
+SNAPSHOT_VALIDATION_TIMEOUT = int(env("SNAPSHOT_VALIDATION_TIMEOUT", default=600))
+
+# seconds after which a count job leader that was not updated is replaced
+# by one of the measures waiting for it
+SINGLE_FLIGHT_LEADER_TIMEOUT = int(env("SINGLE_FLIGHT_LEADER_TIMEOUT", default=3600))
+# seconds after which a leader that did not submit its count job since it
+# was queued or last updated is replaced, its task being revoked or lost
+SINGLE_FLIGHT_SUBMIT_TIMEOUT = int(env("SINGLE_FLIGHT_SUBMIT_TIMEOUT", default=300))
+# seconds before a measure waiting for a count job leader checks it again,
+# doubled on each try up to SINGLE_FLIGHT_MAX_RETRY_DELAY
+SINGLE_FLIGHT_RETRY_DELAY = int(env("SINGLE_FLIGHT_RETRY_DELAY", default=2))
+SINGLE_FLIGHT_MAX_RETRY_DELAY = int(env("SINGLE_FLIGHT_MAX_RETRY_DELAY", default=60))
+
+# FHIR jobs in flight at once, for a user and for everyone, 0 disabling the
+# limit: the jobs over them wait in their task, still pending
+FHIR_JOBS_MAX_PER_USER = int(env("FHIR_JOBS_MAX_PER_USER", default=5))
+FHIR_JOBS_MAX_GLOBAL = int(env("FHIR_JOBS_MAX_GLOBAL", default=50))
+# seconds before a waiting job's task asks for a slot again, doubled on each
+# try up to FHIR_JOB_LIMITER_MAX_RETRY_DELAY, with a random jitter
+FHIR_JOB_LIMITER_RETRY_DELAY = int(env("FHIR_JOB_LIMITER_RETRY_DELAY", default=2))
+FHIR_JOB_LIMITER_MAX_RETRY_DELAY = int(env("FHIR_JOB_LIMITER_MAX_RETRY_DELAY", default=10))
+# seconds the jobs in flight and queued, counted by owner, are shared by the
+# waiting tasks before being counted again
+FHIR_JOB_LIMITER_COUNTS_TTL = int(env("FHIR_JOB_LIMITER_COUNTS_TTL", default=2))
+# seconds after which a job still waiting for a slot, or holding one without
+# a job id, is considered lost by the limiter
+FHIR_JOB_QUEUE_TIMEOUT = int(env("FHIR_JOB_QUEUE_TIMEOUT", default=600))
+FHIR_JOB_SLOT_TIMEOUT = int(env("FHIR_JOB_SLOT_TIMEOUT", default=3600))
+
+# if 1, a count started on a request cancels, in a task, the in-flight counts
+# of the request's other queries started before it
+SUPERSEDE_STALE_COUNTS = int(env("SUPERSEDE_STALE_COUNTS", default=1)) == 1
+
+# requests sent at once by an async job client of the job API
+FHIR_JOB_CLIENT_MAX_IN_FLIGHT = int(env("FHIR_JOB_CLIENT_MAX_IN_FLIGHT", default=500))
+# seconds between two polls of a job awaited by an async job client
+FHIR_JOB_CLIENT_POLL_INTERVAL = float(env("FHIR_JOB_CLIENT_POLL_INTERVAL", default=1))
+
+# the i2b2 import is incremental: it reads the care-site cohorts whose
+# rights changed since the previous run, but only the user cohorts
+# initiated since then, as OMOP cohort_definition has no modification
+# datetime. A user cohort renamed or resized in OMOP is only updated by
+# the next full import, see IMPORT_I2B2_FULL_INTERVAL
+IMPORT_I2B2_INTERVAL = int(env("IMPORT_I2B2_INTERVAL", default=300))
+
 CELERY_BEAT_SCHEDULE = {
-    # 'task-update-cohorts': {
-    #     'task': 'cohort_back.celery.import_i2b2',
-    #     'schedule': 5
-    # },
+    'task-update-cohorts': {
+        'task': 'cohort_back.celery.import_i2b2',
+        'schedule': IMPORT_I2B2_INTERVAL
+    },
     # 'task-update-gitlab-issues': {
     #     'task': 'cohort_back.celery.update_gitlab_issues',
     #     'schedule': 10
     # },
-    #     'get_pending_jobs_status': {
-    #     'task': 'cohort_back.celery.get_pending_jobs_status',
-    #     'schedule': 5
-    # }
+    'get_pending_jobs_status': {
+        'task': 'cohort_back.celery.get_pending_jobs_status',
+        'schedule': FHIR_JOB_POLL_MIN_INTERVAL
+    }
 }
 
+# token the FHIR job server sends in the X-Job-Callback-Token header of the
+# job status callbacks, the endpoint is disabled if empty
+FHIR_JOB_CALLBACK_TOKEN = env("FHIR_JOB_CALLBACK_TOKEN", default="")
 
 PG_OMOP_URL = env("PG_OMOP_URL")
 PG_OMOP_DBNAME = env("PG_OMOP_DBNAME")
 PG_OMOP_SCHEMA = env("PG_OMOP_SCHEMA")
 PG_OMOP_USER = env("PG_OMOP_USER")
 PG_OMOP_PASS = env("PG_OMOP_PASS")
+# connections to OMOP database are pooled in each process
+PG_OMOP_POOL_MIN_SIZE = int(env("PG_OMOP_POOL_MIN_SIZE", default=1))
+PG_OMOP_POOL_MAX_SIZE = int(env("PG_OMOP_POOL_MAX_SIZE", default=5))
+# number of rows fetched at once when streaming OMOP cohorts
+PG_OMOP_ITERSIZE = int(env("PG_OMOP_ITERSIZE", default=2000))
+# number of cohorts written per transaction by the i2b2 import
+IMPORT_I2B2_CHUNK_SIZE = int(env("IMPORT_I2B2_CHUNK_SIZE", default=1000))
+# seconds between two full i2b2 imports, which also delete the care-site
+# cohorts users lost their rights on
+IMPORT_I2B2_FULL_INTERVAL = int(env("IMPORT_I2B2_FULL_INTERVAL", default=86400))
+# seconds of OMOP changes read again by each incremental import
+IMPORT_I2B2_WATERMARK_OVERLAP = int(env("IMPORT_I2B2_WATERMARK_OVERLAP", default=60))
 
 VOTING_GITLAB = {
     'enable': True,
@@ -1,16 +1,22 @@
+import asyncio
 import json
 from datetime import timedelta
 
 from django.utils import timezone
 from itertools import groupby
 
-from django.test import TestCase, Client
+from unittest import mock
+
+from django.test import TestCase, Client, SimpleTestCase
 from rest_framework import status
 from rest_framework.test import APIRequestFactory
 
 from cohort.models import User
 from cohort_back.models import BaseModel
 from cohort_back.celery import app as celery_app
+from cohort_back.FhirAPi import JobStatus
+from cohort_back.http_client import HttpClient
+from cohort_back.job_client import HttpJobClient
 from explorations.models import Folder, Request, RequestQuerySnapshot, CohortResult, DatedMeasure
 
 
@@ -321,3 +327,63 @@ class SoftDeleteTests(BaseTests):
             DatedMeasure.objects.filter(uuid=self.user1_folder1_req1_snap1_dm1.uuid).first(),
             DatedMeasure.objects.filter(uuid=self.user1_folder1_req1_snap1_dm2.uuid).first(),
         ]]
+
+
+class HttpClientTests(SimpleTestCase):
+    def setUp(self):
+        self.http_client = HttpClient(
+            timeout=5, retries=1, backoff_factor=0,
+            pool_connections=1, pool_maxsize=1
+        )
+
+    def test_session_is_reused(self):
+        self.assertIs(self.http_client.session, self.http_client.session)
+
+    @mock.patch('cohort_back.http_client.requests.Session.request')
+    def test_request_metrics(self, mock_request):
+        mock_request.return_value = mock.Mock(status_code=200)
+        self.http_client.post("https://server/jwt/verify/?a=b", data={})
+        mock_request.return_value = mock.Mock(status_code=503)
+        self.http_client.post("https://server/jwt/verify/", data={})
+
+        self.assertEqual(mock_request.call_args[1]["timeout"], 5)
+        metrics = self.http_client.metrics["POST https://server/jwt/verify/"]
+        self.assertEqual(metrics["calls"], 2)
+        self.assertEqual(metrics["errors"], 1)
+
+
+class JobClientTests(SimpleTestCase):
+    def run_with_stub_server(self, test):
+        # the stub lives with the benchmarks, outside of the django apps
+        from tests.stub_job_server import StubJobServer
+
+        async def run():
+            server = StubJobServer(min_duration=1, max_duration=1.5)
+            runner, url = await server.start()
+            client = HttpJobClient(url)
+            try:
+                return server, await test(client)
+            finally:
+                await client.close()
+                await runner.cleanup()
+        return asyncio.run(run())
+
+    def test_counts_are_in_flight_together(self):
+        async def test(client):
+            return await asyncio.gather(*[client.count("{}", {}) for _ in range(50)])
+
+        server, resps = self.run_with_stub_server(test)
+        self.assertEqual(server.max_running, 50)
+        self.assertTrue(all(r.fhir_job_status == JobStatus.FINISHED for r in resps))
+        self.assertTrue(all(r.count is not None for r in resps))
+
+    def test_create_and_cancel(self):
+        async def test(client):
+            created = await client.create("{}", {})
+            submitted = await client.submit_count("{}", {})
+            return created, await client.cancel(submitted.fhir_job_id, {})
+
+        _, (created, cancelled) = self.run_with_stub_server(test)
+        self.assertEqual(created.fhir_job_status, JobStatus.FINISHED)
+        self.assertNotEqual(created.group_id, "")
+        self.assertEqual(cancelled, JobStatus.KILLED)
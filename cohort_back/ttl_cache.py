@@ -0,0 +1,63 @@
+import threading
+import time
+from collections import OrderedDict
+
+
+class TtlLruCache:
+    """
+    In-process, thread-safe LRU cache of at most max_size entries, each one
+    expiring after ttl seconds, or at the time it was set with.
+    Counts its hits and misses. A max_size or ttl of 0 disables it.
+    """
+    def __init__(self, max_size: int, ttl: int):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: str):
+        """
+        :return: the value of the key if it is cached and did not expire,
+        else None
+        """
+        with self._lock:
+            entry = self._entries.get(key, None)
+            if entry is not None and entry[0] <= time.time():
+                del self._entries[key]
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def set(self, key: str, value, expires_at: float = None):
+        if self.max_size <= 0 or self.ttl <= 0:
+            return
+        max_expires_at = time.time() + self.ttl
+        expires_at = max_expires_at if expires_at is None \
+            else min(expires_at, max_expires_at)
+        with self._lock:
+            self._entries[key] = (expires_at, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, key: str):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.hits = 0
+            self.misses = 0
+
+    @property
+    def stats(self) -> dict:
+        return dict(
+            size=len(self._entries), hits=self.hits, misses=self.misses
+        )
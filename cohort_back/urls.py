@@ -21,6 +21,7 @@ from rest_framework import routers, permissions
 from rest_framework_swagger.views import get_swagger_view
 
 from cohort.views import UserViewSet
+from cohort_back.views import HttpClientStatsView
 from explorations.views import SearchCriteria
 # Routers provide an easy way of automatically determining the URL conf.
 from voting.views import IssuePost
@@ -55,6 +56,7 @@ urlpatterns = [
 #    url(r'^accounts/', include('rest_framework.urls')),
     url(r'^search/criteria/$', SearchCriteria.as_view(), name="search_criteria"),
     url(r'^voting/create-issue', IssuePost.as_view(), name='voting_issues'),
+    path('http-client', HttpClientStatsView.as_view(), name="http-client"),
     # url(r'^voting/thumbs', Thumbs.as_view(), name='voting_thumbs'),
     # url(r'^groups/<str:name>/add/<str:username>$', SearchCriteria.as_view(), name="search_criteria"),
 ]
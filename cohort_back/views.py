@@ -1,5 +1,16 @@
+import json
+from itertools import islice
+
+from django.db.models import prefetch_related_objects
+from django.http import StreamingHttpResponse
 from rest_framework import status
 from rest_framework.response import Response
+from rest_framework.utils.encoders import JSONEncoder
+from rest_framework.views import APIView
+
+from cohort.permissions import IsAdmin
+from cohort_back.http_client import http_client
+from cohort_back.settings import STREAMING_LIST_CHUNK_SIZE
 
 
 class NoDeleteViewSetMixin:
@@ -18,3 +29,55 @@ class NoUpdateViewSetMixin:
                         status=status.HTTP_400_BAD_REQUEST)
 
 
+class StreamingListViewSetMixin:
+    """
+    Allows a list call to be streamed as newline delimited json with
+    ?stream=ndjson: the filtered queryset is read through a server-side
+    cursor and each row is serialized and sent as soon as it is fetched,
+    so that memory does not depend on the number of results.
+    prefetch_related being ignored when iterating over a queryset this way,
+    the prefetched relations are fetched for each chunk of rows instead.
+    """
+    stream_param = "stream"
+    stream_format = "ndjson"
+    stream_chunk_size = STREAMING_LIST_CHUNK_SIZE
+
+    def list(self, request, *args, **kwargs):
+        if request.query_params.get(self.stream_param) != self.stream_format:
+            return super(StreamingListViewSetMixin, self).list(
+                request, *args, **kwargs
+            )
+
+        queryset = self.filter_queryset(self.get_queryset())
+        serializer_class = self.get_serializer_class()
+        context = self.get_serializer_context()
+        chunk_size = self.stream_chunk_size
+
+        prefetch_lookups = queryset._prefetch_related_lookups
+
+        def stream_rows():
+            rows = queryset.iterator(chunk_size=chunk_size)
+            while True:
+                chunk = list(islice(rows, chunk_size))
+                if len(chunk) == 0:
+                    return
+                if len(prefetch_lookups):
+                    prefetch_related_objects(chunk, *prefetch_lookups)
+                for instance in chunk:
+                    data = serializer_class(instance, context=context).data
+                    yield json.dumps(data, cls=JSONEncoder) + "\n"
+
+        return StreamingHttpResponse(
+            stream_rows(), content_type="application/x-ndjson"
+        )
+
+
+class HttpClientStatsView(APIView):
+    """
+    Calls, errors and mean duration of the outbound HTTP calls of the
+    process serving the request, per endpoint
+    """
+    permission_classes = (IsAdmin,)
+
+    def get(self, request):
+        return Response(http_client.metrics)
@@ -16,7 +16,20 @@ service nginx restart
 # Install the settings
 python manage.py migrate
 
-celery worker -B -A cohort_back --loglevel=info >> /app/log/celery.log 2>&1 &
+# one worker per queue, see CELERY_TASK_ROUTES, and beat on its own
+celery worker -A cohort_back -Q interactive-count -n interactive-count@%h \
+  --concurrency=${CELERY_INTERACTIVE_COUNT_CONCURRENCY:-8} --prefetch-multiplier=1 \
+  --loglevel=info >> /app/log/celery.log 2>&1 &
+celery worker -A cohort_back -Q cohort-create -n cohort-create@%h \
+  --concurrency=${CELERY_COHORT_CREATE_CONCURRENCY:-4} --prefetch-multiplier=1 -O fair \
+  --loglevel=info >> /app/log/celery.log 2>&1 &
+celery worker -A cohort_back -Q global-estimate -n global-estimate@%h \
+  --concurrency=${CELERY_GLOBAL_ESTIMATE_CONCURRENCY:-2} --prefetch-multiplier=1 -O fair \
+  --loglevel=info >> /app/log/celery.log 2>&1 &
+celery worker -A cohort_back -Q maintenance -n maintenance@%h \
+  --concurrency=${CELERY_MAINTENANCE_CONCURRENCY:-2} --prefetch-multiplier=1 -O fair \
+  --loglevel=info >> /app/log/celery.log 2>&1 &
+celery beat -A cohort_back --loglevel=info >> /app/log/celery-beat.log 2>&1 &
 sleep 10
 python manage.py runserver 49026 >> /app/log/django.log 2>&1 &
 
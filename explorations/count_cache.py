@@ -0,0 +1,150 @@
+import hashlib
+from datetime import timedelta
+
+from django.db import connection, transaction
+from django.db.models import Q
+from django.utils import timezone
+
+from cohort_back.FhirAPi import JobStatus
+from cohort_back.settings import COUNT_CACHE_TTL, \
+    SINGLE_FLIGHT_LEADER_TIMEOUT, SINGLE_FLIGHT_SUBMIT_TIMEOUT
+from explorations.models import DatedMeasure, CohortResult, \
+    sync_cohort_results, IN_FLIGHT_JOB_STATUSES, DATED_MEASURE_RESULT_FIELDS, \
+    MY_ORGANISATIONS_COHORT_TYPE, MY_PATIENTS_COHORT_TYPE
+from explorations.query_normalization import get_query_fingerprint, \
+    canonical_json
+
+
+def get_query_hash(dm: DatedMeasure) -> str:
+    """
+    Fingerprint of the query of the snapshot of the dated measure, see
+    explorations.query_normalization: measures of equivalent queries share
+    their counts
+    """
+    rqs = dm.request_query_snapshot
+    return rqs.query_fingerprint \
+        or get_query_fingerprint(str(rqs.serialized_query))
+
+
+def get_rights_scope(dm: DatedMeasure) -> str:
+    """
+    Rights the count of the dated measure depends on: the perimeters of the
+    query of its snapshot, each with the rights the owner has on it, given
+    by the care-site cohorts imported for them (nominative and
+    pseudo-anonymised). Owners with the same rights on these perimeters get
+    the same counts.
+    If the perimeters are unknown, or the owner has no imported right on
+    one of them, the scope is the owner alone.
+    """
+    perimeters = sorted(set(dm.request_query_snapshot.perimeters_ids or []))
+    rights = dict()
+    for (perimeter, cohort_type) in CohortResult.objects.filter(
+            owner_id=dm.owner_id, fhir_group_id__in=perimeters,
+            type__in=[MY_ORGANISATIONS_COHORT_TYPE, MY_PATIENTS_COHORT_TYPE]
+    ).values_list("fhir_group_id", "type"):
+        rights.setdefault(perimeter, set()).add(cohort_type)
+    if len(perimeters) == 0 or any(p not in rights for p in perimeters):
+        return f"owner:{dm.owner_id}"
+    return hashlib.sha256(canonical_json(
+        [[p, sorted(rights[p])] for p in perimeters]
+    ).encode()).hexdigest()
+
+
+def fill_from_count_cache(dm: DatedMeasure) -> bool:
+    """
+    Fills the dated measure with the result of a measure of the same query,
+    rights scope (see get_rights_scope) and mode, whose count job finished
+    less than COUNT_CACHE_TTL seconds ago. A measure filled this way keeps
+    the time that job finished, so that a count is not reused for longer.
+    Records the query hash, the rights scope and the hit or miss on the
+    dated measure.
+    Returns True on a hit, the count job then not being needed
+    """
+    dm.query_hash = get_query_hash(dm)
+    dm.rights_scope = get_rights_scope(dm)
+    cached = None
+    if COUNT_CACHE_TTL > 0:
+        cached = DatedMeasure.objects.filter(
+            query_hash=dm.query_hash, rights_scope=dm.rights_scope,
+            mode=dm.mode, request_job_status=JobStatus.FINISHED.name.lower(),
+            count_finished_at__gte=timezone.now() - timedelta(
+                seconds=COUNT_CACHE_TTL
+            )
+        ).exclude(uuid=dm.uuid).order_by("-count_finished_at").first()
+
+    dm.count_cache_hit = cached is not None
+    if cached is not None:
+        for f in DATED_MEASURE_RESULT_FIELDS:
+            setattr(dm, f, getattr(cached, f))
+        dm.request_job_status = JobStatus.FINISHED.name.lower()
+        dm.save(update_fields=["query_hash", "rights_scope", "count_cache_hit",
+                               "request_job_status", "modified_at"]
+                + DATED_MEASURE_RESULT_FIELDS)
+    else:
+        dm.save(update_fields=["query_hash", "rights_scope", "count_cache_hit",
+                               "modified_at"])
+    return dm.count_cache_hit
+
+
+def elect_count_leader(dm: DatedMeasure) -> DatedMeasure:
+    """
+    Single-flight of the count jobs: among the in-flight measures of the
+    same query, rights scope (see get_rights_scope) and mode, whoever their
+    owners are, only one, the leader, runs a FHIR job, the others following
+    it to be filled with its result by fill_followers.
+    The election is serialized by a postgres advisory lock on the query and
+    rights scope.
+    A leader that failed, was killed, or was not updated for
+    SINGLE_FLIGHT_LEADER_TIMEOUT seconds (its worker being lost) is
+    replaced by the next measure to be elected, as is a leader that did
+    not submit its job SINGLE_FLIGHT_SUBMIT_TIMEOUT seconds after it was
+    queued or last updated (its task being revoked or lost).
+    Returns the leader dm follows, or None if dm has to run the job
+    """
+    if not dm.query_hash or not dm.rights_scope:
+        return None
+    submit_since = timezone.now() - timedelta(
+        seconds=SINGLE_FLIGHT_SUBMIT_TIMEOUT
+    )
+    with transaction.atomic():
+        with connection.cursor() as c:
+            c.execute("SELECT pg_advisory_xact_lock(hashtext(%s))",
+                      [f"{dm.rights_scope}:{dm.query_hash}"])
+        leader = DatedMeasure.objects.filter(
+            query_hash=dm.query_hash, rights_scope=dm.rights_scope,
+            mode=dm.mode,
+            request_job_status__in=IN_FLIGHT_JOB_STATUSES,
+            count_leader__isnull=True,
+            modified_at__gte=timezone.now() - timedelta(
+                seconds=SINGLE_FLIGHT_LEADER_TIMEOUT
+            )
+        ).exclude(
+            Q(request_job_id=""),
+            ~Q(modified_at__gte=submit_since),
+            ~Q(job_queued_at__gte=submit_since)
+        ).exclude(uuid=dm.uuid).order_by("created_at").first()
+
+        if leader is not None or dm.count_leader_id is not None:
+            dm.count_leader = leader
+            dm.save(update_fields=["count_leader", "modified_at"])
+    return leader
+
+
+def fill_followers(dm: DatedMeasure) -> int:
+    """
+    Fills the measures following dm with its result, once finished.
+    When it fails, they elect a new leader on their task's next try.
+    Returns the number of measures filled
+    """
+    if dm.request_job_status != JobStatus.FINISHED.name.lower():
+        return 0
+    filled = DatedMeasure.objects.filter(
+        count_leader=dm, request_job_status__in=IN_FLIGHT_JOB_STATUSES
+    ).update(
+        request_job_status=dm.request_job_status,
+        modified_at=timezone.now(),
+        **dict((f, getattr(dm, f)) for f in DATED_MEASURE_RESULT_FIELDS)
+    )
+    if filled:
+        sync_cohort_results(DatedMeasure.objects.filter(count_leader=dm))
+    return filled
@@ -0,0 +1,344 @@
+from datetime import datetime, timedelta
+from itertools import chain
+
+from django.db import connection, transaction
+from django.utils import timezone
+
+from cohort.import_i2b2 import get_care_sites_changes, get_users_cohorts, \
+    get_user_care_sites_cohorts
+from cohort.models import User
+from cohort_back.FhirAPi import JobStatus
+from cohort_back.settings import IMPORT_I2B2_CHUNK_SIZE, \
+    IMPORT_I2B2_FULL_INTERVAL, IMPORT_I2B2_WATERMARK_OVERLAP
+from explorations.models import CohortResult, DatedMeasure, Folder, Request, \
+    RequestQuerySnapshot, ImportWatermark, I2B2_COHORT_TYPE, \
+    MY_ORGANISATIONS_COHORT_TYPE, MY_PATIENTS_COHORT_TYPE
+
+IMPORTED_COHORT_TYPES = [
+    I2B2_COHORT_TYPE, MY_ORGANISATIONS_COHORT_TYPE, MY_PATIENTS_COHORT_TYPE
+]
+ORGANISATION_COHORT_TYPES = [
+    MY_ORGANISATIONS_COHORT_TYPE, MY_PATIENTS_COHORT_TYPE
+]
+IMPORT_FOLDER_NAME = "Imported cohorts"
+
+OMOP_COHORTS_SOURCE = "omop_cohorts"
+OMOP_CARE_SITES_SOURCE = "omop_care_sites"
+# key of the postgres advisory lock held during an import
+IMPORT_LOCK_ID = 4558700
+
+
+class CohortBulkImporter:
+    """
+    Upserts OMOP cohorts (OmopCohort or OmopCareSiteCohort) as CohortResults
+    by chunks: the cohorts already imported are loaded in one query, keyed
+    by (owner, fhir_group_id, type), then each chunk is written in a single
+    transaction with bulk_update on the existing cohorts and their dated
+    measures, and bulk_create for the new ones (with their Request,
+    RequestQuerySnapshot and DatedMeasure).
+    Once every cohort has been added, finish() flushes the last chunk and
+    deletes the organisation cohorts that were not imported again.
+    """
+    def __init__(self, users: [User], chunk_size: int = IMPORT_I2B2_CHUNK_SIZE):
+        self.users = dict((u.uuid, u) for u in users)
+        self.chunk_size = chunk_size
+        self.existing = dict()
+        self.folders = dict()
+        self.seen = set()
+        self.stats = dict(created=0, updated=0, deleted=0)
+        self._to_update = dict()
+        self._to_create = dict()
+
+    def load(self):
+        for (owner_id, fhir_group_id, cohort_type, cr_uuid, dm_uuid) in \
+                CohortResult.objects.filter(
+                    owner_id__in=self.users.keys(),
+                    type__in=IMPORTED_COHORT_TYPES
+                ).values_list(
+                    "owner_id", "fhir_group_id", "type", "uuid",
+                    "dated_measure_id"
+                ):
+            self.existing.setdefault(
+                (owner_id, fhir_group_id, cohort_type), (cr_uuid, dm_uuid)
+            )
+
+        for folder in Folder.objects.filter(
+                owner_id__in=self.users.keys(), name=IMPORT_FOLDER_NAME,
+                parent_folder=None
+        ):
+            self.folders.setdefault(folder.owner_id, folder)
+        return self
+
+    def add(self, user: User, cohort, cohort_type: str):
+        name = cohort.name[:50] if cohort.name else ""
+        description = cohort.description[:50] if cohort.description else ""
+        key = (user.uuid, str(cohort.fhir_id), cohort_type)
+        values = dict(
+            name=name, description=description, measure=cohort.size,
+            fhir_datetime=cohort.creation_date
+        )
+
+        if key in self._to_create:
+            self._to_create[key].update(values)
+        elif key in self.existing:
+            self._to_update[key] = values
+        else:
+            self._to_create[key] = values
+
+        if len(self._to_update) + len(self._to_create) >= self.chunk_size:
+            self.flush()
+
+    def flush(self):
+        with transaction.atomic():
+            self._update_existing()
+            self._create_new()
+        self._to_update = dict()
+        self._to_create = dict()
+
+    def _update_existing(self):
+        if len(self._to_update) == 0:
+            return
+        now = timezone.now()
+        crs, dms = [], []
+        for key, values in self._to_update.items():
+            cr_uuid, dm_uuid = self.existing[key]
+            crs.append(CohortResult(
+                uuid=cr_uuid, name=values["name"],
+                description=values["description"],
+                result_size=values["measure"],
+                fhir_datetime=values["fhir_datetime"], modified_at=now
+            ))
+            dms.append(DatedMeasure(
+                uuid=dm_uuid, measure=values["measure"],
+                fhir_datetime=values["fhir_datetime"], modified_at=now
+            ))
+            self.seen.add(cr_uuid)
+
+        CohortResult.objects.bulk_update(
+            crs, ["name", "description", "result_size", "fhir_datetime",
+                  "modified_at"],
+            batch_size=self.chunk_size
+        )
+        DatedMeasure.objects.bulk_update(
+            dms, ["measure", "fhir_datetime", "modified_at"],
+            batch_size=self.chunk_size
+        )
+        self.stats["updated"] += len(crs)
+
+    def _get_folders(self, owner_ids: set) -> dict:
+        missing = [Folder(owner=self.users[owner_id], name=IMPORT_FOLDER_NAME)
+                   for owner_id in owner_ids if owner_id not in self.folders]
+        for folder in Folder.objects.bulk_create(missing):
+            self.folders[folder.owner_id] = folder
+        return self.folders
+
+    def _create_new(self):
+        if len(self._to_create) == 0:
+            return
+        folders = self._get_folders(set(k[0] for k in self._to_create.keys()))
+
+        reqs, rqss, dms, crs = [], [], [], []
+        for (owner_id, fhir_group_id, cohort_type), values \
+                in self._to_create.items():
+            owner = self.users[owner_id]
+            r = Request(
+                owner=owner, name=values["name"],
+                description=values["description"],
+                parent_folder=folders[owner_id]
+            )
+            rqs = RequestQuerySnapshot(
+                owner=owner, request=r, serialized_query="{}"
+            )
+            dm = DatedMeasure(
+                owner=owner, request_query_snapshot=rqs, request=r,
+                measure=values["measure"],
+                fhir_datetime=values["fhir_datetime"]
+            )
+            cr = CohortResult(
+                owner=owner, name=values["name"],
+                description=values["description"], dated_measure=dm,
+                request_query_snapshot=rqs, request=r,
+                fhir_group_id=fhir_group_id, type=cohort_type,
+                request_job_status=JobStatus.FINISHED.name.lower()
+            )
+            cr.set_result(dm)
+            reqs.append(r)
+            rqss.append(rqs)
+            dms.append(dm)
+            crs.append(cr)
+
+            self.existing[(owner_id, fhir_group_id, cohort_type)] = (
+                cr.uuid, dm.uuid
+            )
+            self.seen.add(cr.uuid)
+
+        for model, objs in [(Request, reqs), (RequestQuerySnapshot, rqss),
+                            (DatedMeasure, dms), (CohortResult, crs)]:
+            model.objects.bulk_create(objs, batch_size=self.chunk_size)
+        self.stats["created"] += len(crs)
+
+    def delete_stale_organisations(self, owner_ids: set = None):
+        """
+        :param owner_ids: if given, only the cohorts of these users are
+        deleted, their care-site cohorts having all been added again
+        """
+        # uuids are all known from load(), so this does not need a query
+        # per user
+        stale = [cr_uuid for ((owner_id, _, cohort_type), (cr_uuid, _))
+                 in self.existing.items()
+                 if cohort_type in ORGANISATION_COHORT_TYPES
+                 and cr_uuid not in self.seen
+                 and (owner_ids is None or owner_id in owner_ids)]
+        for i in range(0, len(stale), self.chunk_size):
+            with transaction.atomic():
+                CohortResult.objects.filter(
+                    uuid__in=stale[i:i + self.chunk_size]
+                ).delete()
+        self.stats["deleted"] += len(stale)
+
+    def finish(self, reconciled_owner_ids: set = None) -> dict:
+        self.flush()
+        self.delete_stale_organisations(reconciled_owner_ids)
+        return self.stats
+
+
+def as_aware(value: datetime) -> datetime:
+    # OMOP datetimes are stored without time zone, read as in TIME_ZONE,
+    # as done for the fhir_datetime of the imported cohorts
+    return timezone.make_aware(value) if timezone.is_naive(value) else value
+
+
+def get_since(wm: ImportWatermark) -> datetime:
+    # the overlap reads again the rows of the transactions that were not
+    # committed yet when the watermark was read
+    since = (wm.watermark or wm.last_full_import_at) \
+        - timedelta(seconds=IMPORT_I2B2_WATERMARK_OVERLAP)
+    return timezone.make_naive(since)
+
+
+def update_watermark(wm: ImportWatermark, last_change: datetime,
+                     now: datetime, full: bool):
+    if last_change is not None and (wm.watermark is None
+                                    or last_change > wm.watermark):
+        wm.watermark = last_change
+    wm.last_import_at = now
+    if full:
+        wm.last_full_import_at = now
+    wm.save()
+
+
+def import_omop_cohorts(full: bool = False) -> dict:
+    """
+    Imports the OMOP cohorts of the users, and the cohorts of the care sites
+    they have rights on.
+    Unless full is True, only what changed since the watermark of each source
+    is read: the cohorts initiated since then, and all the care-site cohorts
+    of the users whose care sites or rights changed. The users created since
+    the last import are fully imported.
+    OMOP cohort_definition having no modification datetime, the changes of
+    a cohort initiated before the watermark are only read by a full import.
+    A full import, which also deletes the care-site cohorts that were not
+    imported again, is run when the last one is older than
+    IMPORT_I2B2_FULL_INTERVAL.
+    Returns None if another import is running.
+    """
+    with connection.cursor() as c:
+        c.execute("SELECT pg_try_advisory_lock(%s)", [IMPORT_LOCK_ID])
+        if not c.fetchone()[0]:
+            return None
+    try:
+        return _import_omop_cohorts(full)
+    finally:
+        with connection.cursor() as c:
+            c.execute("SELECT pg_advisory_unlock(%s)", [IMPORT_LOCK_ID])
+
+
+def _import_omop_cohorts(full: bool) -> dict:
+    now = timezone.now()
+    cohorts_wm = ImportWatermark.objects.get_or_create(
+        source=OMOP_COHORTS_SOURCE
+    )[0]
+    care_sites_wm = ImportWatermark.objects.get_or_create(
+        source=OMOP_CARE_SITES_SOURCE
+    )[0]
+    full = full or any(
+        wm.last_full_import_at is None
+        or now - wm.last_full_import_at
+        >= timedelta(seconds=IMPORT_I2B2_FULL_INTERVAL)
+        for wm in [cohorts_wm, care_sites_wm]
+    )
+
+    users = dict((u.username, u) for u in User.objects.all())
+    new_usernames = set(
+        username for (username, u) in users.items()
+        if full or u.created_at >= cohorts_wm.last_import_at
+    )
+    old_usernames = set(users.keys()) - new_usernames
+
+    # read before the cohorts, so that what changes meanwhile is read again
+    # by the next import
+    changes = []
+    if len(new_usernames):
+        changes += get_care_sites_changes(list(new_usernames))
+    if len(old_usernames):
+        changes += get_care_sites_changes(
+            list(old_usernames), get_since(care_sites_wm)
+        )
+    care_sites_usernames = new_usernames \
+        | set(username for (username, _) in changes)
+
+    cohorts = iter([])
+    if len(new_usernames):
+        cohorts = get_users_cohorts(list(new_usernames))
+    if len(old_usernames):
+        cohorts = chain(cohorts, get_users_cohorts(
+            list(old_usernames), get_since(cohorts_wm)
+        ))
+
+    if full:
+        importer_usernames = users.keys()
+    else:
+        # few cohorts changed: the existing cohorts are only loaded for
+        # their owners
+        cohorts = list(cohorts)
+        importer_usernames = care_sites_usernames \
+            | set(str(c.username) for c in cohorts)
+    importer = CohortBulkImporter(
+        [users[u] for u in importer_usernames if u in users]
+    ).load()
+
+    # OMOP rows are processed as they are streamed from the database
+    last_cohort = None
+    for cohort in cohorts:
+        user = users.get(str(cohort.username), None)
+        if user is None:
+            continue
+        importer.add(user, cohort, I2B2_COHORT_TYPE)
+        if cohort.creation_date is not None:
+            creation_date = as_aware(cohort.creation_date)
+            if last_cohort is None or creation_date > last_cohort:
+                last_cohort = creation_date
+
+    if len(care_sites_usernames):
+        for care_site in get_user_care_sites_cohorts(
+                list(care_sites_usernames)):
+            user = users.get(str(care_site.username), None)
+            if user is None:
+                continue
+            if care_site.right_read_data_nominative:
+                importer.add(user, care_site, MY_ORGANISATIONS_COHORT_TYPE)
+            if care_site.right_read_data_pseudo_anonymised:
+                importer.add(user, care_site, MY_PATIENTS_COHORT_TYPE)
+
+    # care-site cohorts that were not imported again have been removed, or
+    # the user's rights on them have
+    stats = importer.finish(None if full else set(
+        users[u].uuid for u in care_sites_usernames if u in users
+    ))
+
+    update_watermark(cohorts_wm, last_cohort, now, full)
+    update_watermark(care_sites_wm, max(
+        [as_aware(last_change) for (_, last_change) in changes
+         if last_change is not None], default=None
+    ), now, full)
+    return dict(stats, full=full)
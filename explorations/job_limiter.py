@@ -0,0 +1,179 @@
+from collections import Counter
+from datetime import timedelta
+
+from django.core.cache import cache
+from django.db import connection, transaction
+from django.db.models import Count, Min, Q
+from django.utils import timezone
+
+from cohort_back.FhirAPi import JobStatus
+from cohort_back.settings import FHIR_JOBS_MAX_PER_USER, \
+    FHIR_JOBS_MAX_GLOBAL, FHIR_JOB_QUEUE_TIMEOUT, FHIR_JOB_SLOT_TIMEOUT, \
+    FHIR_JOB_LIMITER_COUNTS_TTL
+from explorations.models import CohortResult, DatedMeasure, \
+    IN_FLIGHT_JOB_STATUSES
+
+JOB_COUNTS_CACHE_KEY = "job-limiter:counts"
+
+
+def get_job_querysets() -> list:
+    # read through the partial indexes on the jobs in flight
+    return [
+        # the dated measure of a cohort shares its job, and is not queued
+        DatedMeasure.objects.filter(
+            cohort__isnull=True,
+            request_job_status__in=IN_FLIGHT_JOB_STATUSES
+        ),
+        CohortResult.objects.filter(
+            request_job_status__in=IN_FLIGHT_JOB_STATUSES
+        ),
+    ]
+
+
+def get_in_flight_jobs() -> Counter:
+    """
+    Number of FHIR jobs in flight, by owner id: the ones submitted and not
+    over, and the ones whose task was given a slot by acquire_job_slot and
+    did not submit them yet, for FHIR_JOB_SLOT_TIMEOUT seconds
+    """
+    in_flight = Q(
+        request_job_status__in=IN_FLIGHT_JOB_STATUSES
+    ) & ~Q(request_job_id="") | Q(
+        request_job_status=JobStatus.STARTED.name.lower(), request_job_id="",
+        modified_at__gte=timezone.now() - timedelta(
+            seconds=FHIR_JOB_SLOT_TIMEOUT
+        )
+    )
+    counts = Counter()
+    for qs in get_job_querysets():
+        for row in qs.filter(in_flight).values("owner_id")\
+                .annotate(nb=Count("uuid")).order_by():
+            counts[row["owner_id"]] += row["nb"]
+    return counts
+
+
+def get_queued_jobs() -> dict:
+    """
+    FHIR jobs waiting for a slot, queued less than FHIR_JOB_QUEUE_TIMEOUT
+    seconds ago, as {owner id: (number, oldest queuing datetime)}
+    Measures following a count job leader do not wait for a slot.
+    """
+    queued = Q(
+        request_job_status=JobStatus.PENDING.name.lower(), request_job_id="",
+        job_queued_at__gte=timezone.now() - timedelta(
+            seconds=FHIR_JOB_QUEUE_TIMEOUT
+        )
+    )
+    res = dict()
+    for qs in get_job_querysets():
+        if qs.model is DatedMeasure:
+            qs = qs.filter(count_leader__isnull=True)
+        for row in qs.filter(queued).values("owner_id")\
+                .annotate(nb=Count("uuid"), oldest=Min("job_queued_at"))\
+                .order_by():
+            nb, oldest = res.get(row["owner_id"], (0, row["oldest"]))
+            res[row["owner_id"]] = (nb + row["nb"],
+                                    min(oldest, row["oldest"]))
+    return res
+
+
+def get_job_counts(refresh: bool = False) -> (Counter, dict):
+    """
+    Jobs in flight and queued by owner, see get_in_flight_jobs and
+    get_queued_jobs, shared by the waiting tasks in django's cache for
+    FHIR_JOB_LIMITER_COUNTS_TTL seconds, so that they are not counted again
+    by each of them
+    """
+    counts = None if refresh else cache.get(JOB_COUNTS_CACHE_KEY)
+    if counts is None:
+        counts = (get_in_flight_jobs(), get_queued_jobs())
+        cache.set(JOB_COUNTS_CACHE_KEY, counts,
+                  timeout=FHIR_JOB_LIMITER_COUNTS_TTL)
+    return counts
+
+
+def get_fair_queue(in_flight: Counter, queued: dict) -> list:
+    """
+    Owners with queued jobs and under FHIR_JOBS_MAX_PER_USER, in the order
+    they get the free global slots: the ones with the fewest jobs in flight
+    first, then the ones waiting for the longest
+    """
+    return sorted(
+        [o for o in queued if FHIR_JOBS_MAX_PER_USER <= 0
+         or in_flight[o] < FHIR_JOBS_MAX_PER_USER],
+        key=lambda o: (in_flight[o], queued[o][1])
+    )
+
+
+def can_run(instance, in_flight: Counter, queued: dict) -> bool:
+    owner_id = instance.owner_id
+    if 0 < FHIR_JOBS_MAX_PER_USER <= in_flight[owner_id]:
+        return False
+
+    is_queued = owner_id in queued and instance.job_queued_at is not None \
+        and instance.job_queued_at >= timezone.now() - timedelta(
+            seconds=FHIR_JOB_QUEUE_TIMEOUT)
+    # an owner's jobs run in the order they were queued
+    if is_queued and instance.job_queued_at > queued[owner_id][1]:
+        return False
+
+    if FHIR_JOBS_MAX_GLOBAL > 0:
+        free = FHIR_JOBS_MAX_GLOBAL - sum(in_flight.values())
+        if free <= 0:
+            return False
+        if is_queued \
+                and owner_id not in get_fair_queue(in_flight, queued)[:free]:
+            return False
+    return True
+
+
+def acquire_job_slot(instance) -> bool:
+    """
+    Caps the FHIR jobs in flight at once to FHIR_JOBS_MAX_PER_USER for an
+    owner and FHIR_JOBS_MAX_GLOBAL for everyone, so that a user sending
+    many requests does not take all the capacity of FHIR.
+    Called by the task of the dated measure or cohort before submitting its
+    job: if a slot is free and its turn has come, the instance is started
+    and leaves the queue, else it stays pending and its task tries again
+    later. The queue is fair: the owners with the fewest jobs in flight get
+    the free slots first, each owner's jobs running in the order they were
+    queued by enqueue_job.
+    The slots are counted from the rows, under a postgres advisory lock. A
+    task whose job could not run with the counts shared by get_job_counts
+    does not take the lock.
+    Returns whether the job can be submitted
+    """
+    if FHIR_JOBS_MAX_PER_USER <= 0 and FHIR_JOBS_MAX_GLOBAL <= 0:
+        return True
+    if not can_run(instance, *get_job_counts()):
+        return False
+    with transaction.atomic():
+        with connection.cursor() as c:
+            c.execute("SELECT pg_advisory_xact_lock(hashtext(%s))",
+                      ["fhir-job-limiter"])
+        if not can_run(instance, *get_job_counts(refresh=True)):
+            return False
+        instance.request_job_status = JobStatus.STARTED.name.lower()
+        instance.job_queued_at = None
+        instance.save(update_fields=["request_job_status", "job_queued_at",
+                                     "modified_at"])
+    # the slot taken is counted again by the next task
+    cache.delete(JOB_COUNTS_CACHE_KEY)
+    return True
+
+
+def get_job_limits(owner_id) -> dict:
+    """
+    Limits of the FHIR jobs in flight, with the jobs in flight and queued,
+    of the owner and of everyone
+    """
+    in_flight = get_in_flight_jobs()
+    queued = get_queued_jobs()
+    return dict(
+        max_per_user=FHIR_JOBS_MAX_PER_USER,
+        max_global=FHIR_JOBS_MAX_GLOBAL,
+        in_flight=sum(in_flight.values()),
+        queued=sum(nb for (nb, _) in queued.values()),
+        user_in_flight=in_flight[owner_id],
+        user_queued=queued.get(owner_id, (0, None))[0],
+    )
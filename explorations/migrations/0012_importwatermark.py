@@ -0,0 +1,20 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('explorations', '0011_auto_20211108_1803'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ImportWatermark',
+            fields=[
+                ('source', models.CharField(max_length=30, primary_key=True, serialize=False)),
+                ('watermark', models.DateTimeField(null=True)),
+                ('last_import_at', models.DateTimeField(null=True)),
+                ('last_full_import_at', models.DateTimeField(null=True)),
+            ],
+        ),
+    ]
@@ -0,0 +1,21 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('explorations', '0012_importwatermark'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='datedmeasure',
+            name='query_hash',
+            field=models.CharField(blank=True, db_index=True, default='', max_length=64),
+        ),
+        migrations.AddField(
+            model_name='datedmeasure',
+            name='count_cache_hit',
+            field=models.BooleanField(null=True),
+        ),
+    ]
@@ -0,0 +1,74 @@
+import hashlib
+import json
+
+from django.db import migrations, models
+
+
+# frozen copy of explorations.query_normalization as of this migration
+UNORDERED_LIST_KEYS = ["criteria", "caresiteCohortList"]
+
+
+def canonical_json(value) -> str:
+    return json.dumps(value, sort_keys=True, separators=(",", ":"),
+                      ensure_ascii=False)
+
+
+def is_no_op(value) -> bool:
+    if value is None or value == {} or value == []:
+        return True
+    return isinstance(value, dict) \
+        and str(value.get("_type", "")).lower().endswith("group") \
+        and len(value.get("criteria", [])) == 0
+
+
+def normalize_query(value, key: str = None):
+    if isinstance(value, dict):
+        normalized = dict()
+        for (k, v) in value.items():
+            v = normalize_query(v, k)
+            if not is_no_op(v):
+                normalized[k] = v
+        return normalized
+    if isinstance(value, list):
+        items = [normalize_query(v) for v in value]
+        if key in UNORDERED_LIST_KEYS:
+            items = sorted([v for v in items if not is_no_op(v)],
+                           key=canonical_json)
+        return items
+    return value
+
+
+def get_query_fingerprint(serialized_query: str) -> str:
+    try:
+        canonical = canonical_json(normalize_query(json.loads(serialized_query)))
+    except (TypeError, ValueError):
+        canonical = str(serialized_query)
+    return hashlib.sha256(canonical.encode()).hexdigest()
+
+
+def set_query_fingerprints(apps, schema_editor):
+    RequestQuerySnapshot = apps.get_model('explorations', 'RequestQuerySnapshot')
+    batch = []
+    for rqs in RequestQuerySnapshot.objects.only('uuid', 'serialized_query').iterator(chunk_size=1000):
+        rqs.query_fingerprint = get_query_fingerprint(str(rqs.serialized_query))
+        batch.append(rqs)
+        if len(batch) >= 1000:
+            RequestQuerySnapshot.objects.bulk_update(batch, ['query_fingerprint'])
+            batch = []
+    RequestQuerySnapshot.objects.bulk_update(batch, ['query_fingerprint'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('explorations', '0013_datedmeasure_count_cache'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='requestquerysnapshot',
+            name='query_fingerprint',
+            field=models.CharField(blank=True, db_index=True, default='', max_length=64),
+        ),
+        migrations.RunPython(set_query_fingerprints, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,17 @@
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('explorations', '0014_requestquerysnapshot_query_fingerprint'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='datedmeasure',
+            name='count_leader',
+            field=models.ForeignKey(null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='count_followers', to='explorations.DatedMeasure'),
+        ),
+    ]
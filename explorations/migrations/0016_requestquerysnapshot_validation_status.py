@@ -0,0 +1,21 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('explorations', '0015_datedmeasure_count_leader'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='requestquerysnapshot',
+            name='validation_status',
+            field=models.CharField(choices=[('pending', 'pending'), ('valid', 'valid'), ('invalid', 'invalid')], default='valid', max_length=10),
+        ),
+        migrations.AddField(
+            model_name='requestquerysnapshot',
+            name='validation_fail_msg',
+            field=models.TextField(blank=True, default=''),
+        ),
+    ]
@@ -0,0 +1,48 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('explorations', '0016_requestquerysnapshot_validation_status'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='cohortresult',
+            name='result_size',
+            field=models.BigIntegerField(null=True),
+        ),
+        migrations.AddField(
+            model_name='cohortresult',
+            name='fhir_datetime',
+            field=models.DateTimeField(null=True),
+        ),
+        migrations.RunSQL(
+            "UPDATE explorations_cohortresult cr "
+            "SET result_size=dm.measure, fhir_datetime=dm.fhir_datetime "
+            "FROM explorations_datedmeasure dm "
+            "WHERE dm.uuid=cr.dated_measure_id;",
+            reverse_sql=""
+        ),
+        migrations.AddIndex(
+            model_name='cohortresult',
+            index=models.Index(fields=['owner', 'created_at'], name='cohort_owner_created_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='cohortresult',
+            index=models.Index(fields=['owner', 'type'], name='cohort_owner_type_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='cohortresult',
+            index=models.Index(fields=['owner', 'request_job_status'], name='cohort_owner_status_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='cohortresult',
+            index=models.Index(fields=['owner', 'result_size'], name='cohort_owner_size_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='cohortresult',
+            index=models.Index(fields=['owner', 'fhir_datetime'], name='cohort_owner_fhir_dt_idx'),
+        ),
+    ]
@@ -0,0 +1,34 @@
+import django.contrib.postgres.fields
+import django.contrib.postgres.indexes
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('explorations', '0017_cohortresult_result_size'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='cohortresult',
+            name='perimeters_ids',
+            field=django.contrib.postgres.fields.ArrayField(base_field=models.CharField(max_length=15), blank=True, null=True, size=None),
+        ),
+        migrations.RunSQL(
+            "UPDATE explorations_cohortresult cr "
+            "SET perimeters_ids=rqs.perimeters_ids "
+            "FROM explorations_requestquerysnapshot rqs "
+            "WHERE rqs.uuid=cr.request_query_snapshot_id "
+            "AND rqs.perimeters_ids IS NOT NULL;",
+            reverse_sql=""
+        ),
+        migrations.AddIndex(
+            model_name='requestquerysnapshot',
+            index=django.contrib.postgres.indexes.GinIndex(fields=['perimeters_ids'], name='rqs_perimeters_gin_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='cohortresult',
+            index=django.contrib.postgres.indexes.GinIndex(fields=['perimeters_ids'], name='cohort_perimeters_gin_idx'),
+        ),
+    ]
@@ -0,0 +1,21 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('explorations', '0018_perimeters_ids_gin'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='datedmeasure',
+            name='job_queued_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='cohortresult',
+            name='job_queued_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+    ]
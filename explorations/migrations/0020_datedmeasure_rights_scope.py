@@ -0,0 +1,16 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('explorations', '0019_job_queued_at'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='datedmeasure',
+            name='rights_scope',
+            field=models.CharField(blank=True, default='', max_length=64),
+        ),
+    ]
@@ -0,0 +1,16 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('explorations', '0020_datedmeasure_rights_scope'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='datedmeasure',
+            name='count_finished_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+    ]
@@ -0,0 +1,19 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('explorations', '0021_datedmeasure_count_finished_at'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='datedmeasure',
+            index=models.Index(condition=models.Q(request_job_status__in=['pending', 'started', 'running']), fields=['owner'], name='dm_in_flight_owner_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='cohortresult',
+            index=models.Index(condition=models.Q(request_job_status__in=['pending', 'started', 'running']), fields=['owner'], name='cohort_in_flight_owner_idx'),
+        ),
+    ]
@@ -0,0 +1,89 @@
+import hashlib
+import json
+
+from django.db import migrations
+
+
+# frozen copy of explorations.query_normalization as of this migration:
+# only the criteria of commutative groups are sorted
+COMMUTATIVE_GROUP_TYPES = ["andGroup", "orGroup", "nAmongM"]
+UNORDERED_LIST_KEYS = ["caresiteCohortList"]
+
+
+def canonical_json(value) -> str:
+    return json.dumps(value, sort_keys=True, separators=(",", ":"),
+                      ensure_ascii=False)
+
+
+def is_no_op(value) -> bool:
+    if value is None or value == {} or value == []:
+        return True
+    return isinstance(value, dict) \
+        and str(value.get("_type", "")).lower().endswith("group") \
+        and len(value.get("criteria", [])) == 0
+
+
+def is_unordered(key: str, parent: dict) -> bool:
+    return key in UNORDERED_LIST_KEYS or key == "criteria" \
+        and parent.get("_type", None) in COMMUTATIVE_GROUP_TYPES
+
+
+def normalize_query(value, unordered: bool = False):
+    if isinstance(value, dict):
+        normalized = dict()
+        for (k, v) in value.items():
+            v = normalize_query(v, is_unordered(k, value))
+            if not is_no_op(v):
+                normalized[k] = v
+        return normalized
+    if isinstance(value, list):
+        items = [normalize_query(v) for v in value]
+        if unordered:
+            items = sorted([v for v in items if not is_no_op(v)],
+                           key=canonical_json)
+        return items
+    return value
+
+
+def get_query_fingerprint(serialized_query: str) -> str:
+    try:
+        canonical = canonical_json(normalize_query(json.loads(serialized_query)))
+    except (TypeError, ValueError):
+        canonical = str(serialized_query)
+    return hashlib.sha256(canonical.encode()).hexdigest()
+
+
+def set_query_fingerprints(apps, schema_editor):
+    RequestQuerySnapshot = apps.get_model('explorations', 'RequestQuerySnapshot')
+    batch = []
+    for rqs in RequestQuerySnapshot.objects.only('uuid', 'serialized_query', 'query_fingerprint')\
+            .iterator(chunk_size=1000):
+        fingerprint = get_query_fingerprint(str(rqs.serialized_query))
+        if fingerprint == rqs.query_fingerprint:
+            continue
+        rqs.query_fingerprint = fingerprint
+        batch.append(rqs)
+        if len(batch) >= 1000:
+            RequestQuerySnapshot.objects.bulk_update(batch, ['query_fingerprint'])
+            batch = []
+    RequestQuerySnapshot.objects.bulk_update(batch, ['query_fingerprint'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('explorations', '0022_in_flight_owner_idx'),
+    ]
+
+    operations = [
+        migrations.RunPython(set_query_fingerprints, migrations.RunPython.noop),
+        # the count cache keys measures by the fingerprint of their snapshot
+        migrations.RunSQL(
+            "UPDATE explorations_datedmeasure dm "
+            "SET query_hash=rqs.query_fingerprint "
+            "FROM explorations_requestquerysnapshot rqs "
+            "WHERE rqs.uuid=dm.request_query_snapshot_id "
+            "AND dm.query_hash<>'' AND dm.query_hash<>rqs.query_fingerprint;",
+            reverse_sql=""
+        ),
+    ]
@@ -3,13 +3,17 @@ import json
 from datetime import date
 from django.apps import apps
 from django.contrib.postgres.fields import ArrayField
+from django.contrib.postgres.indexes import GinIndex
 
 from cohort.models import User
 from django.db import models
+from django.db.models import OuterRef, Subquery, Q
 
 from cohort_back.FhirAPi import JobStatus
 from cohort_back.models import BaseModel
 from cohort_back.conf_cohort_job_api import format_json_request
+from cohort_back.settings import SUPERSEDE_STALE_COUNTS
+from explorations.query_normalization import get_query_fingerprint
 
 
 COHORT_TYPE_CHOICES = [
@@ -37,6 +41,28 @@ DATED_MEASURE_MODE_CHOICES = [
     (GLOBAL_DM_MODE, GLOBAL_DM_MODE)
 ]
 
+PENDING_VALIDATION = "pending"
+VALID_VALIDATION = "valid"
+INVALID_VALIDATION = "invalid"
+VALIDATION_STATUS_CHOICES = [
+    (PENDING_VALIDATION, PENDING_VALIDATION),
+    (VALID_VALIDATION, VALID_VALIDATION),
+    (INVALID_VALIDATION, INVALID_VALIDATION)
+]
+
+# statuses of a job that is not over
+IN_FLIGHT_JOB_STATUSES = [
+    s.name.lower() for s in [JobStatus.PENDING, JobStatus.STARTED,
+                             JobStatus.RUNNING]
+]
+# fields of a dated measure given by its count job, with the time it
+# finished
+DATED_MEASURE_RESULT_FIELDS = [
+    "measure", "measure_male", "measure_unknown", "measure_deceased",
+    "measure_alive", "measure_female", "measure_min", "measure_max",
+    "fhir_datetime", "count_finished_at"
+]
+
 
 class Folder(BaseModel):
     owner = models.ForeignKey(
@@ -91,6 +117,23 @@ class RequestQuerySnapshot(BaseModel):
     is_active_branch = models.BooleanField(default=True)
     saved = models.BooleanField(default=False)
     perimeters_ids = ArrayField(models.CharField(max_length=15), null=True, blank=True)
+    # equivalent queries have the same fingerprint, see
+    # explorations.query_normalization
+    query_fingerprint = models.CharField(
+        max_length=64, blank=True, default="", db_index=True
+    )
+    # whether FHIR accepts the formatted query, pending while it is being
+    # validated by explorations.tasks.validate_snapshot_task
+    validation_status = models.CharField(
+        max_length=10, choices=VALIDATION_STATUS_CHOICES,
+        default=VALID_VALIDATION
+    )
+    validation_fail_msg = models.TextField(blank=True, default="")
+
+    class Meta:
+        indexes = [
+            GinIndex(fields=["perimeters_ids"], name="rqs_perimeters_gin_idx"),
+        ]
 
     @property
     def active_next_snapshot(self):
@@ -109,6 +152,9 @@ class RequestQuerySnapshot(BaseModel):
             json.loads(str(self.serialized_query))
         except json.decoder.JSONDecodeError as e:
             raise ValueError(f"serialized_query is not a valid JSON {e}")
+        self.query_fingerprint = get_query_fingerprint(
+            str(self.serialized_query)
+        )
         super(RequestQuerySnapshot, self).save(*args, **kwargs)
 
     def save_snapshot(self):
@@ -134,15 +180,13 @@ class RequestQuerySnapshot(BaseModel):
     def generate_measure(self, auth_headers):
         dm = self.create_empty_dated_measure()
 
-        # import explorations.tasks as tasks
-        # task = tasks.get_count_task.delay(auth_headers, format_json_request(str(self.serialized_query)), dm.uuid)
-        from explorations.tasks import get_count_task
-        task = get_count_task.delay(
-            auth_headers, format_json_request(str(self.serialized_query)),
-            dm.uuid
-        )
-        dm.count_task_id = task.id
-        dm.save()
+        formatted_query = format_json_request(str(self.serialized_query))
+        from explorations.count_cache import fill_from_count_cache
+        from explorations.tasks import enqueue_job, get_count_task, supersede_counts
+        if not fill_from_count_cache(dm):
+            enqueue_job(dm, get_count_task, auth_headers, formatted_query, dm.uuid)
+        if SUPERSEDE_STALE_COUNTS:
+            supersede_counts(dm, auth_headers)
 
         return dm
 
@@ -170,12 +214,10 @@ class RequestQuerySnapshot(BaseModel):
         )
         cr.save()
 
-        # import explorations.tasks as tasks
-        # task = tasks.create_cohort_task.delay(auth_headers, format_json_request(str(self.serialized_query)), cr.uuid)
-        from explorations.tasks import create_cohort_task
-        task = create_cohort_task.delay(auth_headers, format_json_request(str(self.serialized_query)), cr.uuid)
-        cr.create_task_id = task.id
-        cr.save()
+        from explorations.tasks import enqueue_job, create_cohort_task
+        enqueue_job(
+            cr, create_cohort_task, auth_headers, format_json_request(str(self.serialized_query)), cr.uuid
+        )
 
         return cr
 
@@ -219,6 +261,39 @@ class DatedMeasure(BaseModel):
         default=SNAPSHOT_DM_MODE, null=True
     )
 
+    # fingerprint of the query of its snapshot, see
+    # explorations.count_cache
+    query_hash = models.CharField(
+        max_length=64, blank=True, default="", db_index=True
+    )
+    # rights its count depends on, see
+    # explorations.count_cache.get_rights_scope
+    rights_scope = models.CharField(max_length=64, blank=True, default="")
+    # when the count job giving its result finished, see
+    # explorations.count_cache.fill_from_count_cache
+    count_finished_at = models.DateTimeField(null=True, blank=True)
+    # whether the count was taken from a previous measure, None if the
+    # cache was not looked up
+    count_cache_hit = models.BooleanField(null=True)
+    # measure whose count job gives this one its result, see
+    # explorations.count_cache.elect_count_leader
+    count_leader = models.ForeignKey(
+        "DatedMeasure", related_name="count_followers", null=True,
+        on_delete=models.SET_NULL
+    )
+    # when its count job was queued, cleared once the job limiter lets it
+    # run, see explorations.job_limiter
+    job_queued_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        indexes = [
+            # jobs counted by explorations.job_limiter
+            models.Index(
+                fields=["owner"], name="dm_in_flight_owner_idx",
+                condition=Q(request_job_status__in=IN_FLIGHT_JOB_STATUSES)
+            ),
+        ]
+
 
 class CohortResult(BaseModel):
     owner = models.ForeignKey(
@@ -247,6 +322,9 @@ class CohortResult(BaseModel):
     )
 
     create_task_id = models.TextField(blank=True)
+    # when its creation job was queued, cleared once the job limiter lets it
+    # run, see explorations.job_limiter
+    job_queued_at = models.DateTimeField(null=True, blank=True)
     request_job_id = models.TextField(blank=True)
     request_job_status = models.CharField(
         max_length=10,
@@ -263,10 +341,71 @@ class CohortResult(BaseModel):
         default=MY_COHORTS_COHORT_TYPE
     )
 
+    # copies of dated_measure's measure and fhir_datetime, to filter and
+    # sort cohorts without joining their dated measure, kept up to date by
+    # sync_cohort_results
+    result_size = models.BigIntegerField(null=True)
+    fhir_datetime = models.DateTimeField(null=True)
+    # copy of request_query_snapshot's perimeters_ids, that does not change
+    perimeters_ids = ArrayField(
+        models.CharField(max_length=15), null=True, blank=True
+    )
+
     class Meta:
         unique_together = []
+        indexes = [
+            models.Index(fields=["owner", "created_at"],
+                         name="cohort_owner_created_idx"),
+            models.Index(fields=["owner", "type"],
+                         name="cohort_owner_type_idx"),
+            models.Index(fields=["owner", "request_job_status"],
+                         name="cohort_owner_status_idx"),
+            models.Index(fields=["owner", "result_size"],
+                         name="cohort_owner_size_idx"),
+            models.Index(fields=["owner", "fhir_datetime"],
+                         name="cohort_owner_fhir_dt_idx"),
+            GinIndex(fields=["perimeters_ids"],
+                     name="cohort_perimeters_gin_idx"),
+            # jobs counted by explorations.job_limiter
+            models.Index(
+                fields=["owner"], name="cohort_in_flight_owner_idx",
+                condition=Q(request_job_status__in=IN_FLIGHT_JOB_STATUSES)
+            ),
+        ]
+
+    def set_result(self, dm: DatedMeasure):
+        self.result_size = dm.measure
+        self.fhir_datetime = dm.fhir_datetime
 
-    @property
-    def result_size(self):
-        return self.dated_measure.measure
+    def save(self, *args, **kwargs):
+        if self._state.adding and self.dated_measure_id is not None:
+            self.set_result(self.dated_measure)
+        if self._state.adding and self.request_query_snapshot_id is not None:
+            self.perimeters_ids = self.request_query_snapshot.perimeters_ids
+        super(CohortResult, self).save(*args, **kwargs)
 
+
+def sync_cohort_results(dms) -> int:
+    """
+    Copies the measure and fhir_datetime of the dated measures, given as a
+    queryset or a list of uuids, onto the cohorts they measure, in a single
+    UPDATE
+    Returns the number of cohorts updated
+    """
+    dm = DatedMeasure.objects.filter(uuid=OuterRef("dated_measure_id"))
+    return CohortResult.objects.filter(dated_measure__in=dms).update(
+        result_size=Subquery(dm.values("measure")[:1]),
+        fhir_datetime=Subquery(dm.values("fhir_datetime")[:1])
+    )
+
+
+class ImportWatermark(models.Model):
+    """
+    Progress of the incremental import of a source of OMOP cohorts: the
+    last change read from it, and when it was last imported, and last fully
+    reconciled
+    """
+    source = models.CharField(max_length=30, primary_key=True)
+    watermark = models.DateTimeField(null=True)
+    last_import_at = models.DateTimeField(null=True)
+    last_full_import_at = models.DateTimeField(null=True)
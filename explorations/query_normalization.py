@@ -0,0 +1,65 @@
+import hashlib
+import json
+
+# groups whose criteria can be given in any order, unlike the ones whose
+# criteria are ordered (sequences, temporal constraints...)
+COMMUTATIVE_GROUP_TYPES = ["andGroup", "orGroup", "nAmongM"]
+# lists whose order never changes the meaning of the query: the perimeters
+# of the source population
+UNORDERED_LIST_KEYS = ["caresiteCohortList"]
+
+
+def canonical_json(value) -> str:
+    return json.dumps(value, sort_keys=True, separators=(",", ":"),
+                      ensure_ascii=False)
+
+
+def is_no_op(value) -> bool:
+    """
+    Null values, empty objects and lists, and groups without criteria do not
+    change what a query selects
+    """
+    if value is None or value == {} or value == []:
+        return True
+    return isinstance(value, dict) \
+        and str(value.get("_type", "")).lower().endswith("group") \
+        and len(value.get("criteria", [])) == 0
+
+
+def is_unordered(key: str, parent: dict) -> bool:
+    return key in UNORDERED_LIST_KEYS or key == "criteria" \
+        and parent.get("_type", None) in COMMUTATIVE_GROUP_TYPES
+
+
+def normalize_query(value, unordered: bool = False):
+    """
+    Returns the query with its no-op nodes removed and its unordered lists
+    (see is_unordered) sorted, recursively, so that equivalent queries are
+    equal once dumped with sorted keys
+    """
+    if isinstance(value, dict):
+        normalized = dict()
+        for (k, v) in value.items():
+            v = normalize_query(v, is_unordered(k, value))
+            if not is_no_op(v):
+                normalized[k] = v
+        return normalized
+    if isinstance(value, list):
+        items = [normalize_query(v) for v in value]
+        if unordered:
+            items = sorted([v for v in items if not is_no_op(v)],
+                           key=canonical_json)
+        return items
+    return value
+
+
+def get_query_fingerprint(serialized_query: str) -> str:
+    """
+    Hash of the normalized query: equivalent serialized queries have the
+    same fingerprint
+    """
+    try:
+        canonical = canonical_json(normalize_query(json.loads(serialized_query)))
+    except (TypeError, ValueError):
+        canonical = str(serialized_query)
+    return hashlib.sha256(canonical.encode()).hexdigest()
@@ -1,5 +1,6 @@
 # from __future__ import annotations
 import json
+import time
 
 from rest_framework import serializers
 from cohort.models import User
@@ -7,8 +8,14 @@ from cohort.serializers import BaseSerializer, UserSerializer
 import cohort_back.conf_cohort_job_api as fhir_api
 from cohort_back.FhirAPi import JobStatus
 from cohort_back.conf_cohort_job_api import get_fhir_authorization_header, format_json_request, retrieve_perimeters
+from cohort_back.settings import ASYNC_SNAPSHOT_VALIDATION, \
+    GLOBAL_ESTIMATE_QUEUE, SUPERSEDE_STALE_COUNTS, TASK_MIN_PRIORITY, \
+    TASK_MAX_PRIORITY
+from explorations.count_cache import fill_from_count_cache
+from explorations.validation_cache import validation_cache
 from explorations.models import Request, CohortResult, RequestQuerySnapshot, \
-    DatedMeasure, Folder, GLOBAL_DM_MODE
+    DatedMeasure, Folder, GLOBAL_DM_MODE, PENDING_VALIDATION, \
+    sync_cohort_results
 
 
 class PrimaryKeyRelatedFieldWithOwner(serializers.PrimaryKeyRelatedField):
@@ -33,10 +40,19 @@ class UserPrimaryKeyRelatedField(serializers.PrimaryKeyRelatedField):
         return qs.filter(uuid=user.uuid)
 
 
+def priority_field():
+    # priority of the task sent on creation, 0 being run first
+    return serializers.IntegerField(
+        write_only=True, required=False, allow_null=True,
+        min_value=TASK_MIN_PRIORITY, max_value=TASK_MAX_PRIORITY
+    )
+
+
 class DatedMeasureSerializer(BaseSerializer):
     request = PrimaryKeyRelatedFieldWithOwner(
         queryset=Request.objects.all(), required=False
     )
+    priority = priority_field()
 
     class Meta:
         model = DatedMeasure
@@ -48,7 +64,13 @@ class DatedMeasureSerializer(BaseSerializer):
             "request_job_status",
             "request_job_fail_msg",
             "request_job_duration",
-            "mode"
+            "mode",
+            "query_hash",
+            "rights_scope",
+            "count_cache_hit",
+            "count_finished_at",
+            "count_leader",
+            "job_queued_at"
         ]
 
     def update(self, instance, validated_data):
@@ -57,9 +79,12 @@ class DatedMeasureSerializer(BaseSerializer):
                 raise serializers.ValidationError(
                     f'{f} field cannot bu updated manually'
                 )
-        return super(DatedMeasureSerializer, self).update(
+        dm = super(DatedMeasureSerializer, self).update(
             instance, validated_data
         )
+        if "measure" in validated_data or "fhir_datetime" in validated_data:
+            sync_cohort_results([dm.uuid])
+        return dm
 
     def partial_update(self, instance, validated_data):
         for f in ['owner', 'request', 'request_query_snapshot']:
@@ -76,6 +101,7 @@ class DatedMeasureSerializer(BaseSerializer):
         req = validated_data.get("request", None)
         measure = validated_data.get("measure", None)
         fhir_datetime = validated_data.get("fhir_datetime", None)
+        priority = validated_data.pop("priority", None)
 
         if rqs is None:
             raise serializers.ValidationError(
@@ -104,14 +130,21 @@ class DatedMeasureSerializer(BaseSerializer):
 
         if measure is None:
             try:
-                from explorations.tasks import get_count_task
-                task = get_count_task.delay(
-                    get_fhir_authorization_header(
-                        self.context.get("request", None)
-                    ),
-                    format_json_request(str(rqs.serialized_query)),
-                    res_dm.uuid
+                formatted_query = format_json_request(
+                    str(rqs.serialized_query)
                 )
+                auth_headers = get_fhir_authorization_header(
+                    self.context.get("request", None)
+                )
+                from explorations.tasks import enqueue_job, get_count_task, \
+                    supersede_counts
+                if not fill_from_count_cache(res_dm):
+                    enqueue_job(
+                        res_dm, get_count_task, auth_headers, formatted_query,
+                        res_dm.uuid, priority=priority
+                    )
+                if self.context.get("supersede", SUPERSEDE_STALE_COUNTS):
+                    supersede_counts(res_dm, auth_headers)
             except Exception as e:
                 res_dm.delete()
                 raise serializers.ValidationError(
@@ -136,6 +169,7 @@ class CohortResultSerializer(BaseSerializer):
     )
 
     global_estimate = serializers.BooleanField(write_only=True)
+    priority = priority_field()
 
     fhir_group_id = serializers.CharField(
         allow_blank=True, allow_null=True, required=False
@@ -148,10 +182,13 @@ class CohortResultSerializer(BaseSerializer):
         # write_only_fields = ["dated_measure_id"]
         read_only_fields = [
             "create_task_id",
+            "job_queued_at",
             "request_job_id",
             "request_job_status",
             "request_job_fail_msg",
             "request_job_duration",
+            "fhir_datetime",
+            "perimeters_ids",
 
             # "request_query_snapshot",
             # "request"
@@ -180,6 +217,7 @@ class CohortResultSerializer(BaseSerializer):
         rqs = validated_data.get("request_query_snapshot", None)
         req = validated_data.get("request", None)
         global_estimate = validated_data.pop("global_estimate", None)
+        priority = validated_data.pop("priority", None)
 
         if rqs is None:
             raise serializers.ValidationError(
@@ -233,14 +271,20 @@ class CohortResultSerializer(BaseSerializer):
 
         if global_estimate:
             try:
-                from explorations.tasks import get_count_task
-                get_count_task.delay(
-                    get_fhir_authorization_header(
-                        self.context.get("request", None)
-                    ),
-                    format_json_request(str(rqs.serialized_query)),
-                    res_dm_global.uuid
+                formatted_query = format_json_request(
+                    str(rqs.serialized_query)
                 )
+                if not fill_from_count_cache(res_dm_global):
+                    from explorations.tasks import enqueue_job, get_count_task
+                    enqueue_job(
+                        res_dm_global, get_count_task,
+                        get_fhir_authorization_header(
+                            self.context.get("request", None)
+                        ),
+                        formatted_query,
+                        res_dm_global.uuid,
+                        queue=GLOBAL_ESTIMATE_QUEUE, priority=priority
+                    )
             except Exception as e:
                 result_cr.dated_measure_global.request_job_fail_msg \
                     = f"INTERNAL ERROR: Could not launch FHIR cohort count: {e}"
@@ -252,13 +296,15 @@ class CohortResultSerializer(BaseSerializer):
         # task to complete it, if fhir_group_id was not already provided
         if validated_data.get("fhir_group_id", None) is None:
             try:
-                from explorations.tasks import create_cohort_task
-                create_cohort_task.delay(
+                from explorations.tasks import enqueue_job, create_cohort_task
+                enqueue_job(
+                    result_cr, create_cohort_task,
                     get_fhir_authorization_header(
                         self.context.get("request", None)
                     ),
                     format_json_request(str(rqs.serialized_query)),
-                    result_cr.uuid
+                    result_cr.uuid,
+                    priority=priority
                 )
 
             except Exception as e:
@@ -302,6 +348,8 @@ class RequestQuerySnapshotSerializer(BaseSerializer):
         optional_fields = ["previous_snapshot", "request"]
         # exclude = ["request", "owner"]
         read_only_fields = ["is_active_branch", "care_sites_ids",
+                            "query_fingerprint", "validation_status",
+                            "validation_fail_msg",
                             # "request", "owner",
                             "dated_measures", "cohort_results"
                             ]
@@ -336,18 +384,33 @@ class RequestQuerySnapshotSerializer(BaseSerializer):
         except json.JSONDecodeError as e:
             raise serializers.ValidationError(f"Serialized_query could not be recognized as json: {e.msg}")
 
-        # post_validate_cohort is called this way so that fhir_api can be mocked in tests
-        validate_resp = fhir_api.post_validate_cohort(
-            format_json_request(serialized_query),
-            get_fhir_authorization_header(self.context.get("request"))
-        )
-        if not validate_resp.success:
-            raise serializers.ValidationError(f"Serialized_query, after formatting, "
-                                              f"is not accepted by FHIR server: {validate_resp.err_msg}")
+        formatted_query = format_json_request(serialized_query)
+        owner_id = self.context.get("request").user.pk
+        validated = validation_cache.get(owner_id, formatted_query)
+        # the query is then validated by validate_snapshot_task, once the snapshot is saved
+        validate_later = not validated and ASYNC_SNAPSHOT_VALIDATION
+        if validate_later:
+            validated_data["validation_status"] = PENDING_VALIDATION
+        elif not validated:
+            start = time.monotonic()
+            # post_validate_cohort is called this way so that fhir_api can be mocked in tests
+            validate_resp = fhir_api.post_validate_cohort(
+                formatted_query,
+                get_fhir_authorization_header(self.context.get("request"))
+            )
+            if not validate_resp.success:
+                raise serializers.ValidationError(f"Serialized_query, after formatting, "
+                                                  f"is not accepted by FHIR server: {validate_resp.err_msg}")
+            validation_cache.set(owner_id, formatted_query, time.monotonic() - start)
 
         validated_data["perimeters_ids"] = retrieve_perimeters(serialized_query)
 
-        return super(RequestQuerySnapshotSerializer, self).create(validated_data=validated_data)
+        rqs = super(RequestQuerySnapshotSerializer, self).create(validated_data=validated_data)
+        if validate_later:
+            from explorations.tasks import enqueue, validate_snapshot_task
+            enqueue(validate_snapshot_task, get_fhir_authorization_header(self.context.get("request")),
+                    formatted_query, rqs.uuid)
+        return rqs
 
     def update(self, instance, validated_data):
         for f in ['owner', 'request', 'owner_id', 'request_id']:
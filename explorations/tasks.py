@@ -1,20 +1,609 @@
-from time import sleep
+import random
+import time
+import zlib
+from datetime import timedelta
+from concurrent.futures import ThreadPoolExecutor
 
 from celery import shared_task, current_task
+from celery.utils import uuid
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import Q
+from django.utils import timezone
 
 import cohort_back.conf_cohort_job_api as fhir_api
-from cohort_back.FhirAPi import JobStatus
-from explorations.models import CohortResult, DatedMeasure, GLOBAL_DM_MODE
+from cohort_back import app
+from cohort_back.FhirAPi import JobStatus, FhirCountResponse, \
+    FhirCohortResponse
+from cohort_back.settings import FHIR_JOB_POLL_MIN_INTERVAL, \
+    FHIR_JOB_POLL_MAX_INTERVAL, FHIR_JOB_POLL_RATE, \
+    FHIR_JOB_STATUS_BATCH_SIZE, FHIR_JOB_STATUS_CONCURRENCY, \
+    SINGLE_FLIGHT_RETRY_DELAY, SINGLE_FLIGHT_MAX_RETRY_DELAY, \
+    SNAPSHOT_VALIDATION_RETRY_DELAY, SNAPSHOT_VALIDATION_TIMEOUT, \
+    FHIR_JOB_LIMITER_RETRY_DELAY, FHIR_JOB_LIMITER_MAX_RETRY_DELAY, \
+    TASK_MIN_PRIORITY
+from explorations.count_cache import elect_count_leader, fill_followers
+from explorations.job_limiter import acquire_job_slot
+from explorations.models import CohortResult, DatedMeasure, GLOBAL_DM_MODE, \
+    RequestQuerySnapshot, sync_cohort_results, PENDING_VALIDATION, VALID_VALIDATION, \
+    INVALID_VALIDATION, IN_FLIGHT_JOB_STATUSES, DATED_MEASURE_RESULT_FIELDS
+from explorations.validation_cache import validation_cache
 
+JOB_FIELDS = ["request_job_id", "request_job_status", "request_job_fail_msg",
+              "request_job_duration", "modified_at"]
+COHORT_RESULT_FIELDS = ["fhir_group_id", "result_size", "fhir_datetime"]
 
-def update_instance_failed(
+
+def get_task_id_field(instance) -> str:
+    return "create_task_id" if isinstance(instance, CohortResult) \
+        else "count_task_id"
+
+
+def save_job_state(instance, fields: [str] = ()):
+    """
+    Writes the job fields of the dated measure or cohort, with the given
+    ones, as a single UPDATE of these columns only
+    """
+    instance.save(update_fields=JOB_FIELDS + [get_task_id_field(instance)]
+                  + list(fields))
+
+
+def set_instance_failed(
         instance, msg, job_duration, fhir_job_id, job_status: JobStatus
 ):
     instance.request_job_status = job_status.name.lower()
     instance.request_job_fail_msg = msg
     instance.request_job_duration = job_duration
     instance.request_job_id = fhir_job_id
-    instance.save()
+
+
+def update_instance_failed(
+        instance, msg, job_duration, fhir_job_id, job_status: JobStatus
+):
+    set_instance_failed(instance, msg, job_duration, fhir_job_id, job_status)
+    save_job_state(instance)
+
+
+def set_count_result(
+        dm: DatedMeasure, resp: FhirCountResponse, finished: bool
+):
+    """
+    Sets the status of the count job of the dated measure, and its result
+    once finished
+    """
+    if not resp.success:
+        set_instance_failed(
+            dm, resp.err_msg, resp.job_duration, resp.fhir_job_id,
+            resp.fhir_job_status
+        )
+        return
+
+    if finished:
+        if dm.mode != GLOBAL_DM_MODE:
+            dm.measure = resp.count
+            dm.measure_male = resp.count_male
+            dm.measure_unknown = resp.count_unknown
+            dm.measure_deceased = resp.count_deceased
+            dm.measure_alive = resp.count_alive
+            dm.measure_female = resp.count_female
+        else:
+            dm.measure_min = resp.count_min
+            dm.measure_max = resp.count_max
+        dm.fhir_datetime = resp.fhir_datetime
+        dm.count_finished_at = timezone.now()
+        dm.request_job_duration = resp.job_duration
+
+    dm.request_job_status = resp.fhir_job_status.name.lower()
+    dm.request_job_id = resp.fhir_job_id
+
+
+def update_dated_measure(
+        dm: DatedMeasure, resp: FhirCountResponse, finished: bool
+):
+    set_count_result(dm, resp, finished)
+    if resp.success and finished:
+        save_job_state(dm, DATED_MEASURE_RESULT_FIELDS)
+        sync_cohort_results([dm.uuid])
+    else:
+        save_job_state(dm)
+    fill_followers(dm)
+
+
+def set_cohort_result(
+        cr: CohortResult, resp: FhirCohortResponse, finished: bool
+):
+    """
+    Sets the status of the job creating the cohort, on the cohort and its
+    dated measure, and its result once finished
+    """
+    if not resp.success:
+        for instance in [cr, cr.dated_measure]:
+            set_instance_failed(
+                instance, resp.err_msg, resp.job_duration, resp.fhir_job_id,
+                resp.fhir_job_status
+            )
+        return
+
+    if finished:
+        cr.dated_measure.fhir_datetime = resp.fhir_datetime
+        cr.dated_measure.count_finished_at = timezone.now()
+        cr.dated_measure.measure = resp.count
+        cr.dated_measure.request_job_duration = resp.job_duration
+        cr.set_result(cr.dated_measure)
+        cr.fhir_group_id = getattr(resp, "group_id", "")
+        cr.request_job_duration = resp.job_duration
+
+    for instance in [cr.dated_measure, cr]:
+        instance.request_job_id = resp.fhir_job_id
+        instance.request_job_status = resp.fhir_job_status.name.lower()
+
+
+def update_cohort_result(
+        cr: CohortResult, resp: FhirCohortResponse, finished: bool
+):
+    set_cohort_result(cr, resp, finished)
+    result = resp.success and finished
+    save_job_state(cr.dated_measure,
+                   ["measure", "fhir_datetime", "count_finished_at"]
+                   if result else [])
+    save_job_state(cr, COHORT_RESULT_FIELDS if result else [])
+
+
+def update_job_instances(resp: FhirCountResponse) -> bool:
+    """
+    Records a status received for a job, on the cohort it creates or else
+    on the dated measure it counts
+    Returns False if no instance is bound to the job
+    """
+    finished = resp.fhir_job_status == JobStatus.FINISHED
+    # the dated measure of a cohort shares its job id
+    crs = list(CohortResult.objects.filter(
+        request_job_id=resp.fhir_job_id
+    ).select_related("dated_measure"))
+    for cr in crs:
+        update_cohort_result(cr, resp, finished)
+    if len(crs):
+        return True
+
+    dms = list(DatedMeasure.objects.filter(request_job_id=resp.fhir_job_id))
+    for dm in dms:
+        update_dated_measure(dm, resp, finished)
+    return len(dms) > 0
+
+
+def refresh_cohort_job_status(cr: CohortResult) -> bool:
+    """
+    Gets the status of the job creating the cohort from the job API, if it
+    is in flight, and records it on the cohort and its dated measure
+    Returns False if the status could not be got
+    """
+    if not cr.request_job_id \
+            or cr.request_job_status not in IN_FLIGHT_JOB_STATUSES:
+        return True
+    if not callable(getattr(fhir_api, "get_job_status", None)):
+        return False
+    resp = get_job_status(cr.request_job_id)
+    if resp is None:
+        return False
+    update_cohort_result(cr, resp, resp.fhir_job_status == JobStatus.FINISHED)
+    return True
+
+
+def get_poll_interval(in_flight: int) -> float:
+    """
+    The more jobs are in flight, the less often each one is polled, so that
+    the job API gets at most FHIR_JOB_POLL_RATE status requests per second
+    """
+    return min(
+        max(in_flight / FHIR_JOB_POLL_RATE, FHIR_JOB_POLL_MIN_INTERVAL),
+        FHIR_JOB_POLL_MAX_INTERVAL
+    )
+
+
+def is_job_due(job_id: str, interval: float, now: float) -> bool:
+    # the poller runs every FHIR_JOB_POLL_MIN_INTERVAL: the jobs are spread
+    # over the runs of an interval, each being polled once in it
+    runs = max(1, round(interval / FHIR_JOB_POLL_MIN_INTERVAL))
+    run = int(now / FHIR_JOB_POLL_MIN_INTERVAL)
+    return zlib.crc32(job_id.encode()) % runs == run % runs
+
+
+def get_job_status(job_id: str) -> FhirCountResponse:
+    try:
+        return fhir_api.get_job_status(job_id)
+    except Exception as e:
+        print(f"[JobsStatus] Error while getting status of job {job_id}: "
+              f"{str(e)}")
+        return None
+
+
+def fetch_jobs_status(job_ids: [str]) -> dict:
+    """
+    Gets the status of the jobs from the job API, by batches if it has
+    get_jobs_status, else one by one from a bounded pool of threads if it
+    has get_job_status
+    The jobs whose status could not be got are left out
+    Returns the responses by job id
+    """
+    if callable(getattr(fhir_api, "get_jobs_status", None)):
+        resps = []
+        for i in range(0, len(job_ids), FHIR_JOB_STATUS_BATCH_SIZE):
+            batch = job_ids[i:i + FHIR_JOB_STATUS_BATCH_SIZE]
+            try:
+                resps += fhir_api.get_jobs_status(batch)
+            except Exception as e:
+                print(f"[JobsStatus] Error while getting status of "
+                      f"{len(batch)} jobs: {str(e)}")
+    elif callable(getattr(fhir_api, "get_job_status", None)):
+        with ThreadPoolExecutor(
+                max_workers=FHIR_JOB_STATUS_CONCURRENCY) as executor:
+            resps = list(executor.map(get_job_status, job_ids))
+    else:
+        resps = []
+    return dict((r.fhir_job_id, r) for r in resps if r is not None)
+
+
+def reconcile_jobs_status() -> dict:
+    """
+    Polls the status of the in-flight jobs of cohorts and dated measures,
+    for the callbacks that were lost, and writes the ones that changed with
+    one bulk_update per model
+    """
+    job_ids = set(CohortResult.objects.filter(
+        request_job_status__in=IN_FLIGHT_JOB_STATUSES
+    ).exclude(request_job_id="").values_list("request_job_id", flat=True))
+    job_ids |= set(DatedMeasure.objects.filter(
+        request_job_status__in=IN_FLIGHT_JOB_STATUSES
+    ).exclude(request_job_id="").values_list("request_job_id", flat=True))
+
+    interval = get_poll_interval(len(job_ids))
+    now = time.time()
+    due = [j for j in job_ids if is_job_due(j, interval, now)]
+    statuses = fetch_jobs_status(due) if len(due) else dict()
+
+    def has_changed(instance) -> bool:
+        resp = statuses[instance.request_job_id]
+        return not resp.success \
+            or resp.fhir_job_status.name.lower() != instance.request_job_status
+
+    modified_at = timezone.now()
+    crs, dms = [], []
+    # the dated measure of a cohort shares its job id
+    cr_dm_ids = []
+    for cr in CohortResult.objects.filter(
+            request_job_id__in=statuses.keys(),
+            request_job_status__in=IN_FLIGHT_JOB_STATUSES
+    ).select_related("dated_measure"):
+        cr_dm_ids.append(cr.dated_measure_id)
+        if has_changed(cr):
+            resp = statuses[cr.request_job_id]
+            set_cohort_result(
+                cr, resp, resp.fhir_job_status == JobStatus.FINISHED
+            )
+            cr.modified_at = cr.dated_measure.modified_at = modified_at
+            crs.append(cr)
+            dms.append(cr.dated_measure)
+
+    for dm in DatedMeasure.objects.filter(
+            request_job_id__in=statuses.keys(),
+            request_job_status__in=IN_FLIGHT_JOB_STATUSES
+    ).exclude(uuid__in=cr_dm_ids):
+        if has_changed(dm):
+            resp = statuses[dm.request_job_id]
+            set_count_result(
+                dm, resp, resp.fhir_job_status == JobStatus.FINISHED
+            )
+            dm.modified_at = modified_at
+            dms.append(dm)
+
+    with transaction.atomic():
+        CohortResult.objects.bulk_update(
+            crs, JOB_FIELDS + COHORT_RESULT_FIELDS, batch_size=1000
+        )
+        DatedMeasure.objects.bulk_update(
+            dms, JOB_FIELDS + DATED_MEASURE_RESULT_FIELDS, batch_size=1000
+        )
+        sync_cohort_results([
+            dm.uuid for dm in dms
+            if dm.request_job_status == JobStatus.FINISHED.name.lower()
+        ])
+        for dm in dms:
+            fill_followers(dm)
+    return dict(in_flight=len(job_ids), polled=len(due),
+                updated_cohorts=len(crs), updated_dated_measures=len(dms),
+                interval=interval)
+
+
+def submit_job(submit_name: str, post_name: str, *args, **kwargs) \
+        -> (FhirCountResponse, bool):
+    """
+    Submits a job with the two-phase function of the job API, that returns
+    as soon as the job is created, its result coming later to
+    JobCallbackView
+    Job APIs without it are called with the former function, that blocks
+    until the job is finished
+    An error raised by the job API is returned as a failed response, for the
+    instances to be failed and their job slot released
+    Returns the response and whether the job is finished
+    """
+    try:
+        submit = getattr(fhir_api, submit_name, None)
+        if callable(submit):
+            resp = submit(*args, **kwargs)
+            return resp, resp.fhir_job_status == JobStatus.FINISHED
+        return getattr(fhir_api, post_name)(*args, **kwargs), True
+    except Exception as e:
+        return FhirCountResponse(
+            success=False, err_msg=f"Error while submitting the job: {e}",
+            fhir_job_status=JobStatus.ERROR
+        ), True
+
+
+# tasks counting the rows they were sent for but did not find: tasks being
+# sent once their rows are committed, these are rows deleted in between
+ROW_MISS_TASKS = ["get_count_task", "create_cohort_task",
+                  "validate_snapshot_task", "cancel_superseded_counts_task"]
+
+
+def get_row_miss_key(task_name: str) -> str:
+    return f"row-misses:{task_name}"
+
+
+def record_row_miss(task_name: str, log):
+    """
+    Counts a row the task did not find in the cache shared by the workers,
+    see get_row_misses
+    """
+    key = get_row_miss_key(task_name)
+    cache.add(key, 0, timeout=None)
+    try:
+        misses = cache.incr(key)
+    except ValueError:
+        # evicted between add and incr
+        cache.set(key, 1, timeout=None)
+        misses = 1
+    log(f"Error: could not find the row to update "
+        f"({misses} misses of {task_name})")
+
+
+def get_row_misses() -> dict:
+    """
+    Number of rows each task was sent for but did not find, by task name
+    """
+    keys = dict((get_row_miss_key(t), t) for t in ROW_MISS_TASKS)
+    misses = cache.get_many(keys.keys())
+    return dict((t, misses.get(k, 0)) for (k, t) in keys.items())
+
+
+def enqueue(task, *args, queue: str = None, priority: int = None) -> str:
+    """
+    Sends the task once the transaction in progress, if any, is committed,
+    so that the task finds the rows it is given
+    The queue and priority override the ones of CELERY_TASK_ROUTES and
+    CELERY_TASK_DEFAULT_PRIORITY
+    Returns the id the task is sent with, to be recorded on its rows
+    """
+    task_id = uuid()
+    options = dict(task_id=task_id)
+    if queue is not None:
+        options["queue"] = queue
+    if priority is not None:
+        options["priority"] = priority
+    transaction.on_commit(lambda: task.apply_async(args, **options))
+    return task_id
+
+
+def enqueue_job(instance, task, *args, queue: str = None,
+                priority: int = None):
+    """
+    Enqueues the task of the FHIR job of the dated measure or cohort, and
+    records its id and the time its job joins the queue of
+    explorations.job_limiter
+    """
+    task_id_field = get_task_id_field(instance)
+    setattr(instance, task_id_field,
+            enqueue(task, *args, queue=queue, priority=priority))
+    instance.job_queued_at = timezone.now()
+    instance.save(update_fields=[task_id_field, "job_queued_at",
+                                 "modified_at"])
+
+
+def holds_job_slot(instance) -> bool:
+    """
+    Whether the current task already took the job slot of the instance
+    without submitting its job, being redelivered after its worker was lost
+    """
+    return instance.request_job_status == JobStatus.STARTED.name.lower() \
+        and not instance.request_job_id \
+        and getattr(instance, get_task_id_field(instance)) \
+        == current_task.request.id
+
+
+def wait_for_job_slot(instance, log):
+    """
+    Retries the current task, its job staying pending, until the job
+    limiter gives it a slot
+    """
+    if not acquire_job_slot(instance):
+        log("Waiting for a FHIR job slot")
+        # jittered, so that the waiting tasks do not ask all at once
+        delay = min(
+            FHIR_JOB_LIMITER_RETRY_DELAY * 2 ** current_task.request.retries,
+            FHIR_JOB_LIMITER_MAX_RETRY_DELAY
+        )
+        raise current_task.retry(
+            countdown=random.uniform(delay / 2, delay), max_retries=None
+        )
+
+
+def check_snapshot_validation(instances: list, log) -> bool:
+    """
+    Retries the current task while the snapshot of the instances is being
+    validated, and fails them if FHIR rejected its query, or if it was not
+    validated SNAPSHOT_VALIDATION_TIMEOUT seconds after its creation
+    Returns whether the job of the instances can be submitted
+    """
+    rqs = instances[0].request_query_snapshot
+    if rqs is None or rqs.validation_status == VALID_VALIDATION:
+        return True
+    if rqs.validation_status == PENDING_VALIDATION:
+        if rqs.created_at >= timezone.now() - timedelta(
+                seconds=SNAPSHOT_VALIDATION_TIMEOUT):
+            log(f"Waiting for the validation of snapshot {rqs.uuid}")
+            raise current_task.retry(
+                countdown=SNAPSHOT_VALIDATION_RETRY_DELAY, max_retries=None
+            )
+        msg = f"Snapshot {rqs.uuid} was not validated after " \
+              f"{SNAPSHOT_VALIDATION_TIMEOUT}s"
+    else:
+        msg = f"Serialized_query, after formatting, is not accepted by " \
+              f"FHIR server: {rqs.validation_fail_msg}"
+    for instance in instances:
+        update_instance_failed(instance, msg, None, "", JobStatus.ERROR)
+    log(msg)
+    return False
+
+
+def log_validate_task(id, msg):
+    print(f"[ValidateTask] [RQS uuid: {id}] {msg}")
+
+
+@shared_task
+def validate_snapshot_task(auth_headers: dict, json_file: str, rqs_uuid: str):
+    rqs = RequestQuerySnapshot.objects.filter(uuid=rqs_uuid).first()
+    if rqs is None:
+        record_row_miss("validate_snapshot_task",
+                        lambda m: log_validate_task(rqs_uuid, m))
+        return
+
+    start = time.monotonic()
+    try:
+        resp = fhir_api.post_validate_cohort(json_file, auth_headers)
+        success, err_msg = resp.success, resp.err_msg
+    except Exception as e:
+        success, err_msg = False, f"Error while validating the query: {e}"
+    if success:
+        validation_cache.set(rqs.owner_id, json_file, time.monotonic() - start)
+        rqs.validation_status = VALID_VALIDATION
+    else:
+        rqs.validation_status = INVALID_VALIDATION
+        rqs.validation_fail_msg = err_msg or ""
+    # the user may have updated the snapshot during the validation
+    rqs.save(update_fields=["validation_status", "validation_fail_msg",
+                            "modified_at"])
+    log_validate_task(rqs_uuid, f"Snapshot {rqs.validation_status}")
+
+
+def supersede_counts(dm: DatedMeasure, auth_headers: dict):
+    """
+    Enqueues the cancelling of the counts dm supersedes, see
+    cancel_superseded_counts_task, ahead of the counts waiting in its queue
+    """
+    enqueue(cancel_superseded_counts_task, auth_headers, dm.uuid,
+            priority=TASK_MIN_PRIORITY)
+
+
+def get_superseded_counts(dm: DatedMeasure):
+    """
+    In-flight counts of the request of dm, started before it, of another
+    query: their result would come for a query the user already changed.
+    Counts of cohorts, and the ones other measures follow, are kept.
+    """
+    stale = DatedMeasure.objects.filter(
+        request_id=dm.request_id,
+        request_job_status__in=IN_FLIGHT_JOB_STATUSES,
+        created_at__lt=dm.created_at,
+        cohort__isnull=True, restricted_cohort__isnull=True
+    ).exclude(uuid=dm.uuid).exclude(
+        count_followers__request_job_status__in=IN_FLIGHT_JOB_STATUSES
+    )
+    if dm.query_hash:
+        stale = stale.exclude(query_hash=dm.query_hash)
+    return stale.distinct()
+
+
+def cancel_job(job_id: str, auth_headers: dict) -> str:
+    """
+    Returns the error cancelling the job, None if it was cancelled
+    """
+    try:
+        fhir_api.cancel_job(job_id, auth_headers)
+        return None
+    except Exception as e:
+        return str(e)
+
+
+def log_supersede_task(id, msg):
+    print(f"[SupersedeTask] [DM uuid: {id}] {msg}")
+
+
+@shared_task
+def cancel_superseded_counts_task(auth_headers: dict, dm_uuid: str) -> dict:
+    """
+    Cancels the counts superseded by a dated measure in bulk: their FHIR
+    jobs from a bounded pool of threads, the tasks of the ones not submitted
+    yet with one revoke, then the measures killed with one UPDATE.
+    A measure that could not be cancelled is left as is, its error being
+    collected in the returned failures.
+    Returns the numbers of measures superseded and killed, and the FHIR job
+    slots freed
+    """
+    dm = DatedMeasure.objects.filter(uuid=dm_uuid).first()
+    if dm is None:
+        record_row_miss("cancel_superseded_counts_task",
+                        lambda m: log_supersede_task(dm_uuid, m))
+        return dict(superseded=0, killed=0, freed_job_slots=0,
+                    failures=dict())
+
+    stale = list(get_superseded_counts(dm).only(
+        "uuid", "count_task_id", "request_job_id", "request_job_status"
+    ))
+    submitted = [s for s in stale if s.request_job_id]
+    not_submitted = [s for s in stale if not s.request_job_id
+                     and s.request_job_status == JobStatus.PENDING.name.lower()]
+    # the task of a started measure is submitting its job, not known yet
+    failures = dict((str(s.uuid), "Job being submitted") for s in stale
+                    if not s.request_job_id and s not in not_submitted)
+
+    with ThreadPoolExecutor(
+            max_workers=FHIR_JOB_STATUS_CONCURRENCY) as executor:
+        errors = executor.map(
+            lambda s: cancel_job(s.request_job_id, auth_headers), submitted
+        )
+        for (s, err) in zip(submitted, errors):
+            if err is not None:
+                failures[str(s.uuid)] = err
+
+    task_ids = [s.count_task_id for s in not_submitted if s.count_task_id]
+    if len(task_ids):
+        try:
+            app.control.revoke(task_ids)
+        except Exception as e:
+            for s in not_submitted:
+                failures[str(s.uuid)] = str(e)
+
+    # a measure whose task started meanwhile is not killed, its job running
+    killed = DatedMeasure.objects.filter(
+        Q(uuid__in=[s.uuid for s in submitted
+                    if str(s.uuid) not in failures],
+          request_job_status__in=IN_FLIGHT_JOB_STATUSES)
+        | Q(uuid__in=[s.uuid for s in not_submitted
+                      if str(s.uuid) not in failures],
+            request_job_id="",
+            request_job_status=JobStatus.PENDING.name.lower())
+    ).update(
+        request_job_status=JobStatus.KILLED.name.lower(),
+        request_job_fail_msg=f"Superseded by dated measure {dm_uuid}",
+        modified_at=timezone.now()
+    )
+
+    # slots of explorations.job_limiter, held by the jobs submitted
+    freed_job_slots = len([s for s in submitted
+                           if str(s.uuid) not in failures])
+    stats = dict(superseded=len(stale), killed=killed,
+                 freed_job_slots=freed_job_slots, failures=failures)
+    log_supersede_task(dm_uuid, f"Superseded counts cancelled: {stats}")
+    return stats
 
 
 def log_create_task(id, msg):
@@ -24,63 +613,41 @@ def log_create_task(id, msg):
 @shared_task
 def create_cohort_task(auth_headers: dict, json_file: str, cohort_uuid: str):
     print(f"Task opened for cohort {cohort_uuid}")
-    # in case of small lattency in database saving (when calling this task)
-    cr: CohortResult = None
-    tries = 0
-    while cr is None and tries <= 5:
-        cr = CohortResult.objects.filter(uuid=cohort_uuid).first()
-        if cr is None:
-            log_create_task(
-                cohort_uuid, f"Error: could not find CohortResult to update"
-                             f" after {tries - 1} sec"
-            )
-            tries = tries + 1
-            sleep(1)
-
+    cr: CohortResult = CohortResult.objects.filter(uuid=cohort_uuid)\
+        .select_related("dated_measure", "request_query_snapshot").first()
     if cr is None:
-        log_create_task(
-            cohort_uuid, f"Error: could not find CohortResult to update"
-                         f" after 5 sec"
-        )
+        record_row_miss("create_cohort_task",
+                        lambda m: log_create_task(cohort_uuid, m))
         return
 
+    holds_slot = holds_job_slot(cr)
+    # written with the job's state
     cr.create_task_id = current_task.request.id
-    cr.save()
     cr.dated_measure.count_task_id = current_task.request.id
-    cr.dated_measure.save()
+
+    if not holds_slot:
+        if not check_snapshot_validation(
+                [cr, cr.dated_measure],
+                lambda m: log_create_task(cohort_uuid, m)
+        ):
+            return
+        wait_for_job_slot(cr, lambda m: log_create_task(cohort_uuid, m))
 
     log_create_task(cohort_uuid, "Asking fhir to create cohort")
-    resp = fhir_api.post_create_cohort(
+    resp, finished = submit_job(
+        "submit_create_cohort", "post_create_cohort",
         json_file, auth_headers,
         log_prefix=f"[CohortTask] [CohortResult uuid: {cohort_uuid}]",
         cohort_result=cr
     )
+    update_cohort_result(cr, resp, finished)
 
-    if resp.success:
-        cr.dated_measure.fhir_datetime = resp.fhir_datetime
-        cr.dated_measure.measure = resp.count
-        cr.dated_measure.request_job_id = resp.fhir_job_id
-        cr.dated_measure.request_job_status = resp.fhir_job_status.name.lower()
-        cr.dated_measure.request_job_duration = resp.job_duration
-        cr.dated_measure.save()
-
-        cr.fhir_group_id = resp.group_id
-        cr.request_job_id = resp.fhir_job_id
-        cr.request_job_status = resp.fhir_job_status.name.lower()
-        cr.request_job_duration = resp.job_duration
-        cr.save()
-
+    if not resp.success:
+        log_create_task(cohort_uuid, resp.err_msg)
+    elif finished:
         log_create_task(cohort_uuid, "CohortResult and dated measure updated")
     else:
-        update_instance_failed(
-            cr, resp.err_msg, resp.job_duration, resp.fhir_job_id,
-            resp.fhir_job_status
-        )
-        update_instance_failed(
-            cr.dated_measure, resp.err_msg, resp.job_duration, resp.fhir_job_id,
-            resp.fhir_job_status
-        )
-        log_create_task(cohort_uuid, resp.err_msg)
+        log_create_task(cohort_uuid, f"Job {resp.fhir_job_id} submitted")
 
 
 def log_count_task(id, msg):
@@ -89,26 +656,40 @@ def log_count_task(id, msg):
 
 @shared_task
 def get_count_task(auth_headers: dict, json_file: str, dm_uuid: str):
-    # in case of small lattency in database saving (when calling this task)
-    dm: DatedMeasure = None
-    tries = 0
-    while dm is None and tries <= 5:
-        dm = DatedMeasure.objects.filter(uuid=dm_uuid).first()
-        if dm is None:
-            log_count_task(
-                dm_uuid,
-                f"Error: could not find DatedMeasure to update"
-                f" after {tries - 1} sec"
-            )
-            tries = tries + 1
-            sleep(1)
-
+    dm: DatedMeasure = DatedMeasure.objects.filter(uuid=dm_uuid)\
+        .select_related("request_query_snapshot").first()
     if dm is None:
-        log_count_task(dm_uuid, "Error: could not find DatedMeasure to update")
+        record_row_miss("get_count_task", lambda m: log_count_task(dm_uuid, m))
+        return
+
+    holds_slot = holds_job_slot(dm)
+    # filled by the count job it was following, or killed
+    if dm.request_job_status != JobStatus.PENDING.name.lower() \
+            and not holds_slot:
+        log_count_task(dm_uuid, f"Dated measure already {dm.request_job_status}")
         return
 
+    # written with the job's state
     dm.count_task_id = current_task.request.id
-    dm.save()
+
+    if not holds_slot:
+        if not check_snapshot_validation(
+                [dm], lambda m: log_count_task(dm_uuid, m)
+        ):
+            return
+
+        leader = elect_count_leader(dm)
+        if leader is not None:
+            log_count_task(
+                dm_uuid, f"Waiting for the count job of DM {leader.uuid}"
+            )
+            retries = current_task.request.retries
+            raise current_task.retry(countdown=min(
+                SINGLE_FLIGHT_RETRY_DELAY * 2 ** retries,
+                SINGLE_FLIGHT_MAX_RETRY_DELAY
+            ), max_retries=None)
+
+        wait_for_job_slot(dm, lambda m: log_count_task(dm_uuid, m))
 
     global_estimate = dm.mode == GLOBAL_DM_MODE
 
@@ -116,35 +697,18 @@ def get_count_task(auth_headers: dict, json_file: str, dm_uuid: str):
         dm_uuid,
         f"Asking fhir to get {'global ' if global_estimate else ''}count"
     )
-    resp = fhir_api.post_count_cohort(
+    resp, finished = submit_job(
+        "submit_count_cohort", "post_count_cohort",
         json_file, auth_headers,
         log_prefix=f"[{'global' if global_estimate else ''}CountTask] "
                    f"[DM uuid: {dm_uuid}]",
         dated_measure=dm, global_estimate=global_estimate
     )
+    update_dated_measure(dm, resp, finished)
 
-    if resp.success:
-        if not global_estimate:
-            dm.measure = resp.count
-            dm.measure_male = resp.count_male
-            dm.measure_unknown = resp.count_unknown
-            dm.measure_deceased = resp.count_deceased
-            dm.measure_alive = resp.count_alive
-            dm.measure_female = resp.count_female
-        else:
-            dm.measure_min = resp.count_min
-            dm.measure_max = resp.count_max
-
-        dm.fhir_datetime = resp.fhir_datetime
-        dm.request_job_status = resp.fhir_job_status.name.lower()
-        dm.request_job_duration = resp.job_duration
-        dm.request_job_id = resp.fhir_job_id
-        dm.save()
+    if not resp.success:
+        log_count_task(dm_uuid, resp.err_msg)
+    elif finished:
         log_count_task(dm_uuid, "Dated measure updated")
-
     else:
-        update_instance_failed(
-            dm, resp.err_msg, resp.job_duration, resp.fhir_job_id,
-            resp.fhir_job_status
-        )
-        log_count_task(dm_uuid, resp.err_msg)
+        log_count_task(dm_uuid, f"Job {resp.fhir_job_id} submitted")
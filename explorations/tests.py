@@ -1,25 +1,50 @@
+import json
 import math
 import random
 import string
+import time
 from datetime import timedelta
 from unittest import mock
+from uuid import uuid4
 
-from celery.result import AsyncResult
+from celery.exceptions import Retry
+from django.core.cache import cache
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
 from django.urls import reverse
 from django.utils import timezone
 from django.utils.datetime_safe import datetime
 from rest_framework import status
 from rest_framework.test import force_authenticate
 
+from cohort.models import User
 from cohort_back.FhirAPi import FhirValidateResponse, FhirCountResponse, \
     FhirCohortResponse, JobStatus
+from cohort_back.settings import IMPORT_I2B2_WATERMARK_OVERLAP, COUNT_CACHE_TTL, \
+    SNAPSHOT_VALIDATION_TIMEOUT, SINGLE_FLIGHT_SUBMIT_TIMEOUT, TASK_MIN_PRIORITY
 from cohort_back.tests import BaseTests
+from cohort_back.views import StreamingListViewSetMixin
+from explorations.count_cache import elect_count_leader, \
+    fill_followers, get_rights_scope
+from explorations.query_normalization import get_query_fingerprint
+from explorations.validation_cache import validation_cache
+from explorations.imports import CohortBulkImporter, import_omop_cohorts, \
+    OMOP_COHORTS_SOURCE
 from explorations.models import Request, RequestQuerySnapshot, DatedMeasure, \
-    CohortResult, COHORT_TYPE_CHOICES, Folder
-from explorations.tasks import get_count_task, create_cohort_task
+    CohortResult, COHORT_TYPE_CHOICES, Folder, ImportWatermark, \
+    I2B2_COHORT_TYPE, MY_ORGANISATIONS_COHORT_TYPE, MY_PATIENTS_COHORT_TYPE, \
+    PENDING_VALIDATION, VALID_VALIDATION, INVALID_VALIDATION
+from explorations.job_limiter import acquire_job_slot, get_job_limits
+from explorations.tasks import get_count_task, create_cohort_task, \
+    reconcile_jobs_status, validate_snapshot_task, \
+    cancel_superseded_counts_task, fetch_jobs_status, get_row_misses
 from explorations.views import RequestViewSet, RequestQuerySnapshotViewSet,\
     DatedMeasureViewSet, CohortResultViewSet, FolderViewSet
 
+# tasks are sent on commit, which does not happen in a TestCase
+on_commit_now = mock.patch('django.db.transaction.on_commit', new=lambda f: f())
+no_job_limits = mock.patch.multiple('explorations.job_limiter', FHIR_JOBS_MAX_PER_USER=0, FHIR_JOBS_MAX_GLOBAL=0)
+
 EXPLORATIONS_URL = "/explorations"
 FOLDERS_URL = f"{EXPLORATIONS_URL}/folders"
 REQUESTS_URL = f"{EXPLORATIONS_URL}/requests"
@@ -88,6 +113,61 @@ class FoldersGetTests(FoldersTests):
         self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND, response.content)
 
 
+class FoldersListQueriesTests(FoldersTests):
+    def add_requests(self, nb_requests: int, nb_snapshots: int):
+        for i in range(nb_requests):
+            req = Request.objects.create(
+                owner=self.user1,
+                name=f"Request {i}",
+                parent_folder=self.user1_fold1,
+            )
+            Folder.objects.create(
+                owner=self.user1,
+                name=f"Sub folder {i}",
+                parent_folder=self.user1_fold1,
+            )
+            for j in range(nb_snapshots):
+                rqs = RequestQuerySnapshot.objects.create(
+                    owner=self.user1,
+                    request=req,
+                    serialized_query="{}",
+                )
+                dm = DatedMeasure.objects.create(
+                    owner=self.user1,
+                    request=req,
+                    request_query_snapshot=rqs,
+                    measure=j,
+                    fhir_datetime=timezone.now(),
+                )
+                CohortResult.objects.create(
+                    owner=self.user1,
+                    name=f"Cohort {i}-{j}",
+                    request=req,
+                    request_query_snapshot=rqs,
+                    dated_measure=dm,
+                )
+
+    def count_list_queries(self) -> int:
+        request = self.factory.get(f'{FOLDERS_URL}')
+        force_authenticate(request, self.user1)
+        with CaptureQueriesContext(connection) as ctx:
+            response = self.list_view(request)
+            response.render()
+        self.assertEqual(response.status_code, status.HTTP_200_OK, response.content)
+        return len(ctx.captured_queries)
+
+    def test_list_queries_do_not_depend_on_tree_size(self):
+        # Listing folders runs the same number of queries, whatever the
+        # number of requests, snapshots, measures and cohorts they contain
+        self.add_requests(nb_requests=1, nb_snapshots=1)
+        small_tree_nb_queries = self.count_list_queries()
+
+        self.add_requests(nb_requests=10, nb_snapshots=5)
+        big_tree_nb_queries = self.count_list_queries()
+
+        self.assertEqual(small_tree_nb_queries, big_tree_nb_queries)
+
+
 class FoldersCreateTests(FoldersTests):
     def test_create_simple(self):
         # As a user, I can create a folder
@@ -468,6 +548,26 @@ class RqsTests(RequestsTests):
 
 
 class RqsGetTests(RqsTests):
+    def test_stream_list_prefetches_by_chunk(self):
+        # nested relations of a streamed list are prefetched once per chunk of rows
+        rqss = [self.user1_req1_snap1, self.user1_req1_branch1_snap2,
+                self.user1_req1_branch2_snap2, self.user1_req1_branch2_snap3]
+        for rqs in rqss:
+            DatedMeasure.objects.create(owner=self.user1, request=rqs.request, request_query_snapshot=rqs)
+
+        view_class = type("ChunkedRqsViewSet", (StreamingListViewSetMixin, RequestQuerySnapshotViewSet),
+                          dict(stream_chunk_size=2))
+        request = self.factory.get(f'{RQS_URL}', dict(stream="ndjson"))
+        force_authenticate(request, self.user1)
+        response = view_class.as_view({'get': 'list'})(request)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+        # the rows, then the dated measures and cohorts of each of the 2 chunks
+        with self.assertNumQueries(5):
+            rows = [json.loads(line) for line in b"".join(response.streaming_content).decode().splitlines()]
+        self.assertCountEqual([row["uuid"] for row in rows], [str(rqs.uuid) for rqs in rqss])
+        self.assertTrue(all(len(row["dated_measures"]) == 1 for row in rows))
+
     def test_rqs_simple_get(self):
         # As a user, I can get a rqs I did
         request = self.factory.get(f'{RQS_URL}')
@@ -501,8 +601,50 @@ class RqsGetTests(RqsTests):
                        self.user1_req1_branch2_snap2, self.user1_req1_branch2_snap3]
         self.check_get_response(response, rqs_to_find)
 
+    def test_get_list_by_query_fingerprint(self):
+        # As a user, I can find the snapshots of a query equivalent to another one
+        self.assertEqual(get_query_fingerprint(
+            '{"request": {"_type": "andGroup", "criteria": [{"_id": 1}, {"_id": 2}, {"_type": "orGroup"}]}}'
+        ), get_query_fingerprint(
+            '{"request": {"criteria": [{"_id": 2}, {"_id": 1}], "_type": "andGroup", "temporalConstraints": []}}'
+        ))
+        self.assertEqual(self.user1_req1_branch2_snap2.query_fingerprint,
+                         self.user1_req1_branch2_snap3.query_fingerprint)
+        self.assertNotEqual(self.user1_req1_branch1_snap2.query_fingerprint,
+                            self.user1_req1_branch2_snap2.query_fingerprint)
+
+        url = reverse(
+            'explorations:request-request-query-snapshots-list',
+            kwargs=dict(parent_lookup_request=self.user1_req1.uuid)
+        )
+        self.client.force_login(self.user1)
+        response = self.client.get(url, dict(query_fingerprint=self.user1_req1_branch2_snap2.query_fingerprint))
+        response.render()
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK, response.content)
+        self.check_get_response(response, [self.user1_req1_branch2_snap2, self.user1_req1_branch2_snap3])
+
+    def test_query_fingerprint_keeps_ordered_criteria(self):
+        # the criteria of a group that is not commutative are not reordered
+        self.assertNotEqual(get_query_fingerprint(
+            '{"request": {"_type": "sequenceGroup", "criteria": [{"_id": 1}, {"_id": 2}]}}'
+        ), get_query_fingerprint(
+            '{"request": {"_type": "sequenceGroup", "criteria": [{"_id": 2}, {"_id": 1}]}}'
+        ))
+        self.assertNotEqual(get_query_fingerprint(
+            '{"request": {"_type": "andGroup", "criteria": ['
+            '{"_type": "sequenceGroup", "criteria": [{"_id": 1}, {"_id": 2}]}, {"_id": 3}]}}'
+        ), get_query_fingerprint(
+            '{"request": {"_type": "andGroup", "criteria": ['
+            '{"_id": 3}, {"_type": "sequenceGroup", "criteria": [{"_id": 2}, {"_id": 1}]}]}}'
+        ))
+
 
 class RqsCreateTests(RqsTests):
+    def setUp(self):
+        super(RqsCreateTests, self).setUp()
+        validation_cache.clear()
+
     @mock.patch('explorations.serializers.fhir_api')
     def test_create_rqs_after_another(self, mock_fhir_api):
         # As a user, I can create a rqs after one in the active branch of a request
@@ -527,6 +669,60 @@ class RqsCreateTests(RqsTests):
         self.assertIsNotNone(rqs)
         mock_fhir_api.post_validate_cohort.assert_called_once()
 
+    @mock.patch('explorations.serializers.fhir_api')
+    def test_create_rqs_of_validated_query(self, mock_fhir_api):
+        # As a user, creating a rqs of a query I already validated does not call FHIR again
+        mock_fhir_api.post_validate_cohort.return_value = FhirValidateResponse(True)
+        test_sq = '{"test": "success"}'
+
+        def create_rqs(previous_snapshot: RequestQuerySnapshot, user: User) -> RequestQuerySnapshot:
+            request = self.factory.post(RQS_URL, dict(
+                previous_snapshot_id=previous_snapshot.uuid,
+                serialized_query=test_sq,
+            ), format='json')
+            force_authenticate(request, user)
+            response = self.create_view(request)
+            response.render()
+            self.assertEqual(response.status_code, status.HTTP_201_CREATED, response.content)
+            return RequestQuerySnapshot.objects.get(uuid=response.data["uuid"])
+
+        rqs = create_rqs(self.user1_req1_branch2_snap3, self.user1)
+        create_rqs(rqs, self.user1)
+        mock_fhir_api.post_validate_cohort.assert_called_once()
+        self.assertEqual(validation_cache.stats["hits"], 1)
+        self.assertEqual(validation_cache.stats["hit_rate"], 0.5)
+
+        # another user's validation is not reused
+        create_rqs(self.user2_req1_snap1, self.user2)
+        self.assertEqual(mock_fhir_api.post_validate_cohort.call_count, 2)
+
+        # nor a rejected query
+        mock_fhir_api.post_validate_cohort.return_value = FhirValidateResponse(False)
+        validation_cache.clear()
+        request = self.factory.post(RQS_URL, dict(
+            previous_snapshot_id=self.user1_req1_branch2_snap3.uuid,
+            serialized_query=test_sq,
+        ), format='json')
+        force_authenticate(request, self.user1)
+        self.create_view(request).render()
+        self.assertEqual(validation_cache.stats["size"], 0)
+
+    @mock.patch('explorations.serializers.ASYNC_SNAPSHOT_VALIDATION', True)
+    @mock.patch('explorations.serializers.fhir_api')
+    def test_create_rqs_validated_later(self, mock_fhir_api):
+        # As a user, in asynchronous validation mode, my rqs is saved before FHIR validates its query
+        request = self.factory.post(RQS_URL, dict(
+            previous_snapshot_id=self.user1_req1_branch2_snap3.uuid,
+            serialized_query='{"test": "success"}',
+        ), format='json')
+        force_authenticate(request, self.user1)
+        response = self.create_view(request)
+        response.render()
+
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED, response.content)
+        self.assertEqual(response.data["validation_status"], PENDING_VALIDATION)
+        mock_fhir_api.post_validate_cohort.assert_not_called()
+
     @mock.patch('explorations.serializers.fhir_api')
     def test_error_create_unvalid_query(self, mock_fhir_api):
         # As a user, I can create a rqs after one in the active branch of a request
@@ -846,8 +1042,15 @@ class DatedMeasuresGetTests(DatedMeasuresTests):
 
 
 class DatedMeasuresCreateTests(DatedMeasuresTests):
-    @mock.patch('explorations.tasks.get_count_task.delay')
-    def test_create_dm(self, count_task_delay):
+    def setUp(self):
+        super(DatedMeasuresCreateTests, self).setUp()
+        patcher = mock.patch('explorations.tasks.cancel_superseded_counts_task.apply_async')
+        self.supersede_task_apply = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    @on_commit_now
+    @mock.patch('explorations.tasks.get_count_task.apply_async')
+    def test_create_dm(self, count_task_apply):
         # As a user, I can create a dated_measure for one request_query_snapshot
         # Some fields are read only
         measure_test = 55
@@ -872,7 +1075,7 @@ class DatedMeasuresCreateTests(DatedMeasuresTests):
         response.render()
 
         self.assertEqual(response.status_code, status.HTTP_201_CREATED, response.content)
-        count_task_delay.assert_not_called()
+        count_task_apply.assert_not_called()
 
         dm = DatedMeasure.objects.filter(
             measure=measure_test,
@@ -885,8 +1088,9 @@ class DatedMeasuresCreateTests(DatedMeasuresTests):
         for read_only_field, val in read_only_fields.items():
             self.assertNotEqual(getattr(dm, read_only_field, None), val, f"With field {read_only_field}: {val}")
 
-    @mock.patch('explorations.tasks.get_count_task.delay')
-    def test_rest_create_dm_from_rqs(self, count_task_delay):
+    @on_commit_now
+    @mock.patch('explorations.tasks.get_count_task.apply_async')
+    def test_rest_create_dm_from_rqs(self, count_task_apply):
         # As a user, I can create a dated_measure for one request_query_snapshot, from rsq' url
         measure_test = 55
         datetime_test = datetime.now()
@@ -902,7 +1106,7 @@ class DatedMeasuresCreateTests(DatedMeasuresTests):
         response.render()
 
         self.assertEqual(response.status_code, status.HTTP_201_CREATED, response.content)
-        count_task_delay.assert_not_called()
+        count_task_apply.assert_not_called()
 
         rqs = DatedMeasure.objects.filter(
             measure=measure_test,
@@ -912,24 +1116,21 @@ class DatedMeasuresCreateTests(DatedMeasuresTests):
         ).first()
         self.assertIsNotNone(rqs)
 
-    @mock.patch('explorations.tasks.get_count_task.delay')
-    def test_create_dm_via_fhir(self, count_task_delay):
+    @on_commit_now
+    @mock.patch('explorations.tasks.get_count_task.apply_async')
+    def test_create_dm_via_fhir(self, count_task_apply):
         # As a user, I can create a dm without specifying a measure, it will ask FHIR back-end for the answer
-        test_task_id = "test_id"
-
         request = self.factory.post(DATED_MEASURES_URL, dict(
             request_query_snapshot_id=self.user1_req1_branch2_snap2.uuid
         ), format='json')
 
-        mocked_task_async_result = AsyncResult(id=test_task_id)
-        count_task_delay.return_value = mocked_task_async_result
-
         force_authenticate(request, self.user1)
         response = self.create_view(request)
         response.render()
 
         self.assertEqual(response.status_code, status.HTTP_201_CREATED, response.content)
-        count_task_delay.assert_called_once()
+        count_task_apply.assert_called_once()
+        test_task_id = count_task_apply.call_args[1]["task_id"]
 
         self.assertIsNotNone(
             DatedMeasure.objects.filter(
@@ -940,8 +1141,98 @@ class DatedMeasuresCreateTests(DatedMeasuresTests):
             ).first()
         )
 
-    @mock.patch('explorations.tasks.get_count_task.delay')
-    def test_error_create_dm_with_forbidden_access(self, count_task_delay):
+    @on_commit_now
+    @mock.patch('explorations.serializers.SUPERSEDE_STALE_COUNTS', False)
+    @mock.patch('explorations.tasks.get_count_task.apply_async')
+    def test_create_dm_supersedes_counts(self, count_task_apply):
+        # the counts of the request started before a dm created with create-unique are cancelled in a task
+        request = self.factory.post(DATED_MEASURES_URL, dict(
+            request_query_snapshot_id=self.user1_req1_branch2_snap2.uuid
+        ), format='json')
+        force_authenticate(request, self.user1)
+        response = self.create_view(request)
+        response.render()
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED, response.content)
+        self.supersede_task_apply.assert_not_called()
+
+        self.client.force_login(self.user1)
+        response = self.client.post(reverse('explorations:dated-measures-create-unique'), data=dict(
+            request_query_snapshot_id=self.user1_req1_branch2_snap2.uuid
+        ), format='json')
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED, response.content)
+        self.supersede_task_apply.assert_called_once()
+        self.assertEqual(str(self.supersede_task_apply.call_args[0][0][1]), response.data["uuid"])
+        self.assertEqual(self.supersede_task_apply.call_args[1]["priority"], TASK_MIN_PRIORITY)
+
+    @on_commit_now
+    @mock.patch('explorations.tasks.get_count_task.apply_async')
+    def test_create_dm_with_priority(self, count_task_apply):
+        # As a user, I can give the priority of the count task of my dm
+        request = self.factory.post(DATED_MEASURES_URL, dict(
+            request_query_snapshot_id=self.user1_req1_branch2_snap2.uuid,
+            priority=1
+        ), format='json')
+        force_authenticate(request, self.user1)
+        response = self.create_view(request)
+        response.render()
+
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED, response.content)
+        count_task_apply.assert_called_once()
+        self.assertEqual(count_task_apply.call_args[1]["priority"], 1)
+
+        # within the bounds of the broker's priorities
+        request = self.factory.post(DATED_MEASURES_URL, dict(
+            request_query_snapshot_id=self.user1_req1_branch2_snap2.uuid,
+            priority=10
+        ), format='json')
+        force_authenticate(request, self.user1)
+        response = self.create_view(request)
+        response.render()
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST, response.content)
+
+    @mock.patch('explorations.serializers.format_json_request', side_effect=lambda q: q)
+    @on_commit_now
+    @mock.patch('explorations.tasks.get_count_task.apply_async')
+    def test_create_dm_from_count_cache(self, count_task_apply, mock_format_json_request):
+        # As a user, the count of a query I counted recently is taken from the previous measure
+        rqs = self.user1_req1_branch2_snap2
+        query_hash = rqs.query_fingerprint
+        # the count finished recently, on data older than the TTL
+        previous_dm = DatedMeasure.objects.create(
+            owner=self.user1, request=rqs.request, request_query_snapshot=rqs, measure=42, measure_male=20,
+            fhir_datetime=timezone.now() - timedelta(seconds=COUNT_CACHE_TTL + 1), count_finished_at=timezone.now(),
+            request_job_status=JobStatus.FINISHED.name.lower(), query_hash=query_hash,
+            rights_scope=f"owner:{self.user1.uuid}"
+        )
+
+        def create_dm() -> DatedMeasure:
+            request = self.factory.post(DATED_MEASURES_URL, dict(request_query_snapshot_id=rqs.uuid), format='json')
+            force_authenticate(request, self.user1)
+            response = self.create_view(request)
+            response.render()
+            self.assertEqual(response.status_code, status.HTTP_201_CREATED, response.content)
+            return DatedMeasure.objects.get(uuid=response.data["uuid"])
+
+        dm = create_dm()
+        count_task_apply.assert_not_called()
+        self.assertTrue(dm.count_cache_hit)
+        self.assertEqual(dm.query_hash, previous_dm.query_hash)
+        self.assertEqual(dm.measure, 42)
+        self.assertEqual(dm.measure_male, 20)
+        self.assertEqual(dm.count_finished_at, previous_dm.count_finished_at)
+        self.assertEqual(dm.request_job_status, JobStatus.FINISHED.name.lower())
+
+        # once the counts finished longer ago than the TTL, FHIR is asked again
+        DatedMeasure.objects.filter(query_hash=query_hash).update(
+            count_finished_at=timezone.now() - timedelta(seconds=COUNT_CACHE_TTL + 1))
+        dm = create_dm()
+        count_task_apply.assert_called_once()
+        self.assertFalse(dm.count_cache_hit)
+        self.assertIsNone(dm.measure)
+
+    @on_commit_now
+    @mock.patch('explorations.tasks.get_count_task.apply_async')
+    def test_error_create_dm_with_forbidden_access(self, count_task_apply):
         forbidden_test_measure = 55
         forbidden_time = datetime.now().replace(tzinfo=timezone.utc)
 
@@ -983,10 +1274,11 @@ class DatedMeasuresCreateTests(DatedMeasuresTests):
         self.assertIsNone(DatedMeasure.objects.filter(
             fhir_datetime=forbidden_time
         ).first())
-        count_task_delay.assert_not_called()
+        count_task_apply.assert_not_called()
 
-    @mock.patch('explorations.tasks.get_count_task.delay')
-    def test_error_create_dm_on_rqs_not_owned(self, count_task_delay):
+    @on_commit_now
+    @mock.patch('explorations.tasks.get_count_task.apply_async')
+    def test_error_create_dm_on_rqs_not_owned(self, count_task_apply):
         # As a user, I cannot create a dm on a Rqs I don't own
         forbidden_test_measure = 55
 
@@ -1332,6 +1624,21 @@ class CohortsGetTests(CohortsTests):
                        self.user1_req1_branch2_snap2_cr1]
         self.check_get_response(response, rqs_to_find)
 
+    def test_stream_list(self):
+        # As a user, I can get the list of my cohorts streamed as ndjson
+        request = self.factory.get(f'{COHORTS_URL}', dict(stream="ndjson"))
+        force_authenticate(request, self.user1)
+        response = CohortResultViewSet.as_view({'get': 'list'})(request)
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response["Content-Type"], "application/x-ndjson")
+        rows = [json.loads(line) for line in b"".join(response.streaming_content).decode().splitlines()]
+        self.assertCountEqual(
+            [row["uuid"] for row in rows],
+            [str(self.user1_req1_branch2_snap3_cr1.uuid), str(self.user1_req1_branch2_snap2_cr1.uuid)]
+        )
+        self.assertEqual(rows[0]["result_size"], rows[0]["dated_measure"]["measure"])
+
 
 def random_str(length):
     letters = string.ascii_lowercase + ' '
@@ -1384,6 +1691,9 @@ class CohortsGetFilteredListTests(RequestsTests):
             request_query_snapshot=rqs,
             fhir_group_id="group11231",
             dated_measure=dm,
+            result_size=dm.measure,
+            fhir_datetime=dm.fhir_datetime,
+            perimeters_ids=rqs.perimeters_ids,
             created_at=d,
             request_job_status=random.choice(REQUEST_STATUS_CHOICES)[0],
             type=random.choice(COHORT_TYPE_CHOICES)[0],
@@ -1564,10 +1874,54 @@ class CohortsGetFilteredListTests(RequestsTests):
             self.check_list_sorted(list_obj_found=found, list_to_find=to_find, get_attr_lambda=param_set["key"],
                                    reverse=True)
 
+    def test_rest_get_keyset_paginated_list_from_request(self):
+        # As a user, I can browse the cohorts of a request page by page with a
+        # cursor, the count being only computed on the first page
+        base_url = reverse(
+            'explorations:request-cohort-results-list',
+            kwargs=dict(parent_lookup_request=self.user1_req1.uuid)
+        )[:-1]
+        self.client.force_login(self.user1)
+
+        for ordering in ["result_size", "-fhir_datetime", "-created_at"]:
+            response = self.client.get(f"{base_url}/?ordering={ordering}&limit=30")
+            response.render()
+            self.assertEqual(response.status_code, status.HTTP_200_OK, response.content)
+            self.assertEqual(self.get_response_payload(response)["count"], len(self.user1_req1_branch2_snap3_crs))
+
+            next_url = self.get_response_payload(response)["next"]
+            self.assertNotIn("offset", next_url)
+            response = self.client.get(next_url)
+            response.render()
+            self.assertIsNone(self.get_response_payload(response)["count"])
+
+            response = self.client.get(f"{base_url}/?ordering={ordering}&limit=30")
+            found = self.check_paged_response(
+                response, list(self.user1_req1_branch2_snap3_crs), user=self.user1, page_size=30
+            )
+            found_ids = [obj.uuid for obj in found]
+            self.assertEqual(len(found_ids), len(set(found_ids)))
+
+    def test_rest_get_offset_paginated_list_from_request(self):
+        # As an older client, I can still browse the cohorts with offset
+        base_url = reverse(
+            'explorations:request-cohort-results-list',
+            kwargs=dict(parent_lookup_request=self.user1_req1.uuid)
+        )[:-1]
+        self.client.force_login(self.user1)
+        response = self.client.get(f"{base_url}/?offset=0&limit=30")
+        response.render()
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK, response.content)
+        payload = self.get_response_payload(response)
+        self.assertEqual(payload["count"], len(self.user1_req1_branch2_snap3_crs))
+        self.assertIn("offset=30", payload["next"])
+
 
 class CohortsCreateTests(CohortsTests):
-    @mock.patch('explorations.tasks.create_cohort_task.delay')
-    def test_create(self, create_task_delay):
+    @on_commit_now
+    @mock.patch('explorations.tasks.create_cohort_task.apply_async')
+    def test_create(self, create_task_apply):
         # As a user, I can create a CohortResult
         # Some fields are read only
         # Some fields are optional
@@ -1603,7 +1957,7 @@ class CohortsCreateTests(CohortsTests):
         response.render()
 
         self.assertEqual(response.status_code, status.HTTP_201_CREATED, response.content)
-        create_task_delay.assert_not_called()
+        create_task_apply.assert_not_called()
 
         cr = CohortResult.objects.filter(
             name=test_name,
@@ -1622,8 +1976,9 @@ class CohortsCreateTests(CohortsTests):
         for read_only_field, val in read_only_fields.items():
             self.assertNotEqual(getattr(dm, read_only_field, None), val, f"With field {read_only_field}: {val}")
 
-    @mock.patch('explorations.tasks.create_cohort_task.delay')
-    def test_create_minimal(self, create_task_delay):
+    @on_commit_now
+    @mock.patch('explorations.tasks.create_cohort_task.apply_async')
+    def test_create_minimal(self, create_task_apply):
         # As a user, I can create a CohortResult with the minimum of fields
         test_measure = 654
         test_datetime = datetime.now().replace(tzinfo=timezone.utc)
@@ -1642,7 +1997,7 @@ class CohortsCreateTests(CohortsTests):
         response.render()
 
         self.assertEqual(response.status_code, status.HTTP_201_CREATED, response.content)
-        create_task_delay.assert_not_called()
+        create_task_apply.assert_not_called()
 
         cr = CohortResult.objects.filter(
             request_query_snapshot=self.user1_req1_branch2_snap3.uuid,
@@ -1656,16 +2011,13 @@ class CohortsCreateTests(CohortsTests):
         ).first()
         self.assertIsNotNone(dm)
 
-    @mock.patch('explorations.tasks.create_cohort_task.delay')
-    def test_create_with_fhir(self, create_task_delay):
+    @on_commit_now
+    @mock.patch('explorations.tasks.create_cohort_task.apply_async')
+    def test_create_with_fhir(self, create_task_apply):
         # As a user, I can create a CohortResult without providing group_id
         # Fhir API will then be called in create_task
         test_name = "My new cohort"
         test_description = "Cohort I just did"
-        test_task_id = "test_id"
-
-        mocked_task_async_result = AsyncResult(id=test_task_id)
-        create_task_delay.return_value = mocked_task_async_result
 
         cohort = self.factory.post(COHORTS_URL, dict(
             name=test_name,
@@ -1677,7 +2029,8 @@ class CohortsCreateTests(CohortsTests):
         response.render()
 
         self.assertEqual(response.status_code, status.HTTP_201_CREATED, response.content)
-        create_task_delay.assert_called_once()
+        create_task_apply.assert_called_once()
+        test_task_id = create_task_apply.call_args[1]["task_id"]
 
         cr = CohortResult.objects.filter(
             name=test_name,
@@ -1690,8 +2043,9 @@ class CohortsCreateTests(CohortsTests):
         self.assertIsNone(cr.dated_measure.fhir_datetime)
         self.assertIsNone(cr.dated_measure.measure)
 
-    @mock.patch('explorations.tasks.create_cohort_task.delay')
-    def test_create_with_dm_id(self, create_task_delay):
+    @on_commit_now
+    @mock.patch('explorations.tasks.create_cohort_task.apply_async')
+    def test_create_with_dm_id(self, create_task_apply):
         # As a user, I can create a CohortResult while providing a dated_measure
         # the cohort result will be bound to it
         test_name = "My new cohort"
@@ -1710,7 +2064,7 @@ class CohortsCreateTests(CohortsTests):
         response.render()
 
         self.assertEqual(response.status_code, status.HTTP_201_CREATED, response.content)
-        create_task_delay.assert_not_called()
+        create_task_apply.assert_not_called()
 
         cr = CohortResult.objects.filter(
             name=test_name,
@@ -1721,18 +2075,15 @@ class CohortsCreateTests(CohortsTests):
         ).first()
         self.assertIsNotNone(cr)
 
-    @mock.patch('explorations.tasks.create_cohort_task.delay')
-    def test_create_with_dm_id_with_fhir(self, create_task_delay):
+    @on_commit_now
+    @mock.patch('explorations.tasks.create_cohort_task.apply_async')
+    def test_create_with_dm_id_with_fhir(self, create_task_apply):
         # As a user, I can create a CohortResult while providing a dated_measure
         # the cohort result will be bound to it
         # If no group_id is provided, cohort_result and dated_measure will be updated with FHIR API
 
         test_name = "My new cohort"
         test_description = "Cohort I just did"
-        test_task_id = "test_id"
-
-        mocked_task_async_result = AsyncResult(id=test_task_id)
-        create_task_delay.return_value = mocked_task_async_result
 
         cohort = self.factory.post(COHORTS_URL, dict(
             name=test_name,
@@ -1744,7 +2095,8 @@ class CohortsCreateTests(CohortsTests):
         response = self.create_view(cohort)
         response.render()
 
-        create_task_delay.assert_called_once()
+        create_task_apply.assert_called_once()
+        test_task_id = create_task_apply.call_args[1]["task_id"]
 
         self.assertEqual(response.status_code, status.HTTP_201_CREATED, response.content)
         cr = CohortResult.objects.filter(
@@ -1905,6 +2257,57 @@ class CohortsCreateTests(CohortsTests):
             name=test_name).first())
 
 
+class CohortsGetStatusTests(CohortsTests):
+    def setUp(self):
+        super(CohortsGetStatusTests, self).setUp()
+        self.get_status_view = CohortResultViewSet.as_view({'post': 'get_status'})
+        cr = self.user1_req1_branch2_snap2_cr1
+        cr.request_job_id = "job_id"
+        cr.request_job_status = JobStatus.RUNNING.name.lower()
+        cr.save()
+
+    @mock.patch('explorations.tasks.fhir_api')
+    def test_get_status_records_job_status(self, mock_fhir_api):
+        # As a user, I can get the status of the job creating my cohort
+        mock_fhir_api.get_job_status.return_value = FhirCohortResponse(
+            count=42, group_id="group_id", fhir_job_id="job_id", success=True,
+            fhir_job_status=JobStatus.FINISHED,
+        )
+        request = self.factory.post(COHORTS_URL)
+        force_authenticate(request, self.user1)
+        response = self.get_status_view(request, uuid=self.user1_req1_branch2_snap2_cr1.uuid)
+        response.render()
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK, response.content)
+        mock_fhir_api.get_job_status.assert_called_once_with("job_id")
+        cr = CohortResult.objects.get(uuid=self.user1_req1_branch2_snap2_cr1.uuid)
+        self.assertEqual(cr.request_job_status, JobStatus.FINISHED.name.lower())
+        self.assertEqual(cr.fhir_group_id, "group_id")
+        self.assertEqual(cr.result_size, 42)
+
+    @mock.patch('explorations.tasks.fhir_api')
+    def test_error_get_status_job_api_fails(self, mock_fhir_api):
+        mock_fhir_api.get_job_status.side_effect = Exception("down")
+        request = self.factory.post(COHORTS_URL)
+        force_authenticate(request, self.user1)
+        response = self.get_status_view(request, uuid=self.user1_req1_branch2_snap2_cr1.uuid)
+        response.render()
+
+        self.assertEqual(response.status_code, status.HTTP_502_BAD_GATEWAY, response.content)
+        cr = CohortResult.objects.get(uuid=self.user1_req1_branch2_snap2_cr1.uuid)
+        self.assertEqual(cr.request_job_status, JobStatus.RUNNING.name.lower())
+
+    @mock.patch('explorations.tasks.fhir_api')
+    def test_error_get_status_as_not_owner(self, mock_fhir_api):
+        request = self.factory.post(COHORTS_URL)
+        force_authenticate(request, self.user2)
+        response = self.get_status_view(request, uuid=self.user1_req1_branch2_snap2_cr1.uuid)
+        response.render()
+
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND, response.content)
+        mock_fhir_api.get_job_status.assert_not_called()
+
+
 class CohortsDeleteTests(CohortsTests):
     def test_delete_as_owner(self):
         # As a user, I can delete a cohort result I created
@@ -2070,6 +2473,8 @@ class CohortsUpdateTests(CohortsTests):
 class TasksTests(RqsTests):
     def setUp(self):
         super(TasksTests, self).setUp()
+        # job counts shared by the job limiter
+        cache.clear()
         self.user1_req1_snap1_empty_dm = DatedMeasure(
             owner=self.user1,
             request=self.user1_req1,
@@ -2098,12 +2503,13 @@ class TasksTests(RqsTests):
         test_job_id = "job_id"
         test_job_duration = 1000
 
-        mock_fhir_api.post_count_cohort.return_value = FhirCountResponse(
+        mock_fhir_api.submit_count_cohort.return_value = FhirCountResponse(
             count=test_count,
             fhir_datetime=test_datetime,
             fhir_job_id="job_id",
             job_duration=test_job_duration,
             success=True,
+            fhir_job_status=JobStatus.FINISHED,
         )
         get_count_task({}, '{"json_key": "json_value"}', self.user1_req1_snap1_empty_dm.uuid)
 
@@ -2120,17 +2526,337 @@ class TasksTests(RqsTests):
         #  while calling Fhir API
         self.assertIsNotNone(new_dm)
 
+    def get_task_writes(self, queries) -> list:
+        return [q["sql"] for q in queries.captured_queries if q["sql"].startswith("UPDATE")]
+
+    @no_job_limits
+    @mock.patch('explorations.tasks.fhir_api')
+    def test_get_count_task_queries(self, mock_fhir_api):
+        # a count task reads its dated measure once, and writes its state with one UPDATE of the changed columns
+        mock_fhir_api.submit_count_cohort.return_value = FhirCountResponse(
+            count=102, fhir_datetime=timezone.now(), fhir_job_id="job_id", success=True,
+            fhir_job_status=JobStatus.FINISHED,
+        )
+        with CaptureQueriesContext(connection) as queries:
+            get_count_task({}, '{"json_key": "json_value"}', self.user1_req1_snap1_empty_dm.uuid)
+
+        # the dated measure with its snapshot, its update, its cohorts' and its followers' updates
+        self.assertEqual(len(queries), 4, [q["sql"] for q in queries.captured_queries])
+        dm_writes = [q for q in self.get_task_writes(queries) if q.startswith('UPDATE "explorations_datedmeasure"')
+                     and "count_leader_id" not in q]
+        self.assertEqual(len(dm_writes), 1)
+        self.assertNotIn('"request_query_snapshot_id"', dm_writes[0])
+        self.assertNotIn('"owner_id"', dm_writes[0])
+
+    @no_job_limits
+    @mock.patch('explorations.tasks.fhir_api')
+    def test_create_cohort_task_queries(self, mock_fhir_api):
+        # a cohort task reads its cohort once, and writes it and its dated measure with one UPDATE each
+        mock_fhir_api.submit_create_cohort.return_value = FhirCohortResponse(
+            count=102, group_id="group_id", fhir_datetime=timezone.now(), fhir_job_id="job_id", success=True,
+            fhir_job_status=JobStatus.FINISHED,
+        )
+        with CaptureQueriesContext(connection) as queries:
+            create_cohort_task({}, '{"json_key": "json_value"}', self.user1_req1_snap1_empty_cohort.uuid)
+
+        self.assertEqual(len(queries), 3, [q["sql"] for q in queries.captured_queries])
+        writes = self.get_task_writes(queries)
+        self.assertEqual(len(writes), 2)
+        for q in writes:
+            self.assertNotIn('"request_query_snapshot_id"', q)
+
+    @mock.patch('explorations.tasks.fhir_api')
+    def test_get_count_task_of_missing_dm(self, mock_fhir_api):
+        # a task whose row does not exist returns at once, counting the miss
+        misses = get_row_misses()["get_count_task"]
+        start = time.monotonic()
+        get_count_task({}, '{"json_key": "json_value"}', "00000000-0000-0000-0000-000000000000")
+        self.assertLess(time.monotonic() - start, 1)
+        self.assertEqual(get_row_misses()["get_count_task"], misses + 1)
+        mock_fhir_api.submit_count_cohort.assert_not_called()
+
+    def test_single_flight_count_jobs(self):
+        # measures of the same query follow the oldest one, that alone runs a count job
+        leader = self.user1_req1_snap1_empty_dm
+        leader.query_hash = "hash"
+        leader.rights_scope = "scope"
+        leader.save()
+        followers = [DatedMeasure.objects.create(
+            owner=self.user1, request=self.user1_req1, request_query_snapshot=self.user1_req1_snap1,
+            request_job_status=JobStatus.PENDING.name.lower(), query_hash="hash",
+            rights_scope="scope"
+        ) for _ in range(2)]
+        other_scope_dm = DatedMeasure.objects.create(
+            owner=self.user2, request=self.user2_req1, request_query_snapshot=self.user2_req1_snap1,
+            request_job_status=JobStatus.PENDING.name.lower(), query_hash="hash",
+            rights_scope="other_scope"
+        )
+        # another owner with the same rights follows the leader too
+        followers.append(DatedMeasure.objects.create(
+            owner=self.user2, request=self.user2_req1, request_query_snapshot=self.user2_req1_snap1,
+            request_job_status=JobStatus.PENDING.name.lower(), query_hash="hash",
+            rights_scope="scope"
+        ))
+
+        self.assertIsNone(elect_count_leader(leader))
+        self.assertIsNone(elect_count_leader(other_scope_dm))
+        for dm in followers:
+            self.assertEqual(elect_count_leader(dm), leader)
+
+        leader.measure = 42
+        leader.fhir_datetime = timezone.now()
+        leader.request_job_status = JobStatus.FINISHED.name.lower()
+        leader.save()
+        self.assertEqual(fill_followers(leader), len(followers))
+        for dm in followers:
+            dm.refresh_from_db()
+            self.assertEqual(dm.measure, 42)
+            self.assertEqual(dm.request_job_status, JobStatus.FINISHED.name.lower())
+
+    def test_single_flight_replaces_failed_leader(self):
+        # when the leader fails, a follower runs the count job itself
+        leader = self.user1_req1_snap1_empty_dm
+        leader.query_hash = "hash"
+        leader.rights_scope = "scope"
+        leader.save()
+        follower = DatedMeasure.objects.create(
+            owner=self.user1, request=self.user1_req1, request_query_snapshot=self.user1_req1_snap1,
+            request_job_status=JobStatus.PENDING.name.lower(), query_hash="hash",
+            rights_scope="scope"
+        )
+        self.assertEqual(elect_count_leader(follower), leader)
+
+        leader.request_job_status = JobStatus.ERROR.name.lower()
+        leader.save()
+        self.assertEqual(fill_followers(leader), 0)
+        self.assertIsNone(elect_count_leader(follower))
+        follower.refresh_from_db()
+        self.assertIsNone(follower.count_leader)
+
+    def test_single_flight_replaces_leader_not_submitted(self):
+        # a leader that did not submit its job long after it was queued, its task being lost, is replaced
+        leader = self.user1_req1_snap1_empty_dm
+        leader.query_hash = "hash"
+        leader.rights_scope = "scope"
+        leader.save()
+        follower = DatedMeasure.objects.create(
+            owner=self.user1, request=self.user1_req1, request_query_snapshot=self.user1_req1_snap1,
+            request_job_status=JobStatus.PENDING.name.lower(), query_hash="hash",
+            rights_scope="scope"
+        )
+        self.assertEqual(elect_count_leader(follower), leader)
+
+        DatedMeasure.objects.filter(uuid=leader.uuid).update(
+            modified_at=timezone.now() - timedelta(seconds=SINGLE_FLIGHT_SUBMIT_TIMEOUT + 1),
+            job_queued_at=timezone.now() - timedelta(seconds=SINGLE_FLIGHT_SUBMIT_TIMEOUT + 1)
+        )
+        self.assertIsNone(elect_count_leader(follower))
+
+    def test_rights_scope(self):
+        # owners with the same rights on the perimeters of a query share its rights scope
+        def add_right(user, perimeter, cohort_type):
+            rqs = RequestQuerySnapshot.objects.create(owner=user, request=self.user1_req1)
+            dm = DatedMeasure.objects.create(owner=user, request=self.user1_req1, request_query_snapshot=rqs)
+            CohortResult.objects.create(owner=user, request=self.user1_req1, request_query_snapshot=rqs,
+                                        dated_measure=dm, fhir_group_id=perimeter, type=cohort_type)
+
+        def get_scope(user, perimeters_ids) -> str:
+            rqs = RequestQuerySnapshot.objects.create(owner=user, request=self.user1_req1,
+                                                      perimeters_ids=perimeters_ids)
+            return get_rights_scope(DatedMeasure(owner=user, request=self.user1_req1, request_query_snapshot=rqs))
+
+        for user in [self.user1, self.user2]:
+            add_right(user, "1", MY_ORGANISATIONS_COHORT_TYPE)
+            add_right(user, "2", MY_ORGANISATIONS_COHORT_TYPE)
+        add_right(self.user2, "2", MY_PATIENTS_COHORT_TYPE)
+
+        self.assertEqual(get_scope(self.user1, ["1"]), get_scope(self.user2, ["1"]))
+        self.assertNotEqual(get_scope(self.user1, ["1", "2"]), get_scope(self.user2, ["1", "2"]))
+        # without rights on a perimeter, or perimeters, counts are not shared
+        self.assertEqual(get_scope(self.user1, ["1", "3"]), f"owner:{self.user1.uuid}")
+        self.assertEqual(get_scope(self.user1, None), f"owner:{self.user1.uuid}")
+
+    @mock.patch('explorations.tasks.app')
+    @mock.patch('explorations.tasks.fhir_api')
+    def test_cancel_superseded_counts_task(self, mock_fhir_api, mock_app):
+        # the in-flight counts of the request's other queries started before a dm are cancelled in bulk
+        def create_dm(**kwargs) -> DatedMeasure:
+            return DatedMeasure.objects.create(
+                owner=self.user1, request=self.user1_req1, request_query_snapshot=self.user1_req1_snap1, **kwargs
+            )
+        submitted_dm = create_dm(request_job_id="job_id", request_job_status=JobStatus.RUNNING.name.lower())
+        failing_dm = create_dm(request_job_id="failing_job_id", request_job_status=JobStatus.RUNNING.name.lower())
+        queued_dm = create_dm(count_task_id="queued_task_id", request_job_status=JobStatus.PENDING.name.lower())
+        same_query_dm = create_dm(request_job_status=JobStatus.PENDING.name.lower(), query_hash="hash")
+        finished_dm = create_dm(request_job_status=JobStatus.FINISHED.name.lower())
+        new_dm = create_dm(request_job_status=JobStatus.PENDING.name.lower(), query_hash="hash")
+
+        def cancel_job(job_id, auth_headers):
+            if job_id == "failing_job_id":
+                raise Exception("Could not cancel")
+        mock_fhir_api.cancel_job.side_effect = cancel_job
+
+        stats = cancel_superseded_counts_task({}, new_dm.uuid)
+        self.assertEqual(stats["superseded"], 3)
+        self.assertEqual(stats["killed"], 2)
+        self.assertEqual(stats["freed_job_slots"], 1)
+        self.assertEqual(list(stats["failures"]), [str(failing_dm.uuid)])
+        mock_app.control.revoke.assert_called_once_with(["queued_task_id"])
+
+        for (dm, job_status) in [(submitted_dm, JobStatus.KILLED), (queued_dm, JobStatus.KILLED),
+                                 (failing_dm, JobStatus.RUNNING), (same_query_dm, JobStatus.PENDING),
+                                 (finished_dm, JobStatus.FINISHED), (self.user1_req1_snap1_empty_dm, JobStatus.PENDING)]:
+            dm.refresh_from_db()
+            self.assertEqual(dm.request_job_status, job_status.name.lower(), dm)
+
+    @mock.patch('explorations.tasks.app')
+    def test_cancel_superseded_counts_task_dm_missing(self, mock_app):
+        # without its dated measure, the task cancels nothing but returns the same stats
+        stats = cancel_superseded_counts_task({}, uuid4())
+        self.assertEqual(stats, dict(superseded=0, killed=0, freed_job_slots=0, failures=dict()))
+        mock_app.control.revoke.assert_not_called()
+
+    @mock.patch.multiple('explorations.job_limiter', FHIR_JOBS_MAX_PER_USER=1, FHIR_JOBS_MAX_GLOBAL=0,
+                         FHIR_JOB_LIMITER_COUNTS_TTL=0)
+    @mock.patch('explorations.tasks.fhir_api')
+    def test_get_count_task_over_user_limit(self, mock_fhir_api):
+        # a count task waits, its measure staying pending, while its owner has as many jobs as allowed in flight
+        running_dm = DatedMeasure.objects.create(
+            owner=self.user1, request=self.user1_req1, request_query_snapshot=self.user1_req1_snap1,
+            request_job_id="running_job_id", request_job_status=JobStatus.RUNNING.name.lower()
+        )
+        with self.assertRaises(Retry):
+            get_count_task({}, '{"json_key": "json_value"}', self.user1_req1_snap1_empty_dm.uuid)
+        mock_fhir_api.submit_count_cohort.assert_not_called()
+        self.assertEqual(DatedMeasure.objects.get(uuid=self.user1_req1_snap1_empty_dm.uuid).request_job_status,
+                         JobStatus.PENDING.name.lower())
+        self.assertEqual(get_job_limits(self.user1.uuid)["user_in_flight"], 1)
+
+        running_dm.request_job_status = JobStatus.FINISHED.name.lower()
+        running_dm.save()
+        mock_fhir_api.submit_count_cohort.return_value = FhirCountResponse(
+            fhir_job_id="job_id", success=True, fhir_job_status=JobStatus.RUNNING,
+        )
+        get_count_task({}, '{"json_key": "json_value"}', self.user1_req1_snap1_empty_dm.uuid)
+        mock_fhir_api.submit_count_cohort.assert_called_once()
+
+    @mock.patch.multiple('explorations.job_limiter', FHIR_JOBS_MAX_PER_USER=1, FHIR_JOBS_MAX_GLOBAL=0)
+    @mock.patch('explorations.tasks.fhir_api')
+    def test_get_count_task_submission_error_releases_slot(self, mock_fhir_api):
+        # a count whose submission raises fails, releasing the job slot it took
+        mock_fhir_api.submit_count_cohort.side_effect = Exception("Connection refused")
+        get_count_task({}, '{"json_key": "json_value"}', self.user1_req1_snap1_empty_dm.uuid)
+
+        dm = DatedMeasure.objects.get(uuid=self.user1_req1_snap1_empty_dm.uuid)
+        self.assertEqual(dm.request_job_status, JobStatus.ERROR.name.lower())
+        self.assertIn("Connection refused", dm.request_job_fail_msg)
+        self.assertEqual(get_job_limits(self.user1.uuid)["user_in_flight"], 0)
+
+    @mock.patch.multiple('explorations.job_limiter', FHIR_JOBS_MAX_PER_USER=1, FHIR_JOBS_MAX_GLOBAL=0)
+    def test_job_limiter_shares_counts(self):
+        # waiting tasks whose job cannot run with the shared counts do not count the jobs again
+        DatedMeasure.objects.create(
+            owner=self.user1, request=self.user1_req1, request_query_snapshot=self.user1_req1_snap1,
+            request_job_id="running_job_id", request_job_status=JobStatus.RUNNING.name.lower()
+        )
+        self.assertFalse(acquire_job_slot(self.user1_req1_snap1_empty_dm))
+        with self.assertNumQueries(0):
+            self.assertFalse(acquire_job_slot(self.user1_req1_snap1_empty_dm))
+
+    @mock.patch.multiple('explorations.job_limiter', FHIR_JOBS_MAX_PER_USER=5, FHIR_JOBS_MAX_GLOBAL=2)
+    def test_job_limiter_fair_queue(self):
+        # the last global slot goes to the owner with the fewest jobs in flight, each owner's jobs in their order
+        DatedMeasure.objects.create(
+            owner=self.user1, request=self.user1_req1, request_query_snapshot=self.user1_req1_snap1,
+            request_job_id="running_job_id", request_job_status=JobStatus.RUNNING.name.lower()
+        )
+        queued_at = timezone.now()
+        user1_dms = [DatedMeasure.objects.create(
+            owner=self.user1, request=self.user1_req1, request_query_snapshot=self.user1_req1_snap1,
+            request_job_status=JobStatus.PENDING.name.lower(), job_queued_at=queued_at + timedelta(seconds=i)
+        ) for i in range(2)]
+        user2_dm = DatedMeasure.objects.create(
+            owner=self.user2, request=self.user2_req1, request_query_snapshot=self.user2_req1_snap1,
+            request_job_status=JobStatus.PENDING.name.lower(), job_queued_at=queued_at + timedelta(seconds=2)
+        )
+        self.assertEqual(get_job_limits(self.user1.uuid)["user_queued"], 2)
+
+        self.assertFalse(acquire_job_slot(user1_dms[0]))
+        self.assertFalse(acquire_job_slot(user1_dms[1]))
+        self.assertTrue(acquire_job_slot(user2_dm))
+        self.assertEqual(DatedMeasure.objects.get(uuid=user2_dm.uuid).request_job_status,
+                         JobStatus.STARTED.name.lower())
+        self.assertFalse(acquire_job_slot(user1_dms[0]))
+
+        limits = get_job_limits(self.user2.uuid)
+        self.assertEqual(limits["in_flight"], 2)
+        self.assertEqual(limits["queued"], 2)
+        self.assertEqual(limits["user_in_flight"], 1)
+        self.assertEqual(limits["user_queued"], 0)
+
+    @mock.patch('explorations.tasks.fhir_api')
+    def test_validate_snapshot_task(self, mock_fhir_api):
+        rqs = self.user1_req1_snap1
+        rqs.validation_status = PENDING_VALIDATION
+        rqs.save()
+
+        # the count task waits for the validation of its snapshot
+        with self.assertRaises(Retry):
+            get_count_task({}, '{"json_key": "json_value"}', self.user1_req1_snap1_empty_dm.uuid)
+        mock_fhir_api.submit_count_cohort.assert_not_called()
+
+        mock_fhir_api.post_validate_cohort.return_value = FhirValidateResponse(True)
+        validate_snapshot_task({}, '{"json_key": "json_value"}', rqs.uuid)
+        rqs.refresh_from_db()
+        self.assertEqual(rqs.validation_status, VALID_VALIDATION)
+
+    @mock.patch('explorations.tasks.fhir_api')
+    def test_validate_snapshot_task_error(self, mock_fhir_api):
+        # a validation that raises rejects the snapshot
+        mock_fhir_api.post_validate_cohort.side_effect = Exception("Connection refused")
+        validate_snapshot_task({}, '{"json_key": "json_value"}', self.user1_req1_snap1.uuid)
+        self.user1_req1_snap1.refresh_from_db()
+        self.assertEqual(self.user1_req1_snap1.validation_status, INVALID_VALIDATION)
+        self.assertIn("Connection refused", self.user1_req1_snap1.validation_fail_msg)
+
+    @mock.patch('explorations.tasks.fhir_api')
+    def test_get_count_task_of_snapshot_never_validated(self, mock_fhir_api):
+        # the tasks of a snapshot still being validated after the timeout fail
+        RequestQuerySnapshot.objects.filter(uuid=self.user1_req1_snap1.uuid).update(
+            validation_status=PENDING_VALIDATION,
+            created_at=timezone.now() - timedelta(seconds=SNAPSHOT_VALIDATION_TIMEOUT + 1)
+        )
+        get_count_task({}, '{"json_key": "json_value"}', self.user1_req1_snap1_empty_dm.uuid)
+        mock_fhir_api.submit_count_cohort.assert_not_called()
+        dm = DatedMeasure.objects.get(uuid=self.user1_req1_snap1_empty_dm.uuid)
+        self.assertEqual(dm.request_job_status, JobStatus.ERROR.name.lower())
+
+    @mock.patch('explorations.tasks.fhir_api')
+    def test_get_count_task_of_invalid_snapshot(self, mock_fhir_api):
+        mock_fhir_api.post_validate_cohort.return_value = FhirValidateResponse(False, err_msg="Wrong query")
+        validate_snapshot_task({}, '{"json_key": "json_value"}', self.user1_req1_snap1.uuid)
+        self.user1_req1_snap1.refresh_from_db()
+        self.assertEqual(self.user1_req1_snap1.validation_status, INVALID_VALIDATION)
+
+        # the count of a rejected query fails without asking FHIR
+        get_count_task({}, '{"json_key": "json_value"}', self.user1_req1_snap1_empty_dm.uuid)
+        mock_fhir_api.submit_count_cohort.assert_not_called()
+        dm = DatedMeasure.objects.get(uuid=self.user1_req1_snap1_empty_dm.uuid)
+        self.assertEqual(dm.request_job_status, JobStatus.ERROR.name.lower())
+        self.assertIn("Wrong query", dm.request_job_fail_msg)
+
     @mock.patch('explorations.tasks.fhir_api')
     def test_failed_get_count_task(self, mock_fhir_api):
         test_job_duration = 1000
         test_err_msg = "Error"
         test_fhir_job_id = "job_id"
 
-        mock_fhir_api.post_count_cohort.return_value = FhirCountResponse(
+        mock_fhir_api.submit_count_cohort.return_value = FhirCountResponse(
             fhir_job_id=test_fhir_job_id,
             job_duration=test_job_duration,
             success=False,
             err_msg=test_err_msg,
+            fhir_job_status=JobStatus.ERROR,
         )
 
         get_count_task({}, '{"json_key": "json_value"}', self.user1_req1_snap1_empty_dm.uuid)
@@ -2149,6 +2875,42 @@ class TasksTests(RqsTests):
         self.assertIsNone(new_dm.measure)
         self.assertIsNone(new_dm.fhir_datetime)
 
+    @mock.patch('explorations.views.parse_job_callback')
+    @mock.patch('explorations.views.FHIR_JOB_CALLBACK_TOKEN', "secret")
+    @mock.patch('explorations.tasks.fhir_api')
+    def test_get_count_task_submits_then_callback_updates(self, mock_fhir_api, mock_parse_job_callback):
+        test_datetime = datetime.now().replace(tzinfo=timezone.utc)
+        mock_fhir_api.submit_count_cohort.return_value = FhirCountResponse(
+            fhir_job_id="job_id", success=True, fhir_job_status=JobStatus.PENDING,
+        )
+        get_count_task({}, '{"json_key": "json_value"}', self.user1_req1_snap1_empty_dm.uuid)
+
+        dm = DatedMeasure.objects.get(uuid=self.user1_req1_snap1_empty_dm.uuid)
+        self.assertEqual(dm.request_job_id, "job_id")
+        self.assertEqual(dm.request_job_status, JobStatus.PENDING.name.lower())
+        self.assertIsNone(dm.measure)
+
+        mock_parse_job_callback.return_value = FhirCountResponse(
+            count=102, fhir_datetime=test_datetime, fhir_job_id="job_id", job_duration=1000,
+            success=True, fhir_job_status=JobStatus.FINISHED,
+        )
+        url = reverse("explorations:job-callback")
+        response = self.client.post(url, {}, HTTP_X_JOB_CALLBACK_TOKEN="wrong")
+        self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+        response = self.client.post(url, {}, HTTP_X_JOB_CALLBACK_TOKEN="secret")
+        self.assertEqual(response.status_code, status.HTTP_204_NO_CONTENT)
+
+        dm = DatedMeasure.objects.get(uuid=self.user1_req1_snap1_empty_dm.uuid)
+        self.assertEqual(dm.request_job_status, JobStatus.FINISHED.name.lower())
+        self.assertEqual(dm.measure, 102)
+        self.assertEqual(dm.fhir_datetime, test_datetime)
+
+        mock_parse_job_callback.return_value = FhirCountResponse(
+            fhir_job_id="unknown", success=True, fhir_job_status=JobStatus.FINISHED,
+        )
+        response = self.client.post(url, {}, HTTP_X_JOB_CALLBACK_TOKEN="secret")
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
     @mock.patch('explorations.tasks.fhir_api')
     def test_create_cohort_task(self, mock_fhir_api):
         test_count = 102
@@ -2157,13 +2919,14 @@ class TasksTests(RqsTests):
         test_job_duration = 1000
         test_group_id = "groupId"
 
-        mock_fhir_api.post_create_cohort.return_value = FhirCohortResponse(
+        mock_fhir_api.submit_create_cohort.return_value = FhirCohortResponse(
             count=test_count,
             group_id=test_group_id,
             fhir_datetime=test_datetime,
             fhir_job_id="job_id",
             job_duration=test_job_duration,
             success=True,
+            fhir_job_status=JobStatus.FINISHED,
         )
         create_cohort_task({}, '{"json_key": "json_value"}', self.user1_req1_snap1_empty_cohort.uuid)
 
@@ -2184,6 +2947,22 @@ class TasksTests(RqsTests):
         self.assertEqual(new_cr.dated_measure.request_job_status, new_cr.request_job_status)
         self.assertEqual(new_cr.dated_measure.request_job_fail_msg, new_cr.request_job_fail_msg)
         self.assertEqual(new_cr.dated_measure.request_job_duration, new_cr.request_job_duration)
+        self.assertEqual(new_cr.result_size, test_count)
+        self.assertEqual(new_cr.fhir_datetime, test_datetime)
+
+    @mock.patch('explorations.tasks.fhir_api')
+    def test_get_count_task_updates_cohort_result_size(self, mock_fhir_api):
+        # the count of a dated measure is copied onto the cohorts it measures
+        test_datetime = datetime.now().replace(tzinfo=timezone.utc)
+        mock_fhir_api.submit_count_cohort.return_value = FhirCountResponse(
+            count=42, fhir_datetime=test_datetime, fhir_job_id="job_id", success=True,
+            fhir_job_status=JobStatus.FINISHED,
+        )
+        get_count_task({}, '{"json_key": "json_value"}', self.user1_req1_snap1_empty_dm.uuid)
+
+        cr = CohortResult.objects.get(uuid=self.user1_req1_snap1_empty_cohort.uuid)
+        self.assertEqual(cr.result_size, 42)
+        self.assertEqual(cr.fhir_datetime, test_datetime)
 
     @mock.patch('explorations.tasks.fhir_api')
     def test_failed_create_cohort_task(self, mock_fhir_api):
@@ -2191,11 +2970,12 @@ class TasksTests(RqsTests):
         test_err_msg = "Error"
         test_fhir_job_id = "job_id"
 
-        mock_fhir_api.post_create_cohort.return_value = FhirCohortResponse(
+        mock_fhir_api.submit_create_cohort.return_value = FhirCohortResponse(
             fhir_job_id=test_fhir_job_id,
             job_duration=test_job_duration,
             success=False,
             err_msg=test_err_msg,
+            fhir_job_status=JobStatus.ERROR,
         )
 
         create_cohort_task({}, '{"json_key": "json_value"}', self.user1_req1_snap1_empty_cohort.uuid)
@@ -2219,3 +2999,124 @@ class TasksTests(RqsTests):
         self.assertEqual(new_cr.dated_measure.request_job_fail_msg, new_cr.request_job_fail_msg)
         self.assertEqual(new_cr.dated_measure.request_job_duration, new_cr.request_job_duration)
 
+    @mock.patch('explorations.tasks.fhir_api')
+    def test_reconcile_jobs_status(self, mock_fhir_api):
+        for instance in [self.user1_req1_snap1_empty_cohort, self.user1_req1_snap1_empty_dm]:
+            instance.request_job_id = "job_id"
+            instance.save()
+        other_dm = DatedMeasure.objects.create(
+            owner=self.user1, request=self.user1_req1, request_query_snapshot=self.user1_req1_snap1,
+            request_job_id="other_job_id", request_job_status=JobStatus.PENDING.name.lower()
+        )
+        mock_fhir_api.get_jobs_status.side_effect = lambda job_ids: [
+            FhirCohortResponse(count=102, group_id="groupId", fhir_job_id="job_id", success=True,
+                               fhir_job_status=JobStatus.FINISHED),
+            FhirCountResponse(fhir_job_id="other_job_id", success=True, fhir_job_status=JobStatus.PENDING),
+        ]
+
+        with CaptureQueriesContext(connection) as queries:
+            stats = reconcile_jobs_status()
+        self.assertEqual(stats["in_flight"], 2)
+        self.assertEqual(stats["updated_cohorts"], 1)
+        self.assertEqual(stats["updated_dated_measures"], 1)
+        self.assertEqual(len([q for q in queries.captured_queries if q["sql"].startswith("UPDATE")]), 2)
+
+        cr = CohortResult.objects.get(uuid=self.user1_req1_snap1_empty_cohort.uuid)
+        self.assertEqual(cr.request_job_status, JobStatus.FINISHED.name.lower())
+        self.assertEqual(cr.fhir_group_id, "groupId")
+        self.assertEqual(cr.dated_measure.measure, 102)
+        self.assertEqual(cr.dated_measure.request_job_status, JobStatus.FINISHED.name.lower())
+        self.assertEqual(DatedMeasure.objects.get(uuid=other_dm.uuid).request_job_status,
+                         JobStatus.PENDING.name.lower())
+
+        stats = reconcile_jobs_status()
+        self.assertEqual(stats["in_flight"], 1)
+        self.assertEqual(stats["updated_dated_measures"], 0)
+
+    @mock.patch('explorations.tasks.FHIR_JOB_STATUS_BATCH_SIZE', 1)
+    @mock.patch('explorations.tasks.fhir_api')
+    def test_fetch_jobs_status_skips_failed_batch(self, mock_fhir_api):
+        # a batch of statuses that fails is left out, the other batches being fetched
+        def get_jobs_status(job_ids):
+            if job_ids == ["failing_job_id"]:
+                raise Exception("Timeout")
+            return [FhirCountResponse(fhir_job_id=j, success=True, fhir_job_status=JobStatus.RUNNING)
+                    for j in job_ids]
+        mock_fhir_api.get_jobs_status.side_effect = get_jobs_status
+
+        self.assertEqual(list(fetch_jobs_status(["failing_job_id", "job_id"])), ["job_id"])
+
+
+# IMPORT
+class FakeOmopCohort:
+    def __init__(self, fhir_id: str, size: int, name: str = "Cohort", username: str = ""):
+        self.fhir_id = fhir_id
+        self.name = name
+        self.description = "Imported"
+        self.creation_date = timezone.now()
+        self.size = size
+        self.username = username
+
+
+class CohortBulkImporterTests(BaseTests):
+    def import_cohorts(self, cohorts: [(FakeOmopCohort, str)]) -> dict:
+        importer = CohortBulkImporter([self.user1, self.user2]).load()
+        for (cohort, cohort_type) in cohorts:
+            importer.add(self.user1, cohort, cohort_type)
+        return importer.finish()
+
+    def test_import_creates_then_updates(self):
+        stats = self.import_cohorts([
+            (FakeOmopCohort("1", 10), I2B2_COHORT_TYPE),
+            (FakeOmopCohort("2", 20), MY_ORGANISATIONS_COHORT_TYPE),
+        ])
+        self.assertEqual(stats, dict(created=2, updated=0, deleted=0))
+        cr = CohortResult.objects.get(owner=self.user1, fhir_group_id="1", type=I2B2_COHORT_TYPE)
+        self.assertEqual(cr.dated_measure.measure, 10)
+        self.assertEqual(cr.request.parent_folder.owner, self.user1)
+
+        stats = self.import_cohorts([
+            (FakeOmopCohort("1", 15, name="Renamed"), I2B2_COHORT_TYPE),
+        ])
+        self.assertEqual(stats, dict(created=0, updated=1, deleted=1))
+        cr = CohortResult.objects.get(uuid=cr.uuid)
+        self.assertEqual(cr.name, "Renamed")
+        self.assertEqual(cr.dated_measure.measure, 15)
+        self.assertIsNone(CohortResult.objects.filter(
+            owner=self.user1, type=MY_ORGANISATIONS_COHORT_TYPE).first())
+
+    def test_import_queries_do_not_depend_on_cohorts_number(self):
+        # creates the user's import folder
+        self.import_cohorts([(FakeOmopCohort("-1", 1), I2B2_COHORT_TYPE)])
+
+        with CaptureQueriesContext(connection) as small_import:
+            self.import_cohorts([(FakeOmopCohort("0", 1), I2B2_COHORT_TYPE)])
+        with CaptureQueriesContext(connection) as big_import:
+            self.import_cohorts([(FakeOmopCohort(str(i), i), I2B2_COHORT_TYPE) for i in range(1, 50)])
+        self.assertEqual(len(small_import.captured_queries), len(big_import.captured_queries))
+
+
+class ImportOmopCohortsTests(BaseTests):
+    @mock.patch('explorations.imports.get_user_care_sites_cohorts')
+    @mock.patch('explorations.imports.get_care_sites_changes')
+    @mock.patch('explorations.imports.get_users_cohorts')
+    def test_import_is_incremental_after_full_import(self, mock_cohorts, mock_changes, mock_care_sites):
+        cohort = FakeOmopCohort("1", 10, username=self.user1.username)
+        mock_cohorts.return_value = iter([cohort])
+        mock_changes.return_value = []
+        mock_care_sites.return_value = iter([])
+
+        stats = import_omop_cohorts()
+        self.assertEqual(stats, dict(created=1, updated=0, deleted=0, full=True))
+        self.assertEqual(ImportWatermark.objects.get(source=OMOP_COHORTS_SOURCE).watermark, cohort.creation_date)
+        mock_care_sites.assert_called_once()
+
+        mock_cohorts.reset_mock()
+        mock_cohorts.return_value = iter([])
+        stats = import_omop_cohorts()
+        self.assertEqual(stats, dict(created=0, updated=0, deleted=0, full=False))
+        # only the cohorts initiated since the watermark are read, and no
+        # care-site cohorts as no rights changed
+        mock_cohorts.assert_called_once()
+        self.assertEqual(mock_cohorts.call_args[0][1], timezone.make_naive(cohort.creation_date - timedelta(seconds=IMPORT_I2B2_WATERMARK_OVERLAP)))
+        mock_care_sites.assert_called_once()
@@ -19,7 +19,8 @@ from rest_framework import routers
 from rest_framework_extensions.routers import NestedRouterMixin
 
 from explorations.views import RequestViewSet, RequestQuerySnapshotViewSet, CohortResultViewSet, DatedMeasureViewSet, \
-    FolderViewSet
+    FolderViewSet, JobCallbackView, JobLimitsView, ValidationCacheStatsView, \
+    RowMissesStatsView
 
 
 class NestedDefaultRouter(NestedRouterMixin, routers.DefaultRouter):
@@ -111,5 +112,9 @@ router.register(r'dated-measures', DatedMeasureViewSet, basename="dated-measures
 router.register(r'cohorts', CohortResultViewSet, basename="cohort-results")
 
 urlpatterns = [
+    path('jobs/callback', JobCallbackView.as_view(), name="job-callback"),
+    path('jobs/limits', JobLimitsView.as_view(), name="job-limits"),
+    path('validation-cache', ValidationCacheStatsView.as_view(), name="validation-cache"),
+    path('tasks/row-misses', RowMissesStatsView.as_view(), name="task-row-misses"),
     path('', include(router.urls)),
 ]
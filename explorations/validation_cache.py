@@ -0,0 +1,61 @@
+from cohort_back.settings import VALIDATION_CACHE_MAX_SIZE, \
+    VALIDATION_CACHE_TTL
+from cohort_back.ttl_cache import TtlLruCache
+from explorations.query_normalization import get_query_fingerprint
+
+
+class ValidationCache(TtlLruCache):
+    """
+    Cache of the formatted queries FHIR accepted, so that a snapshot of an
+    already validated query is created without waiting for
+    post_validate_cohort again.
+    Entries are keyed by the owner and the fingerprint of the formatted
+    query, as FHIR validates a query with the rights of the user, and expire
+    after ttl seconds. Rejected queries are not cached.
+    Each entry keeps the duration of its validation, summed on each hit as
+    the latency saved.
+    """
+    def __init__(self, max_size: int, ttl: int):
+        super(ValidationCache, self).__init__(max_size=max_size, ttl=ttl)
+        self.saved_seconds = 0.
+
+    @staticmethod
+    def get_key(owner_id, formatted_query: str) -> str:
+        return f"{owner_id}:{get_query_fingerprint(formatted_query)}"
+
+    def get(self, owner_id, formatted_query: str) -> bool:
+        """
+        :return: True if the query was validated for this owner and did not
+        expire
+        """
+        duration = super(ValidationCache, self).get(
+            self.get_key(owner_id, formatted_query)
+        )
+        if duration is None:
+            return False
+        with self._lock:
+            self.saved_seconds += duration
+        return True
+
+    def set(self, owner_id, formatted_query: str, duration: float):
+        super(ValidationCache, self).set(
+            self.get_key(owner_id, formatted_query), duration
+        )
+
+    def clear(self):
+        super(ValidationCache, self).clear()
+        self.saved_seconds = 0.
+
+    @property
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return dict(
+            super(ValidationCache, self).stats,
+            hit_rate=self.hits / lookups if lookups else 0.,
+            saved_seconds=round(self.saved_seconds, 3)
+        )
+
+
+validation_cache = ValidationCache(
+    max_size=VALIDATION_CACHE_MAX_SIZE, ttl=VALIDATION_CACHE_TTL
+)
@@ -1,3 +1,4 @@
+import hmac
 import re
 from collections import OrderedDict
 
@@ -16,31 +17,37 @@ from rest_framework_extensions.mixins import NestedViewSetMixin
 
 from cohort.permissions import IsAdminOrOwner, OR, IsAdmin
 from cohort.views import UserObjectsRestrictedViewSet
-from cohort_back import app
-from cohort_back.FhirAPi import JobStatus
+from cohort_back.pagination import KeysetPagination
 from cohort_back.conf_cohort_job_api import cancel_job, \
-    get_fhir_authorization_header
-from cohort_back.views import NoDeleteViewSetMixin, NoUpdateViewSetMixin
+    get_fhir_authorization_header, parse_job_callback
+from cohort_back.settings import FHIR_JOB_CALLBACK_TOKEN
+from cohort_back.views import NoDeleteViewSetMixin, NoUpdateViewSetMixin, \
+    StreamingListViewSetMixin
 from explorations.models import Request, CohortResult, RequestQuerySnapshot, DatedMeasure, Folder
 from explorations.serializers import RequestSerializer, CohortResultSerializer, \
     RequestQuerySnapshotSerializer, DatedMeasureSerializer, FolderSerializer, CohortResultSerializerFullDatedMeasure
+from explorations.job_limiter import get_job_limits
+from explorations.tasks import update_job_instances, \
+    refresh_cohort_job_status, get_row_misses
+from explorations.validation_cache import validation_cache
 
 
 class CohortFilter(django_filters.FilterSet):
     def perimeter_filter(self, queryset, field, value):
-        return queryset.filter(request_query_snapshot__perimeters_ids__contains=[value])
+        return queryset.filter(perimeters_ids__contains=[value])
 
     def perimeters_filter(self, queryset, field, value):
-        return queryset.filter(request_query_snapshot__perimeters_ids__contains=value.split(","))
+        return queryset.filter(perimeters_ids__contains=value.split(","))
 
     name = django_filters.CharFilter(field_name='name', lookup_expr="contains")
     perimeter_id = django_filters.CharFilter(method="perimeter_filter")
     perimeters_ids = django_filters.CharFilter(method="perimeters_filter")
-    min_result_size = django_filters.NumberFilter(field_name='dated_measure__measure', lookup_expr='gte')
-    max_result_size = django_filters.NumberFilter(field_name='dated_measure__measure', lookup_expr='lte')
+    min_result_size = django_filters.NumberFilter(field_name='result_size', lookup_expr='gte')
+    max_result_size = django_filters.NumberFilter(field_name='result_size', lookup_expr='lte')
     # ?min_created_at=2015-04-23
-    min_fhir_datetime = django_filters.DateTimeFilter(field_name='dated_measure__fhir_datetime', lookup_expr="gte")
-    max_fhir_datetime = django_filters.DateTimeFilter(field_name='dated_measure__fhir_datetime', lookup_expr="lte")
+    min_fhir_datetime = django_filters.DateTimeFilter(field_name='fhir_datetime', lookup_expr="gte")
+    max_fhir_datetime = django_filters.DateTimeFilter(field_name='fhir_datetime', lookup_expr="lte")
+    query_fingerprint = django_filters.CharFilter(field_name='request_query_snapshot__query_fingerprint')
     request_job_status = django_filters.AllValuesMultipleFilter()
     type = django_filters.AllValuesMultipleFilter()
 
@@ -57,21 +64,25 @@ class CohortFilter(django_filters.FilterSet):
             "favorite",
             "type",
             "perimeters_ids",
-            "fhir_group_id"
+            "fhir_group_id",
+            "query_fingerprint"
         )
 
 
-class CohortResultViewSet(NestedViewSetMixin, UserObjectsRestrictedViewSet):
+class CohortResultViewSet(
+    NestedViewSetMixin, StreamingListViewSetMixin, UserObjectsRestrictedViewSet
+):
     queryset = CohortResult.objects.all()
     serializer_class = CohortResultSerializer
     http_method_names = ['get', 'post', 'patch', 'delete']
     lookup_field = "uuid"
+    pagination_class = KeysetPagination
 
     filter_class = CohortFilter
     ordering_fields = (
         "name",
-        ("result_size", "dated_measure__measure"),
-        ("fhir_datetime", "dated_measure__fhir_datetime"),
+        "result_size",
+        "fhir_datetime",
         "type",
         "favorite",
         "request_job_status"
@@ -140,14 +151,34 @@ class CohortResultViewSet(NestedViewSetMixin, UserObjectsRestrictedViewSet):
     def list(self, request, *args, **kwargs):
         return super(CohortResultViewSet, self).list(request, *args, **kwargs)
 
+    @action(detail=True, methods=['post'], url_path="get-status")
+    def get_status(self, request, *args, **kwargs):
+        """
+        Demande à l'API FHIR le statut du job de création de la cohorte, s'il
+        est en cours, et l'enregistre sur la cohorte et son dated measure
+        """
+        cr: CohortResult = self.get_object()
+        if not refresh_cohort_job_status(cr):
+            return Response(
+                dict(message=f"Could not get the status of job "
+                             f"'{cr.request_job_id}'"),
+                status=status.HTTP_502_BAD_GATEWAY
+            )
+        return Response(CohortResultSerializerFullDatedMeasure(
+            cr, context=self.get_serializer_context()
+        ).data)
+
 
-class DatedMeasureViewSet(NestedViewSetMixin, UserObjectsRestrictedViewSet):
+class DatedMeasureViewSet(
+    NestedViewSetMixin, StreamingListViewSetMixin, UserObjectsRestrictedViewSet
+):
     queryset = DatedMeasure.objects.all()
     serializer_class = DatedMeasureSerializer
     http_method_names = ['get', 'post', 'patch', 'delete']
     lookup_field = "uuid"
 
-    filterset_fields = ('uuid', 'request_query_snapshot_id', 'request_id')
+    filterset_fields = ('uuid', 'request_query_snapshot_id', 'request_id',
+                        'request_query_snapshot__query_fingerprint')
     ordering_fields = ('created_at', 'modified_at', 'result_size')
     ordering = ('-created_at',)
     search_fields = []
@@ -165,6 +196,12 @@ class DatedMeasureViewSet(NestedViewSetMixin, UserObjectsRestrictedViewSet):
                             status=status.HTTP_403_FORBIDDEN)
         return super(DatedMeasureViewSet, self).destroy(request, *args, **kwargs)
 
+    def get_serializer_context(self):
+        context = super(DatedMeasureViewSet, self).get_serializer_context()
+        if self.action == "create_unique":
+            context["supersede"] = True
+        return context
+
     def create(self, request, *args, **kwargs):
         user = request.user
         if type(request.data) == QueryDict:
@@ -197,12 +234,7 @@ class DatedMeasureViewSet(NestedViewSetMixin, UserObjectsRestrictedViewSet):
                 status.HTTP_400_BAD_REQUEST,
             )
 
-        headers = get_fhir_authorization_header(request)
-        try:
-            rqs: RequestQuerySnapshot = RequestQuerySnapshot.objects.get(
-                pk=rqs_id
-            )
-        except RequestQuerySnapshot.DoesNotExist:
+        if not RequestQuerySnapshot.objects.filter(pk=rqs_id).exists():
             return Response(
                 dict(
                     message="No existing request_query_snapshot to "
@@ -211,36 +243,9 @@ class DatedMeasureViewSet(NestedViewSetMixin, UserObjectsRestrictedViewSet):
                 status.HTTP_400_BAD_REQUEST,
             )
 
-        for job_to_cancel in rqs.request.dated_measures.filter(
-                request_job_status=JobStatus.STARTED.name.lower()
-        ):
-            try:
-                cancel_job(job_to_cancel.request_job_id, headers)
-            except Exception as e:
-                return Response(
-                    dict(
-                        message=f"Error while cancelling job "
-                                f"'{job_to_cancel.request_job_id}', bound "
-                                f"to dated-measure '{job_to_cancel.uuid}': "
-                                f"{str(e)}"
-                    ), status.HTTP_500_INTERNAL_SERVER_ERROR
-                )
-
-        for job_to_cancel in rqs.request.dated_measures.filter(
-                request_job_status=JobStatus.PENDING.name.lower()
-        ):
-            try:
-                app.control.revoke(job_to_cancel.count_task_id)
-                # revoke(task_id=job_to_cancel.count_task_id, terminate=True)
-                job_to_cancel.request_job_status = JobStatus.KILLED.name.lower()
-                job_to_cancel.save()
-            except Exception as e:
-                return Response(
-                    dict(message=str(e)), status.HTTP_500_INTERNAL_SERVER_ERROR
-                )
-
+        # the earlier counts of the request are cancelled by the serializer,
+        # in a task, whatever SUPERSEDE_STALE_COUNTS
         return self.create(request, *args, **kwargs)
-        return Response(dict(hehe=headers))
 
     @action(methods=['patch'], detail=True, url_path='abort')
     def abort(self, request, *args, **kwargs):
@@ -268,8 +273,9 @@ class RequestQuerySnapshotViewSet(
     serializer_class = RequestQuerySnapshotSerializer
     http_method_names = ['get', 'post', 'patch', 'delete']
     lookup_field = "uuid"
+    pagination_class = KeysetPagination
 
-    filterset_fields = ('uuid', 'request_id',)
+    filterset_fields = ('uuid', 'request_id', 'query_fingerprint',)
     ordering_fields = ('created_at', 'modified_at',)
     ordering = ('-created_at',)
     search_fields = ('$serialized_query',)
@@ -342,6 +348,7 @@ class RequestViewSet(NestedViewSetMixin, UserObjectsRestrictedViewSet):
     serializer_class = RequestSerializer
     http_method_names = ['get', 'post', 'patch', 'delete']
     lookup_field = "uuid"
+    pagination_class = KeysetPagination
 
     filterset_fields = ('uuid', 'name', 'favorite', 'data_type_of_query',)
     ordering_fields = ('created_at', 'modified_at',
@@ -372,17 +379,6 @@ class RequestViewSet(NestedViewSetMixin, UserObjectsRestrictedViewSet):
 
         return super(RequestViewSet, self).create(request, *args, **kwargs)
 
-    @action(detail=True, methods=['post'], permission_classes=(IsAdminOrOwner,), url_path="get-status")
-    def get_status(self, req, cohort_result_uuid):
-        try:
-            cr = CohortResult.objects.get(uuid=cohort_result_uuid)
-        except CohortResult.DoesNotExist:
-            return Response({"response": "CohortResult not found"},
-                            status=status.HTTP_404_NOT_FOUND)
-        r = cr.check_request_status()
-        return Response({'response': "Query successful!", 'data': r},
-                        status=status.HTTP_200_OK)
-
     def partial_update(self, request, *args, **kwargs):
         # temp fix untill _id is not used
         # if 'parent_folder_id' in request.data:
@@ -455,3 +451,73 @@ class SearchCriteria(APIView):
 
         result = {}
         return Response(result)
+
+
+class JobCallbackView(APIView):
+    """
+    Called by the FHIR job server when the status of a job changes, with
+    FHIR_JOB_CALLBACK_TOKEN in the X-Job-Callback-Token header
+    """
+    authentication_classes = ()
+    permission_classes = ()
+    swagger_schema = None
+
+    def post(self, request):
+        token = request.META.get("HTTP_X_JOB_CALLBACK_TOKEN", "")
+        if not FHIR_JOB_CALLBACK_TOKEN \
+                or not hmac.compare_digest(token, FHIR_JOB_CALLBACK_TOKEN):
+            return Response(status=status.HTTP_403_FORBIDDEN)
+
+        if not callable(parse_job_callback):
+            return Response(
+                dict(message="The job API does not send callbacks"),
+                status=status.HTTP_501_NOT_IMPLEMENTED
+            )
+        resp = parse_job_callback(request.data)
+        if not resp.fhir_job_id:
+            return Response(
+                dict(message="No job id provided"),
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        # the task may not have recorded the job id yet: the job server will
+        # send the status again
+        if not update_job_instances(resp):
+            return Response(
+                dict(message=f"No job '{resp.fhir_job_id}' found"),
+                status=status.HTTP_404_NOT_FOUND
+            )
+        return Response(status=status.HTTP_204_NO_CONTENT)
+
+
+class ValidationCacheStatsView(APIView):
+    """
+    Statistics of the query validation cache of the process serving the
+    request: size, hits, misses, hit rate, and seconds of validation saved
+    """
+    permission_classes = (IsAdmin,)
+
+    def get(self, request):
+        return Response(validation_cache.stats)
+
+
+class RowMissesStatsView(APIView):
+    """
+    Number of rows the tasks were sent for but did not find, by task, across
+    the workers sharing the cache
+    """
+    permission_classes = (IsAdmin,)
+
+    def get(self, request):
+        return Response(get_row_misses())
+
+
+class JobLimitsView(APIView):
+    """
+    Limits of the FHIR jobs in flight at once, per user and for everyone,
+    with the jobs of the user and of everyone in flight and waiting for a
+    slot
+    """
+    permission_classes = (IsAuthenticated,)
+
+    def get(self, request):
+        return Response(get_job_limits(request.user.pk))
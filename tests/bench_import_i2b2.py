@@ -0,0 +1,102 @@
+"""
+Compares the former per-row import of OMOP cohorts with CohortBulkImporter,
+on synthetic cohorts, against the database configured in settings.
+Everything is rolled back at the end.
+
+    python tests/bench_import_i2b2.py [nb_cohorts] [nb_users]
+"""
+import os
+import sys
+import time
+from datetime import datetime
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'cohort_back.settings')
+
+import django
+
+django.setup()
+
+from django.db import transaction
+
+from cohort.models import User
+from cohort_back.FhirAPi import JobStatus
+from explorations.imports import CohortBulkImporter
+from explorations.models import CohortResult, DatedMeasure, Folder, Request, \
+    RequestQuerySnapshot, I2B2_COHORT_TYPE
+
+
+class FakeOmopCohort:
+    def __init__(self, i: int, user: User):
+        self.fhir_id = str(i)
+        self.name = f"Cohort {i}"
+        self.description = f"Synthetic cohort {i}"
+        self.creation_date = datetime.now()
+        self.size = i
+        self.username = user.username
+
+
+def import_per_row(user, cohort, folder):
+    # former behaviour of import_i2b2: 2 queries to look the cohort up, then
+    # one save per object
+    cohorts = CohortResult.objects.filter(owner=user, name=cohort.name, fhir_group_id=cohort.fhir_id,
+                                          type=I2B2_COHORT_TYPE)
+    if cohorts.count() == 1:
+        cr = cohorts.first()
+        cr.save()
+        cr.dated_measure.measure = cohort.size
+        cr.dated_measure.save()
+        return
+    r = Request(owner=user, name=cohort.name, description=cohort.description, parent_folder=folder)
+    r.save()
+    rqs = RequestQuerySnapshot(owner=user, request=r, serialized_query="{}")
+    rqs.save()
+    dm = DatedMeasure(owner=user, request_query_snapshot=rqs, request=r, measure=cohort.size,
+                      fhir_datetime=cohort.creation_date)
+    dm.save()
+    CohortResult(owner=user, name=cohort.name, description=cohort.description, dated_measure=dm,
+                 request_query_snapshot=rqs, request=r, fhir_group_id=cohort.fhir_id, type=I2B2_COHORT_TYPE,
+                 request_job_status=JobStatus.FINISHED.name.lower()).save()
+
+
+def run(nb_cohorts: int, nb_users: int):
+    with transaction.atomic():
+        users = [User.objects.create(username=f"bench{i}", email=f"bench{i}@bench.org") for i in range(nb_users)]
+        cohorts = [FakeOmopCohort(i, users[i % nb_users]) for i in range(nb_cohorts)]
+
+        sid = transaction.savepoint()
+        folders = dict((u.uuid, Folder.objects.create(owner=u, name="bench")) for u in users)
+        start = time.monotonic()
+        for c in cohorts:
+            user = users[int(c.fhir_id) % nb_users]
+            import_per_row(user, c, folders[user.uuid])
+        per_row = time.monotonic() - start
+        transaction.savepoint_rollback(sid)
+
+        start = time.monotonic()
+        importer = CohortBulkImporter(users).load()
+        for c in cohorts:
+            importer.add(users[int(c.fhir_id) % nb_users], c, I2B2_COHORT_TYPE)
+        importer.finish()
+        bulk = time.monotonic() - start
+
+        start = time.monotonic()
+        importer = CohortBulkImporter(users).load()
+        for c in cohorts:
+            importer.add(users[int(c.fhir_id) % nb_users], c, I2B2_COHORT_TYPE)
+        importer.finish()
+        bulk_update = time.monotonic() - start
+
+        transaction.set_rollback(True)
+
+    print(f"{nb_cohorts} cohorts for {nb_users} users")
+    print(f"per row import:         {per_row:.1f}s")
+    print(f"bulk import (creation): {bulk:.1f}s ({per_row / bulk:.1f}x)")
+    print(f"bulk import (update):   {bulk_update:.1f}s")
+
+
+if __name__ == "__main__":
+    run(
+        nb_cohorts=int(sys.argv[1]) if len(sys.argv) > 1 else 100000,
+        nb_users=int(sys.argv[2]) if len(sys.argv) > 2 else 100,
+    )
@@ -0,0 +1,66 @@
+"""
+Measures how many count jobs a single process drives at once, against the
+stub job server started in the same process: one job after the other with
+the blocking SyncJobClient.post_count_cohort, as a celery worker slot does,
+then all the jobs at once with HttpJobClient.
+
+    python tests/bench_job_client.py [nb_jobs] [min_duration] [max_duration]
+"""
+import asyncio
+import os
+import sys
+import time
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'cohort_back.settings')
+
+from cohort_back.FhirAPi import JobStatus
+from cohort_back.job_client import HttpJobClient, SyncJobClient
+from tests.stub_job_server import StubJobServer
+
+NB_BLOCKING_JOBS = 5
+
+
+async def run_concurrent(url: str, nb_jobs: int) -> (float, int):
+    client = HttpJobClient(url)
+    start = time.monotonic()
+    resps = await asyncio.gather(*[
+        client.count('{"query": %d}' % i, {}) for i in range(nb_jobs)
+    ])
+    duration = time.monotonic() - start
+    await client.close()
+    return duration, len([r for r in resps
+                          if r.fhir_job_status == JobStatus.FINISHED])
+
+
+def run_blocking(url: str, nb_jobs: int) -> float:
+    client = SyncJobClient(lambda: HttpJobClient(url))
+    start = time.monotonic()
+    for i in range(nb_jobs):
+        client.post_count_cohort('{"query": %d}' % i, {})
+    return time.monotonic() - start
+
+
+async def run(nb_jobs: int, min_duration: float, max_duration: float):
+    server = StubJobServer(min_duration, max_duration)
+    runner, url = await server.start()
+    try:
+        blocking = await asyncio.get_running_loop().run_in_executor(
+            None, run_blocking, url, NB_BLOCKING_JOBS
+        )
+        concurrent, finished = await run_concurrent(url, nb_jobs)
+    finally:
+        await runner.cleanup()
+
+    print(f"jobs lasting {min_duration}s to {max_duration}s")
+    print(f"blocking, one at a time: {NB_BLOCKING_JOBS / blocking:.1f} jobs/s")
+    print(f"async, {nb_jobs} at once:  {nb_jobs / concurrent:.1f} jobs/s "
+          f"({finished} finished, up to {server.max_running} in flight)")
+
+
+if __name__ == "__main__":
+    asyncio.run(run(
+        nb_jobs=int(sys.argv[1]) if len(sys.argv) > 1 else 500,
+        min_duration=float(sys.argv[2]) if len(sys.argv) > 2 else 0.5,
+        max_duration=float(sys.argv[3]) if len(sys.argv) > 3 else 2.,
+    ))
@@ -0,0 +1,122 @@
+"""
+Compares the former OMOP queries, built with IN lists of literal ids, with
+the ones binding the ids as a single array (= ANY(%s)), and with the
+patient count prepared once per connection.
+Synthetic provider, cohort_definition and visit_occurrence tables are created
+in a scratch schema of the OMOP database configured in settings, which is
+dropped at the end.
+
+    python tests/bench_omop_queries.py [nb_ids] [nb_runs]
+"""
+import os
+import sys
+import time
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'cohort_back.settings')
+
+import psycopg2
+
+from cohort_back.settings import PG_OMOP_URL, PG_OMOP_USER, PG_OMOP_PASS, PG_OMOP_DBNAME
+
+BENCH_SCHEMA = "bench_omop_queries"
+
+COHORTS_SQL = """
+    SELECT cd.cohort_definition_id, cd.cohort_size, p.provider_source_value
+    FROM cohort_definition cd
+        JOIN provider p ON p.provider_id=cd.owner_entity_id
+    WHERE p.provider_source_value {}
+        AND p.delete_datetime IS NULL
+        AND cd.cohort_size>0
+"""
+COUNT_SQL = """
+    SELECT COUNT(*) FROM (SELECT DISTINCT vo.person_id FROM visit_occurrence vo
+    WHERE vo.care_site_id {}) AS temp
+"""
+
+
+def create_fixture(c, nb_ids: int):
+    c.execute(f"DROP SCHEMA IF EXISTS {BENCH_SCHEMA} CASCADE")
+    c.execute(f"CREATE SCHEMA {BENCH_SCHEMA}")
+    c.execute(f"SET search_path TO {BENCH_SCHEMA}")
+    c.execute("""
+        CREATE TABLE provider AS
+        SELECT i AS provider_id, i::text AS provider_source_value,
+            NULL::timestamp AS delete_datetime
+        FROM generate_series(1, %s) i
+    """, (nb_ids * 10,))
+    c.execute("""
+        CREATE TABLE cohort_definition AS
+        SELECT i AS cohort_definition_id, (i %% %s) + 1 AS owner_entity_id,
+            i AS cohort_size
+        FROM generate_series(1, %s) i
+    """, (nb_ids * 10, nb_ids * 100))
+    c.execute("""
+        CREATE TABLE visit_occurrence AS
+        SELECT i AS visit_occurrence_id, i %% 100000 AS person_id,
+            (i %% %s)::bigint AS care_site_id
+        FROM generate_series(1, 1000000) i
+    """, (nb_ids * 10,))
+    c.execute("CREATE INDEX ON provider(provider_source_value)")
+    c.execute("CREATE INDEX ON cohort_definition(owner_entity_id)")
+    c.execute("CREATE INDEX ON visit_occurrence(care_site_id)")
+    c.execute("ANALYZE")
+
+
+def timed(nb_runs: int, fn) -> float:
+    start = time.monotonic()
+    for _ in range(nb_runs):
+        fn()
+    return (time.monotonic() - start) / nb_runs
+
+
+def run(nb_ids: int, nb_runs: int):
+    conn = psycopg2.connect(host=PG_OMOP_URL, database=PG_OMOP_DBNAME, user=PG_OMOP_USER, password=PG_OMOP_PASS)
+    c = conn.cursor()
+    try:
+        create_fixture(c, nb_ids)
+        conn.commit()
+
+        users_ids = [str(i) for i in range(1, nb_ids + 1)]
+        org_ids = list(range(1, nb_ids + 1))
+
+        def cohorts_in_list():
+            c.execute(COHORTS_SQL.format("IN ({})".format(", ".join([f"'{id}'" for id in users_ids]))))
+            c.fetchall()
+
+        def cohorts_any():
+            c.execute(COHORTS_SQL.format("= ANY(%s)"), (users_ids,))
+            c.fetchall()
+
+        def count_in_list():
+            c.execute(COUNT_SQL.format("IN ({})".format(','.join([str(e) for e in org_ids]))))
+            c.fetchall()
+
+        def count_any():
+            c.execute(COUNT_SQL.format("= ANY(%s)"), (org_ids,))
+            c.fetchall()
+
+        c.execute("PREPARE bench_count(bigint[]) AS {}".format(COUNT_SQL.format("= ANY($1)")))
+
+        def count_prepared():
+            c.execute("EXECUTE bench_count(%s)", (org_ids,))
+            c.fetchall()
+
+        print(f"{nb_ids} ids, mean of {nb_runs} runs")
+        print(f"cohorts, IN list:        {timed(nb_runs, cohorts_in_list) * 1000:.1f}ms")
+        print(f"cohorts, ANY(array):     {timed(nb_runs, cohorts_any) * 1000:.1f}ms")
+        print(f"count, IN list:          {timed(nb_runs, count_in_list) * 1000:.1f}ms")
+        print(f"count, ANY(array):       {timed(nb_runs, count_any) * 1000:.1f}ms")
+        print(f"count, prepared:         {timed(nb_runs, count_prepared) * 1000:.1f}ms")
+    finally:
+        conn.rollback()
+        c.execute(f"DROP SCHEMA IF EXISTS {BENCH_SCHEMA} CASCADE")
+        conn.commit()
+        conn.close()
+
+
+if __name__ == "__main__":
+    run(
+        nb_ids=int(sys.argv[1]) if len(sys.argv) > 1 else 1000,
+        nb_runs=int(sys.argv[2]) if len(sys.argv) > 2 else 20,
+    )
@@ -0,0 +1,115 @@
+"""
+Compares the perimeter filters of CohortFilter: the former one, through a
+join to the snapshots' perimeters_ids, without and with their GIN index,
+and the one on the perimeters_ids copied onto the cohorts.
+Synthetic snapshots, one cohort every cohort_every snapshots, are created
+in the database configured in settings. Everything is rolled back at the
+end.
+
+    python tests/bench_perimeter_filter.py [nb_snapshots] [cohort_every] [nb_runs]
+"""
+import os
+import random
+import sys
+import time
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'cohort_back.settings')
+
+import django
+
+django.setup()
+
+from django.db import connection, transaction
+
+from cohort.models import User
+from explorations.models import CohortResult, DatedMeasure, Folder, Request, \
+    RequestQuerySnapshot
+
+BATCH_SIZE = 10000
+NB_PERIMETERS = 5000
+
+
+def random_perimeters() -> [str]:
+    return [str(random.randint(1, NB_PERIMETERS))
+            for _ in range(random.randint(1, 5))]
+
+
+def create_fixture(user: User, nb_snapshots: int, cohort_every: int):
+    folder = Folder.objects.create(owner=user, name="bench")
+    r = Request.objects.create(owner=user, name="bench", parent_folder=folder)
+    for i in range(0, nb_snapshots, BATCH_SIZE):
+        rqss = RequestQuerySnapshot.objects.bulk_create([
+            RequestQuerySnapshot(owner=user, request=r, serialized_query="{}",
+                                 perimeters_ids=random_perimeters())
+            for _ in range(min(BATCH_SIZE, nb_snapshots - i))
+        ])
+        rqss = rqss[::cohort_every]
+        dms = DatedMeasure.objects.bulk_create([
+            DatedMeasure(owner=user, request=r, request_query_snapshot=rqs)
+            for rqs in rqss
+        ])
+        CohortResult.objects.bulk_create([
+            CohortResult(owner=user, request=r, request_query_snapshot=rqs,
+                         dated_measure=dm, perimeters_ids=rqs.perimeters_ids)
+            for (rqs, dm) in zip(rqss, dms)
+        ])
+    with connection.cursor() as c:
+        c.execute("ANALYZE explorations_requestquerysnapshot")
+        c.execute("ANALYZE explorations_cohortresult")
+
+
+def timed(nb_runs: int, fn) -> float:
+    start = time.monotonic()
+    for _ in range(nb_runs):
+        fn()
+    return (time.monotonic() - start) / nb_runs
+
+
+def run(nb_snapshots: int, cohort_every: int, nb_runs: int):
+    with transaction.atomic():
+        user = User.objects.create(username="bench", email="bench@bench.org")
+        create_fixture(user, nb_snapshots, cohort_every)
+        perimeters = [str(random.randint(1, NB_PERIMETERS))
+                      for _ in range(nb_runs)]
+        crs = CohortResult.objects.filter(owner=user)
+
+        def join_filter():
+            p = perimeters.pop()
+            perimeters.insert(0, p)
+            list(crs.filter(
+                request_query_snapshot__perimeters_ids__contains=[p]
+            ).values_list("uuid", flat=True)[:100])
+
+        def copy_filter():
+            p = perimeters.pop()
+            perimeters.insert(0, p)
+            list(crs.filter(
+                perimeters_ids__contains=[p]
+            ).values_list("uuid", flat=True)[:100])
+
+        with connection.cursor() as c:
+            c.execute("DROP INDEX rqs_perimeters_gin_idx")
+        join_no_index = timed(nb_runs, join_filter)
+        with connection.cursor() as c:
+            c.execute("CREATE INDEX rqs_perimeters_gin_idx ON "
+                      "explorations_requestquerysnapshot "
+                      "USING gin (perimeters_ids)")
+        join_gin = timed(nb_runs, join_filter)
+        copy_gin = timed(nb_runs, copy_filter)
+
+        transaction.set_rollback(True)
+
+    print(f"{nb_snapshots} snapshots, {nb_snapshots // cohort_every} cohorts, "
+          f"mean of {nb_runs} runs")
+    print(f"join, no index:         {join_no_index * 1000:.1f}ms")
+    print(f"join, GIN index:        {join_gin * 1000:.1f}ms")
+    print(f"cohort copy, GIN index: {copy_gin * 1000:.1f}ms")
+
+
+if __name__ == "__main__":
+    run(
+        nb_snapshots=int(sys.argv[1]) if len(sys.argv) > 1 else 1000000,
+        cohort_every=int(sys.argv[2]) if len(sys.argv) > 2 else 10,
+        nb_runs=int(sys.argv[3]) if len(sys.argv) > 3 else 20,
+    )
@@ -0,0 +1,117 @@
+"""
+Stub of a FHIR job server, implementing the API read by
+cohort_back.job_client.HttpJobClient, to benchmark the job clients offline.
+Jobs are only timers: they finish after a random duration, with a random
+count.
+
+    python tests/stub_job_server.py [port] [min_duration] [max_duration]
+"""
+import asyncio
+import random
+import sys
+import time
+from datetime import datetime
+from uuid import uuid4
+
+from aiohttp import web
+
+RUNNING = "RUNNING"
+FINISHED = "FINISHED"
+KILLED = "KILLED"
+
+
+class StubJobServer:
+    def __init__(self, min_duration: float = 0.5, max_duration: float = 2.):
+        self.min_duration = min_duration
+        self.max_duration = max_duration
+        self.jobs = dict()
+        self.max_running = 0
+
+    def get_job(self, job_id: str) -> dict:
+        job = self.jobs[job_id]
+        if job["status"] == RUNNING and time.monotonic() >= job["end"]:
+            job["status"] = FINISHED
+        res = dict(job_id=job_id, status=job["status"], err_msg="")
+        if job["status"] == FINISHED:
+            res.update(
+                datetime=datetime.now().isoformat(), count=job["count"],
+                duration=round(job["end"] - job["start"], 3)
+            )
+            if job["type"] == "count_all":
+                res.update(count_min=job["count"], count_max=job["count"])
+            if job["type"] == "create":
+                res.update(group_id=str(uuid4()))
+        return res
+
+    @property
+    def running(self) -> int:
+        now = time.monotonic()
+        return len([j for j in self.jobs.values()
+                    if j["status"] == RUNNING and now < j["end"]])
+
+    async def post_job(self, request: web.Request) -> web.Response:
+        data = await request.json()
+        if data.get("type") == "validate":
+            return web.json_response(dict(status=FINISHED, err_msg=""))
+
+        job_id = str(uuid4())
+        now = time.monotonic()
+        self.jobs[job_id] = dict(
+            type=data.get("type"), status=RUNNING, start=now,
+            end=now + random.uniform(self.min_duration, self.max_duration),
+            count=random.randint(0, 100000)
+        )
+        self.max_running = max(self.max_running, self.running)
+        return web.json_response(self.get_job(job_id), status=201)
+
+    async def get(self, request: web.Request) -> web.Response:
+        job_id = request.match_info["job_id"]
+        if job_id not in self.jobs:
+            return web.json_response(dict(err_msg="Not found"), status=404)
+        return web.json_response(self.get_job(job_id))
+
+    async def delete(self, request: web.Request) -> web.Response:
+        job_id = request.match_info["job_id"]
+        if job_id not in self.jobs:
+            return web.json_response(dict(err_msg="Not found"), status=404)
+        if self.get_job(job_id)["status"] == RUNNING:
+            self.jobs[job_id]["status"] = KILLED
+        return web.json_response(self.get_job(job_id))
+
+    def build_app(self) -> web.Application:
+        app = web.Application()
+        app.add_routes([
+            web.post("/jobs", self.post_job),
+            web.get("/jobs/{job_id}", self.get),
+            web.delete("/jobs/{job_id}", self.delete),
+        ])
+        return app
+
+    async def start(self, port: int = 0) -> (web.AppRunner, str):
+        """
+        Starts the server in the running loop, on a free port if port is 0
+        Returns the runner, to clean it up, and the server's url
+        """
+        runner = web.AppRunner(self.build_app())
+        await runner.setup()
+        site = web.TCPSite(runner, "127.0.0.1", port)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        return runner, f"http://127.0.0.1:{port}"
+
+
+async def serve(port: int, min_duration: float, max_duration: float):
+    runner, url = await StubJobServer(min_duration, max_duration).start(port)
+    print(f"Stub job server listening on {url}")
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await runner.cleanup()
+
+
+if __name__ == "__main__":
+    asyncio.run(serve(
+        port=int(sys.argv[1]) if len(sys.argv) > 1 else 8090,
+        min_duration=float(sys.argv[2]) if len(sys.argv) > 2 else 0.5,
+        max_duration=float(sys.argv[3]) if len(sys.argv) > 3 else 2.,
+    ))
@@ -1,14 +1,14 @@
-import requests
 from requests import Response
 
+from cohort_back.http_client import http_client
 from cohort_back.settings import VOTING_GITLAB
 
 
 def req_url(method, end, data=None):
     url = VOTING_GITLAB['api_url'] + "/projects/" + VOTING_GITLAB['project_id'] + end
 
-    return getattr(requests, method)(
-        url,
+    return http_client.request(
+        method, url,
         headers={"PRIVATE-TOKEN": VOTING_GITLAB['private_token']},
         data=data)
 
@@ -32,7 +32,7 @@ class AttachmentReturned:
 def post_gitlab_attachment(file) -> Response:
     url = f"{VOTING_GITLAB['api_url']}/projects/" \
           f"{VOTING_GITLAB['project_id']}/uploads"
-    return requests.post(
+    return http_client.post(
         url,
         headers={
             "PRIVATE-TOKEN": VOTING_GITLAB['private_token'],
@@ -45,7 +45,7 @@ def post_gitlab_issue(data: dict={}):
     url = f"{VOTING_GITLAB['api_url']}/projects/" \
           f"{VOTING_GITLAB['project_id']}/issues"
 
-    return requests.post(
+    return http_client.post(
         url,
         headers={"PRIVATE-TOKEN": VOTING_GITLAB['private_token']},
         data=data